@@ -13,10 +13,26 @@
 # limitations under the License.
 
 import os
+import stat as stat_module
+import time
+
+from idmapshift import prune
+from idmapshift.idmap import compose_maps  # noqa
+from idmapshift.idmap import HostIdSet  # noqa
+from idmapshift.idmap import IdMap  # noqa
+from idmapshift.inodes import InodeSet  # noqa
+from idmapshift.stats import lstat_entry
+from idmapshift.stats import Stats  # noqa
+from idmapshift import xattrs as xattrs_module
+
+DIR_OPEN_FLAGS = os.O_RDONLY | os.O_DIRECTORY | getattr(os, 'O_CLOEXEC', 0)
 
 
 def find_target_id(fsid, mappings, nobody, memo):
     if fsid not in memo:
+        if isinstance(mappings, IdMap):
+            memo[fsid] = mappings.lookup(fsid, nobody)
+            return memo[fsid]
         for start, target, count in mappings:
             if start <= fsid < start + count:
                 memo[fsid] = (fsid - start) + target
@@ -27,52 +43,372 @@ def find_target_id(fsid, mappings, nobody, memo):
     return memo[fsid]
 
 
+def find_target_ids(fsids, mappings, nobody):
+    """Batch form of find_target_id; see IdMap.lookup_many."""
+    if not isinstance(mappings, IdMap):
+        mappings = IdMap(mappings)
+    return mappings.lookup_many(fsids, nobody)
+
+
+class ShiftResult(object):
+    """Per-run counts returned by shift_dir.
+
+    visited is every inode looked at; each one is then counted as changed
+    (its ownership was, or in a dry run would be, rewritten) or unchanged
+    (it already had the target ownership). mapped_to_nobody counts the
+    inodes whose uid or gid fell outside the mappings. hardlinks_skipped
+    counts the extra links to an inode that had already been shifted
+    through another link, i.e. the chowns saved by tracking hard links.
+    pruned counts the entries left out of the walk, with their subtrees,
+    by excludes or one_file_system; see idmapshift.prune. xattrs_shifted
+    counts the ACL and capability xattrs rewritten with xattrs. missing
+    counts the listed paths that no longer existed; see shift_paths.
+    """
+
+    FIELDS = ('visited', 'changed', 'unchanged', 'mapped_to_nobody',
+              'hardlinks_skipped', 'pruned', 'xattrs_shifted', 'missing')
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def merge(self, other):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+
+def is_hardlinked(stat):
+    """Return True for a non-directory with more than one link."""
+    return stat.st_nlink > 1 and not stat_module.S_ISDIR(stat.st_mode)
+
+
 def print_chown(path, uid, gid, target_uid, target_gid):
     print('%s %s:%s -> %s:%s' % (path, uid, gid, target_uid, target_gid))
 
 
 def shift_path(path, uid_mappings, gid_mappings, nobody, uid_memo, gid_memo,
-               dry_run=False, verbose=False):
-    stat = os.lstat(path)
+               dry_run=False, verbose=False, stat=None, dir_fd=None,
+               name=None, result=None, skip_ranges=None, printer=None,
+               hardlinks=None, stats=None, pre_entry=None, post_entry=None,
+               entry_filter=None, xattrs=False):
+    """Shift the ownership of a single path.
+
+    The path is only chowned when its ownership actually changes. If
+    skip_ranges is a (uid_ranges, gid_ranges) pair, a path whose ownership
+    already confirms against those ranges is treated as shifted and left
+    alone. When they are IdMaps that map nobody as a guest id, host
+    nobody does not count as shifted: it is as likely to be the guest's
+    own nobody, which still has to be mapped. Returns True if the path
+    was (or, in a dry run, would be) chowned, and tallies the outcome in
+    result when one is given.
+    Verbose output goes to printer, which takes print_chown's arguments,
+    when one is given.
+
+    If hardlinks is an InodeSet, a non-directory with more than one link
+    is only shifted the first time one of its links is seen; later links
+    would otherwise see the already shifted ids and map them again.
+
+    If stats is a Stats, the lookups and the chown are counted and timed
+    there.
+
+    The hooks take the path and its stat: a path for which entry_filter
+    returns False is left alone and not counted, pre_entry is called
+    before the path is shifted and post_entry, with changed as a third
+    argument, after.
+
+    With xattrs, the ids in the path's POSIX ACLs and v3 file capability
+    are shifted too, unless skip_ranges says the path is already
+    shifted; see idmapshift.xattrs. Symlinks are not checked for them.
+    With dir_fd, the xattrs are reached relative to it, like the chown.
+    """
+    if stat is None:
+        stat = os.lstat(path)
+    hooked = entry_filter is not None or pre_entry is not None
+    if hooked or post_entry is not None:
+        if entry_filter is not None and not entry_filter(path, stat):
+            return False
+        if pre_entry is not None:
+            pre_entry(path, stat)
+        changed = shift_path(path, uid_mappings, gid_mappings, nobody,
+                             uid_memo, gid_memo, dry_run=dry_run,
+                             verbose=verbose, stat=stat, dir_fd=dir_fd,
+                             name=name, result=result,
+                             skip_ranges=skip_ranges, printer=printer,
+                             hardlinks=hardlinks, stats=stats,
+                             xattrs=xattrs)
+        if post_entry is not None:
+            post_entry(path, stat, changed)
+        return changed
+    if stats is not None:
+        stats.entries += 1
+    if hardlinks is not None and is_hardlinked(stat):
+        if not hardlinks.add(stat.st_dev, stat.st_ino):
+            if result is not None:
+                result.hardlinks_skipped += 1
+            if stats is not None:
+                stats.skips += 1
+            return False
     uid = stat.st_uid
     gid = stat.st_gid
-    target_uid = find_target_id(uid, uid_mappings, nobody, uid_memo)
-    target_gid = find_target_id(gid, gid_mappings, nobody, gid_memo)
+    saved = None
+    if skip_ranges is not None and _already_shifted(path, skip_ranges,
+                                                    nobody, stat):
+        target_uid = uid
+        target_gid = gid
+    else:
+        if xattrs and not stat_module.S_ISLNK(stat.st_mode):
+            # Read before the chown, which drops file capabilities.
+            saved = xattrs_module.read(path, dir_fd, name, stat)
+        if stats is None:
+            target_uid = find_target_id(uid, uid_mappings, nobody, uid_memo)
+            target_gid = find_target_id(gid, gid_mappings, nobody, gid_memo)
+        else:
+            stats.lookups += 2
+            stats.memo_hits += (uid in uid_memo) + (gid in gid_memo)
+            start = time.perf_counter_ns()
+            target_uid = find_target_id(uid, uid_mappings, nobody, uid_memo)
+            target_gid = find_target_id(gid, gid_mappings, nobody, gid_memo)
+            stats.lookup_ns += time.perf_counter_ns() - start
+    changed = target_uid != uid or target_gid != gid
+    if result is not None:
+        result.visited += 1
+        if changed:
+            result.changed += 1
+        else:
+            result.unchanged += 1
+        if target_uid == nobody != uid or target_gid == nobody != gid:
+            result.mapped_to_nobody += 1
     if verbose:
-        print_chown(path, uid, gid, target_uid, target_gid)
-    if not dry_run:
+        (printer or print_chown)(path, uid, gid, target_uid, target_gid)
+    if not changed or dry_run:
+        if saved:
+            _shift_xattrs(path, saved, uid_mappings, gid_mappings, nobody,
+                          uid_memo, gid_memo, result, False, dry_run,
+                          dir_fd, name, stat)
+        if stats is not None:
+            stats.skips += not changed
+        return changed
+    if stats is not None:
+        stats.chowns += 1
+        start = time.perf_counter_ns()
+    if dir_fd is None:
         os.lchown(path, target_uid, target_gid)
+    else:
+        os.chown(name, target_uid, target_gid, dir_fd=dir_fd,
+                 follow_symlinks=False)
+    if stats is not None:
+        elapsed = time.perf_counter_ns() - start
+        stats.lchown.add(elapsed)
+        if stats.keep_slowest:
+            stats.note(elapsed, path, 'chown')
+    if saved:
+        _shift_xattrs(path, saved, uid_mappings, gid_mappings, nobody,
+                      uid_memo, gid_memo, result, True, False, dir_fd, name,
+                      stat)
+    return changed
+
+
+def _shift_xattrs(path, values, uid_mappings, gid_mappings, nobody,
+                  uid_memo, gid_memo, result, chowned, dry_run, dir_fd,
+                  name, stat):
+    def uid_map(fsid):
+        return find_target_id(fsid, uid_mappings, nobody, uid_memo)
+
+    def gid_map(fsid):
+        return find_target_id(fsid, gid_mappings, nobody, gid_memo)
+
+    shifted = xattrs_module.shift(path, values, uid_map, gid_map,
+                                  chowned=chowned, dry_run=dry_run,
+                                  dir_fd=dir_fd, name=name, stat=stat)
+    if result is not None:
+        result.xattrs_shifted += shifted
+
+
+def _lstat(path, stats, lstat=None):
+    if lstat is None:
+        lstat = os.lstat
+    if stats is None:
+        return lstat(path)
+    start = time.perf_counter_ns()
+    stat = lstat(path)
+    elapsed = time.perf_counter_ns() - start
+    stats.lstat.add(elapsed)
+    if stats.keep_slowest:
+        stats.note(elapsed, path, 'lstat')
+    return stat
+
+
+def iter_tree(fsdir, stats=None, prune=None, lstat=None):
+    """Yield (path, stat) for fsdir and every entry beneath it.
+
+    Directories are listed with os.scandir and each entry is lstat'ed
+    exactly once, through DirEntry.stat(follow_symlinks=False), so callers
+    can act on the stat without another syscall. A directory's entries are
+    yielded before any of its subdirectories are listed, and unreadable
+    directories are skipped, as with os.walk. Listings and lstats are
+    counted and timed in stats when one is given. An entry for which
+    prune(path, stat) returns True is neither yielded nor descended into.
+    With lstat, e.g. an idmapshift.statx.Lstat, entries are stat'ed with
+    lstat(path) instead.
+    """
+    yield fsdir, (lstat or os.lstat)(fsdir)
+    pending = [fsdir]
+    while pending:
+        root = pending.pop()
+        try:
+            entries = os.scandir(root)
+        except OSError:
+            continue
+        if stats is not None:
+            stats.dirs += 1
+        subdirs = []
+        with entries:
+            for entry in entries:
+                stat = lstat_entry(entry, stats, lstat)
+                if prune is not None and prune(entry.path, stat):
+                    continue
+                yield entry.path, stat
+                if stat_module.S_ISDIR(stat.st_mode):
+                    subdirs.append(entry.path)
+        pending.extend(reversed(subdirs))
+
+
+class DirHandle(object):
+    """An open directory fd shared by the subdirectories still to visit."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.refs = 0
+
+    def release(self):
+        self.refs -= 1
+        if self.refs <= 0:
+            self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def iter_tree_fd(fsdir, stats=None, prune=None, lstat=None):
+    """Yield (path, stat, dir_fd, name) for fsdir and every entry beneath it.
+
+    Like iter_tree, but every directory is opened relative to its parent's
+    fd with O_NOFOLLOW and entries are stat'ed relative to the directory
+    they live in, so the kernel never resolves a full path after the root.
+    Callers act on (dir_fd, name) while the entry is being yielded; the
+    root itself is yielded with a dir_fd and name of None. A parent fd is
+    closed as soon as its last subdirectory has been opened, so a deep
+    chain holds a constant number of descriptors. stats and prune are as
+    for iter_tree; lstat is called as lstat(name, dir_fd).
+    """
+    yield fsdir, (lstat or os.lstat)(fsdir), None, None
+    try:
+        root = DirHandle(os.open(fsdir, DIR_OPEN_FLAGS))
+    except OSError:
+        return
+    handles = [root]
+    pending = [(root, None, fsdir)]
+    try:
+        while pending:
+            parent, dirname, dirpath = pending.pop()
+            if dirname is None:
+                handle = parent
+            else:
+                try:
+                    fd = os.open(dirname, DIR_OPEN_FLAGS | os.O_NOFOLLOW,
+                                 dir_fd=parent.fd)
+                except OSError:
+                    fd = None
+                parent.release()
+                if fd is None:
+                    continue
+                handle = DirHandle(fd)
+                handles.append(handle)
+            subdirs = []
+            try:
+                entries = os.scandir(handle.fd)
+            except OSError:
+                handle.close()
+                continue
+            if stats is not None:
+                stats.dirs += 1
+            with entries:
+                for entry in entries:
+                    stat = lstat_entry(entry, stats, lstat, handle.fd)
+                    path = os.path.join(dirpath, entry.name)
+                    if prune is not None and prune(path, stat):
+                        continue
+                    yield path, stat, handle.fd, entry.name
+                    if stat_module.S_ISDIR(stat.st_mode):
+                        subdirs.append(entry.name)
+            handle.refs = len(subdirs)
+            if not subdirs:
+                handle.close()
+            pending.extend((handle, name, os.path.join(dirpath, name))
+                           for name in reversed(subdirs))
+            handles = [h for h in handles if h.fd is not None]
+    finally:
+        for handle in handles:
+            handle.close()
 
 
 def shift_dir(fsdir, uid_mappings, gid_mappings, nobody,
-              dry_run=False, verbose=False):
-    uid_memo = dict()
-    gid_memo = dict()
-
-    def shift_path_short(p):
-        shift_path(p, uid_mappings, gid_mappings, nobody,
-                   dry_run=dry_run, verbose=verbose,
-                   uid_memo=uid_memo, gid_memo=gid_memo)
-
-    shift_path_short(fsdir)
-    for root, dirs, files in os.walk(fsdir):
-        for d in dirs:
-            path = os.path.join(root, d)
-            shift_path_short(path)
-        for f in files:
-            path = os.path.join(root, f)
-            shift_path_short(path)
-
-
-def confirm_path(path, uid_ranges, gid_ranges, nobody):
-    stat = os.lstat(path)
+              dry_run=False, verbose=False, fd_relative=False,
+              idempotent=False, jobs=1, processes=1, journal=None,
+              resume=False, manifest=None, stats=None, printer=None,
+              excludes=None, one_file_system=False, statx=False,
+              dont_sync=False, xattrs=False):
+    """Shift the ownership of fsdir and everything beneath it.
+
+    A wrapper around IdMapShifter(...).shift(); see there for the options.
+    Returns a ShiftResult.
+    """
+    shifter = IdMapShifter(uid_mappings, gid_mappings, nobody, stats=stats,
+                           excludes=excludes,
+                           one_file_system=one_file_system, statx=statx,
+                           dont_sync=dont_sync, xattrs=xattrs)
+    return shifter.shift(fsdir, dry_run=dry_run, verbose=verbose,
+                         fd_relative=fd_relative, idempotent=idempotent,
+                         jobs=jobs, processes=processes, journal=journal,
+                         resume=resume, manifest=manifest, printer=printer)
+
+
+def remap_dir(fsdir, src_uid_mappings, src_gid_mappings, dst_uid_mappings,
+              dst_gid_mappings, nobody, **kwargs):
+    """Move fsdir's ownership from one pair of id maps to another.
+
+    fsdir must already be shifted for the src maps. Both pairs are
+    composed up front into host-to-host maps with compose_maps, so the
+    tree is rewritten in one shift_dir pass rather than shifted back to
+    guest ids and then forward again. Ids outside the src maps become
+    nobody. kwargs are passed to shift_dir, whose ShiftResult is returned.
+    """
+    return shift_dir(fsdir, compose_maps(src_uid_mappings, dst_uid_mappings),
+                     compose_maps(src_gid_mappings, dst_gid_mappings),
+                     nobody, **kwargs)
+
+
+def confirm_path(path, uid_ranges, gid_ranges, nobody, stat=None):
+    if stat is None:
+        stat = os.lstat(path)
     uid = stat.st_uid
     gid = stat.st_gid
 
+    if isinstance(uid_ranges, HostIdSet):
+        return uid in uid_ranges and gid in gid_ranges
+
     uid_in_range = True if uid == nobody else False
     gid_in_range = True if gid == nobody else False
 
-    if not uid_in_range or not gid_in_range:
+    if isinstance(uid_ranges, IdMap):
+        uid_in_range = uid_in_range or uid_ranges.contains_host(uid)
+        gid_in_range = gid_in_range or gid_ranges.contains_host(gid)
+    elif not uid_in_range or not gid_in_range:
         for (start, end) in uid_ranges:
             if start <= uid <= end:
                 uid_in_range = True
@@ -86,23 +422,480 @@ def confirm_path(path, uid_ranges, gid_ranges, nobody):
     return uid_in_range and gid_in_range
 
 
+def _already_shifted(path, skip_ranges, nobody, stat):
+    uid_ranges, gid_ranges = skip_ranges
+    if not confirm_path(path, uid_ranges, gid_ranges, nobody, stat=stat):
+        return False
+    if stat.st_uid == nobody and _maps_nobody(uid_ranges, nobody):
+        return False
+    return not (stat.st_gid == nobody and _maps_nobody(gid_ranges, nobody))
+
+
+def _maps_nobody(mappings, nobody):
+    """Return True if nobody is a mapped guest id but not a host one."""
+    if not isinstance(mappings, IdMap) or mappings.contains_host(nobody):
+        return False
+    return mappings.lookup(nobody) is not None
+
+
 def get_ranges(maps):
     return [(target, target + count - 1) for (start, target, count) in maps]
 
 
-def confirm_dir(fsdir, uid_mappings, gid_mappings, nobody):
-    uid_ranges = get_ranges(uid_mappings)
-    gid_ranges = get_ranges(gid_mappings)
+def confirm_dir(fsdir, uid_mappings, gid_mappings, nobody, jobs=1,
+                processes=1, manifest=None, stats=None, excludes=None,
+                one_file_system=False, statx=False, dont_sync=False):
+    """Return True if everything under fsdir is owned by a mapped host id.
 
-    if not confirm_path(fsdir, uid_ranges, gid_ranges, nobody):
-        return False
-    for root, dirs, files in os.walk(fsdir):
-        for d in dirs:
-            path = os.path.join(root, d)
-            if not confirm_path(path, uid_ranges, gid_ranges, nobody):
-                return False
-        for f in files:
-            path = os.path.join(root, f)
-            if not confirm_path(path, uid_ranges, gid_ranges, nobody):
+    A wrapper around IdMapShifter(...).confirm(); see there for the
+    options.
+    """
+    shifter = IdMapShifter(uid_mappings, gid_mappings, nobody, stats=stats,
+                           excludes=excludes,
+                           one_file_system=one_file_system, statx=statx,
+                           dont_sync=dont_sync)
+    return shifter.confirm(fsdir, jobs=jobs, processes=processes,
+                           manifest=manifest)
+
+
+class IdMapShifter(object):
+    """Shifts and confirms trees for one pair of id maps.
+
+    The maps are compiled once, and the uid/gid memos are kept for the
+    life of the shifter, so callers that shift many trees with the same
+    maps keep them warm. stats, a Stats, collects every call's counters
+    and timings. The hooks are passed to shift_path for every entry:
+    entry_filter(path, stat) returning False leaves an entry alone,
+    pre_entry(path, stat) runs before it is shifted and
+    post_entry(path, stat, changed) after. Hooks are plain callables, so
+    they cannot be used with worker processes.
+
+    Every walk leaves out the entries matching excludes, and with
+    one_file_system those on another device than the root, along with
+    everything beneath them; see idmapshift.prune. They are counted in
+    ShiftResult.pruned and Stats.pruned.
+
+    With statx, entries are stat'ed with statx(2) for just the fields a
+    walk uses, and with dont_sync too without revalidating them against
+    a network filesystem's server; see idmapshift.statx. The stats hooks
+    are given then only have st_mode, st_ino, st_dev, st_nlink, st_uid
+    and st_gid. The journal and manifest walks do not support it.
+
+    With xattrs, every shift also translates the ids in POSIX ACLs and v3
+    file capabilities in the same pass; see idmapshift.xattrs.
+    """
+
+    def __init__(self, uid_mappings, gid_mappings, nobody, stats=None,
+                 pre_entry=None, post_entry=None, entry_filter=None,
+                 excludes=None, one_file_system=False, statx=False,
+                 dont_sync=False, xattrs=False):
+        self.uid_mappings = IdMap(uid_mappings)
+        self.gid_mappings = IdMap(gid_mappings)
+        self.nobody = nobody
+        self.uid_memo = dict()
+        self.gid_memo = dict()
+        self.stats = stats
+        self.pre_entry = pre_entry
+        self.post_entry = post_entry
+        self.entry_filter = entry_filter
+        self.xattrs = xattrs
+        self.excludes = tuple(excludes or ())
+        self.one_file_system = one_file_system
+        # Fail on a bad pattern now rather than at the first walk.
+        prune.compile_excludes(self.excludes)
+        if dont_sync and not statx:
+            raise ValueError('dont_sync requires statx')
+        self.lstat = None
+        if statx:
+            from idmapshift import statx as statx_module
+            self.lstat = statx_module.Lstat(dont_sync)
+        self._ranges = None
+
+    def _pruner(self, fsdir):
+        if not self.excludes and not self.one_file_system:
+            return None
+        return prune.Pruner(fsdir, self.excludes, self.one_file_system)
+
+    def _count_pruned(self, pruner, result=None):
+        if pruner is None:
+            return
+        if result is not None:
+            result.pruned += pruner.pruned
+            pruned = result.pruned
+        else:
+            pruned = pruner.pruned
+        if self.stats is not None:
+            self.stats.pruned += pruned
+
+    def _hooked(self):
+        hooks = (self.pre_entry, self.post_entry, self.entry_filter)
+        return any(hook is not None for hook in hooks)
+
+    def translate(self, uid, gid):
+        """Return the host (uid, gid) that a guest uid and gid map to."""
+        return (find_target_id(uid, self.uid_mappings, self.nobody,
+                               self.uid_memo),
+                find_target_id(gid, self.gid_mappings, self.nobody,
+                               self.gid_memo))
+
+    def host_ranges(self):
+        """Return the (uid, gid) HostIdSets of ids a shifted tree may use."""
+        if self._ranges is None:
+            self._ranges = (
+                HostIdSet(get_ranges(self.uid_mappings), [self.nobody]),
+                HostIdSet(get_ranges(self.gid_mappings), [self.nobody]))
+        return self._ranges
+
+    def shift(self, fsdir, dry_run=False, verbose=False, fd_relative=False,
+              idempotent=False, jobs=1, processes=1, journal=None,
+              resume=False, manifest=None, printer=None):
+        """Shift the ownership of fsdir and everything beneath it.
+
+        With fd_relative, the tree is walked with iter_tree_fd and each
+        entry is chowned relative to its directory's fd instead of by full
+        path. With idempotent, nothing is done if the tree already
+        confirms; the check stops at the first entry out of range, which
+        in a tree that still needs shifting is usually the root.
+        Otherwise entries whose ownership already confirms against the
+        target ranges are left as they are, so a partially shifted tree
+        can be finished, but nobody counts as shifted only when it is not
+        a mapped guest id. A single inode cannot tell whether it is the
+        guest's nobody or an id shifted to nobody, so this is the answer
+        for a tree that is known to need shifting. With jobs
+        greater than one, directories are shifted concurrently by that
+        many threads; see idmapshift.parallel.shift_dir_threads. With
+        processes greater than one, subtrees are sharded across that many
+        worker processes instead; see
+        idmapshift.parallel.shift_dir_processes.
+
+        With journal, a path, progress is recorded there as directories
+        finish and, with resume, a previous run's journal is picked up so
+        finished subtrees are skipped; see idmapshift.journal.
+
+        With manifest, a path, an ownership manifest of the shifted tree
+        is written there, and a manifest left by an earlier run with the
+        same maps is used to skip directories that have not changed since;
+        see idmapshift.manifest. This implies idempotent.
+
+        Verbose output goes to printer, e.g. an
+        idmapshift.output.OutputSink, when one is given. Returns a
+        ShiftResult.
+        """
+        start = time.perf_counter_ns()
+        result = ShiftResult()
+        uid_mappings = self.uid_mappings
+        gid_mappings = self.gid_mappings
+        nobody = self.nobody
+        stats = self.stats
+        skip_ranges = None
+        if idempotent or manifest is not None:
+            skip_ranges = (uid_mappings, gid_mappings)
+        kwargs = self._shift_kwargs(result, dry_run, verbose, skip_ranges,
+                                    printer)
+
+        if jobs > 1 and processes > 1:
+            raise ValueError('jobs and processes are mutually exclusive')
+        if fd_relative and (jobs > 1 or processes > 1):
+            raise ValueError('fd_relative does not support jobs or processes')
+        if journal is not None:
+            if fd_relative or jobs > 1 or processes > 1:
+                raise ValueError('journal only supports the serial walk')
+            if dry_run:
+                raise ValueError('journal cannot be used with dry_run')
+        if resume and journal is None:
+            raise ValueError('resume requires a journal')
+        if manifest is not None:
+            if fd_relative or jobs > 1 or processes > 1 or journal:
+                raise ValueError('manifest only supports the serial walk')
+            if dry_run:
+                raise ValueError('manifest cannot be used with dry_run')
+        if processes > 1 and self._hooked():
+            raise ValueError('hooks are not supported with processes')
+        lstat = self.lstat
+        if lstat is not None and (journal is not None or manifest):
+            raise ValueError('statx is not supported with journal or '
+                             'manifest')
+
+        if idempotent or manifest is not None:
+            if not resume and self._shifted_already(fsdir, jobs, processes,
+                                                    manifest, result):
+                if stats is not None:
+                    stats.wall_ns += time.perf_counter_ns() - start
+                return result
+
+        pruner = self._pruner(fsdir)
+        if manifest is not None:
+            from idmapshift import manifest as manifest_module
+            manifest_module.shift_dir_manifest(fsdir, uid_mappings,
+                                               gid_mappings, nobody,
+                                               manifest, prune=pruner,
+                                               **kwargs)
+        elif journal is not None:
+            from idmapshift import journal as journal_module
+            fingerprint = journal_module.fingerprint(fsdir, uid_mappings,
+                                                     gid_mappings, nobody,
+                                                     pruner)
+            progress = journal_module.Journal(journal, fingerprint,
+                                              resume=resume)
+            try:
+                journal_module.shift_dir_journaled(fsdir, uid_mappings,
+                                                   gid_mappings, nobody,
+                                                   progress, prune=pruner,
+                                                   **kwargs)
+            finally:
+                progress.close()
+        elif jobs > 1:
+            from idmapshift import parallel
+            parallel.shift_dir_threads(fsdir, uid_mappings, gid_mappings,
+                                       nobody, jobs, prune=pruner,
+                                       lstat=lstat, **kwargs)
+        elif processes > 1:
+            if verbose:
+                raise ValueError('verbose is not supported with processes')
+            from idmapshift import parallel
+            parallel.shift_dir_processes(fsdir, uid_mappings, gid_mappings,
+                                         nobody, processes, result,
+                                         dry_run=dry_run,
+                                         skip_ranges=skip_ranges,
+                                         stats=stats, prune=pruner,
+                                         lstat=lstat, xattrs=self.xattrs)
+        elif fd_relative:
+            entries = iter_tree_fd(fsdir, stats, pruner, lstat)
+            for path, stat, dir_fd, name in entries:
+                shift_path(path, uid_mappings, gid_mappings, nobody,
+                           stat=stat, dir_fd=dir_fd, name=name, **kwargs)
+        else:
+            for path, stat in iter_tree(fsdir, stats, pruner, lstat):
+                self._shift_entry(path, stat, kwargs)
+        self._count_pruned(pruner, result)
+        if stats is not None:
+            stats.wall_ns += time.perf_counter_ns() - start
+        return result
+
+    def _shift_kwargs(self, result, dry_run=False, verbose=False,
+                      skip_ranges=None, printer=None):
+        """Return the shift_path keyword arguments for one shift."""
+        return dict(dry_run=dry_run, verbose=verbose,
+                    uid_memo=self.uid_memo, gid_memo=self.gid_memo,
+                    result=result, skip_ranges=skip_ranges,
+                    hardlinks=InodeSet(), stats=self.stats, printer=printer,
+                    pre_entry=self.pre_entry, post_entry=self.post_entry,
+                    entry_filter=self.entry_filter, xattrs=self.xattrs)
+
+    def _shift_entry(self, path, stat, kwargs):
+        """Shift one entry of a walk, kwargs being from _shift_kwargs."""
+        return shift_path(path, self.uid_mappings, self.gid_mappings,
+                          self.nobody, stat=stat, **kwargs)
+
+    def shift_paths(self, paths, dry_run=False, verbose=False,
+                    idempotent=False, printer=None, root=None):
+        """Shift the ownership of each path in paths, and nothing else.
+
+        paths is any iterable, e.g. idmapshift.pathlist.read_paths, and is
+        consumed lazily. Directories are not descended into. Every inode
+        is shifted once, however many times and under however many links
+        it is listed; the repeats are counted as hardlinks_skipped. A path
+        that no longer exists is counted as missing and left out.
+        excludes and one_file_system apply to the paths below root, which
+        they require. The options otherwise match shift's. Returns a
+        ShiftResult.
+        """
+        start = time.perf_counter_ns()
+        result = ShiftResult()
+        stats = self.stats
+        skip_ranges = None
+        if idempotent:
+            skip_ranges = (self.uid_mappings, self.gid_mappings)
+        shifted = InodeSet()
+        pruner = self._paths_pruner(root)
+        for path in paths:
+            try:
+                stat = _lstat(path, stats, self.lstat)
+                if pruner is not None and pruner.listed(path, stat):
+                    continue
+                if not shifted.add(stat.st_dev, stat.st_ino):
+                    result.hardlinks_skipped += 1
+                    if stats is not None:
+                        stats.skips += 1
+                    continue
+                shift_path(path, self.uid_mappings, self.gid_mappings,
+                           self.nobody, self.uid_memo, self.gid_memo,
+                           dry_run=dry_run, verbose=verbose, stat=stat,
+                           result=result, skip_ranges=skip_ranges,
+                           printer=printer, stats=stats,
+                           pre_entry=self.pre_entry,
+                           post_entry=self.post_entry,
+                           entry_filter=self.entry_filter,
+                           xattrs=self.xattrs)
+            except FileNotFoundError:
+                result.missing += 1
+        self._count_pruned(pruner, result)
+        if stats is not None:
+            stats.wall_ns += time.perf_counter_ns() - start
+        return result
+
+    def _paths_pruner(self, root):
+        if root is None:
+            if self.excludes or self.one_file_system:
+                raise ValueError('excludes and one_file_system need a root '
+                                 'for a path list')
+            return None
+        return self._pruner(root)
+
+    def confirm_paths(self, paths, root=None, result=None):
+        """Return True if each path in paths is owned by a mapped id.
+
+        Checking stops at the first path out of range, so the rest of
+        paths is not consumed. A path that no longer exists is skipped
+        and, if result, a ShiftResult, is given, counted as missing there.
+        root is as for shift_paths.
+        """
+        stats = self.stats
+        entry_filter = self.entry_filter
+        pruner = self._paths_pruner(root)
+        start = time.perf_counter_ns()
+        try:
+            for path in paths:
+                try:
+                    stat = _lstat(path, stats, self.lstat)
+                except FileNotFoundError:
+                    if result is not None:
+                        result.missing += 1
+                    continue
+                if pruner is not None and pruner.listed(path, stat):
+                    continue
+                if not self._confirm_entry(path, stat, stats, entry_filter):
+                    return False
+            return True
+        finally:
+            self._count_pruned(pruner)
+            if stats is not None:
+                stats.wall_ns += time.perf_counter_ns() - start
+
+    def confirm(self, fsdir, jobs=1, processes=1, manifest=None):
+        """Return True if everything under fsdir is owned by a mapped id.
+
+        The allowed host ids, nobody included, are compiled into HostIdSet
+        bitmaps by host_ranges so every check is O(1). With jobs or
+        processes greater than one, the tree is checked by that many
+        threads or worker processes, and all of them stop as soon as one
+        finds an entry out of range; see idmapshift.parallel.
+
+        With manifest, a path written by shift, directories unchanged
+        since it was written are not listed, and the manifest is
+        refreshed when the tree confirms; see idmapshift.manifest. Stats
+        and entry_filter are only supported by the serial walk, where
+        entries the filter rejects are not checked.
+        """
+        stats = self.stats
+        entry_filter = self.entry_filter
+        if jobs > 1 and processes > 1:
+            raise ValueError('jobs and processes are mutually exclusive')
+        serial = jobs <= 1 and processes <= 1 and manifest is None
+        if stats is not None and not serial:
+            raise ValueError('stats are only collected by the serial confirm')
+        if entry_filter is not None and not serial:
+            raise ValueError('entry_filter only supports the serial confirm')
+        if manifest is not None:
+            if jobs > 1 or processes > 1:
+                raise ValueError('manifest only supports the serial walk')
+            if self.lstat is not None:
+                raise ValueError('statx is not supported with manifest')
+
+        pruner = self._pruner(fsdir)
+        start = time.perf_counter_ns()
+        try:
+            return self._confirm(fsdir, jobs, processes, manifest, pruner,
+                                 stats, entry_filter)
+        finally:
+            self._count_pruned(pruner)
+            if stats is not None:
+                stats.wall_ns += time.perf_counter_ns() - start
+
+    def _confirm(self, fsdir, jobs, processes, manifest, pruner, stats,
+                 entry_filter):
+        uid_ranges, gid_ranges = self.host_ranges()
+        nobody = self.nobody
+        lstat = self.lstat
+        if manifest is not None:
+            from idmapshift import manifest as manifest_module
+            return manifest_module.confirm_dir_manifest(
+                fsdir, self.uid_mappings, self.gid_mappings, nobody,
+                uid_ranges, gid_ranges, manifest, prune=pruner)
+        if jobs > 1:
+            from idmapshift import parallel
+            return parallel.confirm_dir_threads(fsdir, uid_ranges,
+                                                gid_ranges, nobody, jobs,
+                                                prune=pruner, lstat=lstat)
+        if processes > 1:
+            from idmapshift import parallel
+            return parallel.confirm_dir_processes(fsdir, uid_ranges,
+                                                  gid_ranges, nobody,
+                                                  processes, prune=pruner,
+                                                  lstat=lstat)
+        for path, stat in iter_tree(fsdir, stats, pruner, lstat):
+            if not self._confirm_entry(path, stat, stats, entry_filter):
                 return False
-    return True
+        return True
+
+    def _confirm_entry(self, path, stat, stats, entry_filter):
+        """Confirm one entry of a walk; entry_filter's rejects pass."""
+        if entry_filter is not None and not entry_filter(path, stat):
+            return True
+        if stats is not None:
+            stats.entries += 1
+        uid_ranges, gid_ranges = self.host_ranges()
+        return confirm_path(path, uid_ranges, gid_ranges, self.nobody,
+                            stat=stat)
+
+    def _shifted_already(self, fsdir, jobs, processes, manifest, result):
+        """Return True if an idempotent shift of fsdir has nothing to do.
+
+        This is a confirm with the engine the shift would use. It stops
+        at the first entry out of range, usually the root of a tree that
+        was never shifted, and on a tree that was already shifted it
+        walks the tree instead of the shift. As for confirm, only the
+        serial walk counts into stats and applies entry_filter, so a
+        filtered shift confirms serially; the manifest walk checks every
+        entry, which can only make it shift when it need not.
+        """
+        if self.entry_filter is not None and manifest is None:
+            jobs = processes = 1
+        serial = jobs <= 1 and processes <= 1 and manifest is None
+        stats = self.stats if serial else None
+        entry_filter = self.entry_filter if serial else None
+        pruner = self._pruner(fsdir)
+        confirmed = self._confirm(fsdir, jobs, processes, manifest, pruner,
+                                  stats, entry_filter)
+        if confirmed:
+            self._count_pruned(pruner, result)
+        return confirmed
+
+    def confirm_sample(self, fsdir, size, confidence=0.95, stop_early=True,
+                       rng=None):
+        """Check a random sample of about size entries under fsdir.
+
+        A fast, probabilistic stand-in for confirm: directories are
+        listed in random order and a random subset of each one's entries
+        is checked, stopping at the first entry out of range unless
+        stop_early is False. Returns an idmapshift.sample.SampleResult,
+        which estimates the fraction of the tree out of range and bounds
+        it with confidence; see there. rng is a random.Random.
+        """
+        from idmapshift import sample
+
+        uid_ranges, gid_ranges = self.host_ranges()
+        stats = self.stats
+        pruner = self._pruner(fsdir)
+        start = time.perf_counter_ns()
+        try:
+            result = sample.confirm_sample(
+                fsdir, uid_ranges, gid_ranges, self.nobody, size,
+                confidence=confidence, stop_early=stop_early, stats=stats,
+                prune=pruner, lstat=self.lstat,
+                entry_filter=self.entry_filter, rng=rng)
+        finally:
+            if stats is not None:
+                stats.wall_ns += time.perf_counter_ns() - start
+        self._count_pruned(pruner, result)
+        return result
@@ -0,0 +1,204 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asyncio counterparts of IdMapShifter.shift and confirm.
+
+The walk runs in an executor a batch of entries at a time, so the event
+loop is never blocked and many trees can be shifted at once with
+asyncio.gather. Between batches the coroutine reports progress. When it
+is cancelled, the batch that is running stops at its next entry and the
+CancelledError is raised once it has.
+"""
+
+import asyncio
+import itertools
+import threading
+import time
+
+import idmapshift
+
+# Entries handled per trip to the executor.
+BATCH_SIZE = 4096
+
+
+class Progress(object):
+    """A progress event for one tree.
+
+    visited is the number of entries handled so far and done is True on
+    the last event. result is the running ShiftResult of a shift, and None
+    for a confirm.
+    """
+
+    def __init__(self, fsdir, visited, done, result=None):
+        self.fsdir = fsdir
+        self.visited = visited
+        self.done = done
+        self.result = result
+
+
+async def _walk(fsdir, handle, executor, progress, batch_size, stats=None,
+                result=None, prune=None, lstat=None):
+    """Feed iter_tree(fsdir, stats, prune, lstat) to handle in batches.
+
+    handle(path, stat) returns False to end the walk early. Returns False
+    if it did.
+    """
+    loop = asyncio.get_running_loop()
+    entries = idmapshift.iter_tree(fsdir, stats, prune, lstat)
+    stop = threading.Event()
+    counts = {'visited': 0}
+
+    def step():
+        handled = 0
+        for path, stat in itertools.islice(entries, batch_size):
+            if stop.is_set():
+                break
+            handled += 1
+            if not handle(path, stat):
+                counts['visited'] += handled
+                return None
+        counts['visited'] += handled
+        return handled == batch_size
+
+    more = True
+    while more:
+        batch = loop.run_in_executor(executor, step)
+        try:
+            more = await asyncio.shield(batch)
+        except asyncio.CancelledError:
+            # Let the running batch see the flag and finish, so nothing
+            # is touched once the cancelled coroutine has returned.
+            stop.set()
+            await asyncio.wait([batch])
+            raise
+        if progress is not None:
+            progress(Progress(fsdir, counts['visited'], not more, result))
+    return more is not None
+
+
+async def _confirm_walk(shifter, fsdir, pruner, executor, progress,
+                        batch_size):
+    stats = shifter.stats
+    entry_filter = shifter.entry_filter
+
+    def handle(path, stat):
+        return shifter._confirm_entry(path, stat, stats, entry_filter)
+
+    return await _walk(fsdir, handle, executor, progress, batch_size,
+                       stats=stats, prune=pruner, lstat=shifter.lstat)
+
+
+async def shift_async(shifter, fsdir, dry_run=False, verbose=False,
+                      idempotent=False, printer=None, executor=None,
+                      progress=None, batch_size=BATCH_SIZE):
+    """Shift fsdir with shifter, an IdMapShifter, off the event loop.
+
+    Entries are shifted as by shifter.shift's serial walk, with its
+    memos, hooks, excludes, statx and stats, batch_size at a time in
+    executor; None means the loop's default executor, which is bounded.
+    After every batch progress, if given, is called on the loop with a
+    Progress event. Cancelling the coroutine stops the walk at the next
+    entry. With idempotent, the tree is first confirmed the same way and
+    left alone if it confirms, as by shift. The other options are as
+    for shift. Returns a ShiftResult.
+    """
+    start = time.perf_counter_ns()
+    stats = shifter.stats
+    result = idmapshift.ShiftResult()
+    skip_ranges = None
+    if idempotent:
+        pruner = shifter._pruner(fsdir)
+        if await _confirm_walk(shifter, fsdir, pruner, executor, None,
+                               batch_size):
+            shifter._count_pruned(pruner, result)
+            if stats is not None:
+                stats.wall_ns += time.perf_counter_ns() - start
+            return result
+        skip_ranges = (shifter.uid_mappings, shifter.gid_mappings)
+    kwargs = shifter._shift_kwargs(result, dry_run, verbose, skip_ranges,
+                                   printer)
+
+    def handle(path, stat):
+        shifter._shift_entry(path, stat, kwargs)
+        return True
+
+    pruner = shifter._pruner(fsdir)
+    try:
+        await _walk(fsdir, handle, executor, progress, batch_size,
+                    stats=stats, result=result, prune=pruner,
+                    lstat=shifter.lstat)
+    finally:
+        shifter._count_pruned(pruner, result)
+    if stats is not None:
+        stats.wall_ns += time.perf_counter_ns() - start
+    return result
+
+
+async def confirm_async(shifter, fsdir, executor=None, progress=None,
+                        batch_size=BATCH_SIZE):
+    """Confirm fsdir with shifter, an IdMapShifter, off the event loop.
+
+    The walk is run as in shift_async, as shifter.confirm's serial walk,
+    and stops at the first entry outside the ranges. Returns True if
+    everything is in range.
+    """
+    start = time.perf_counter_ns()
+    pruner = shifter._pruner(fsdir)
+    try:
+        return await _confirm_walk(shifter, fsdir, pruner, executor,
+                                   progress, batch_size)
+    finally:
+        shifter._count_pruned(pruner)
+        if shifter.stats is not None:
+            shifter.stats.wall_ns += time.perf_counter_ns() - start
+
+
+async def shift_dir_async(fsdir, uid_mappings, gid_mappings, nobody,
+                          dry_run=False, verbose=False, idempotent=False,
+                          stats=None, printer=None, executor=None,
+                          progress=None, batch_size=BATCH_SIZE,
+                          excludes=None, one_file_system=False,
+                          statx=False, dont_sync=False, xattrs=False):
+    """Shift fsdir like shift_dir, without blocking the event loop.
+
+    A wrapper around shift_async with an IdMapShifter built from the
+    maps and options, as shift_dir builds one. Returns a ShiftResult.
+    """
+    shifter = idmapshift.IdMapShifter(uid_mappings, gid_mappings, nobody,
+                                      stats=stats, excludes=excludes,
+                                      one_file_system=one_file_system,
+                                      statx=statx, dont_sync=dont_sync,
+                                      xattrs=xattrs)
+    return await shift_async(shifter, fsdir, dry_run=dry_run,
+                             verbose=verbose, idempotent=idempotent,
+                             printer=printer, executor=executor,
+                             progress=progress, batch_size=batch_size)
+
+
+async def confirm_dir_async(fsdir, uid_mappings, gid_mappings, nobody,
+                            executor=None, progress=None,
+                            batch_size=BATCH_SIZE, excludes=None,
+                            one_file_system=False, stats=None, statx=False,
+                            dont_sync=False):
+    """Confirm fsdir like confirm_dir, without blocking the event loop.
+
+    A wrapper around confirm_async, as shift_dir_async is around
+    shift_async. Returns True if everything is in range.
+    """
+    shifter = idmapshift.IdMapShifter(uid_mappings, gid_mappings, nobody,
+                                      stats=stats, excludes=excludes,
+                                      one_file_system=one_file_system,
+                                      statx=statx, dont_sync=dont_sync)
+    return await confirm_async(shifter, fsdir, executor=executor,
+                               progress=progress, batch_size=batch_size)
@@ -0,0 +1,229 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shift many trees in one run.
+
+A batch spec is a JSON list of trees, each an object with a path, uid
+and gid maps (in -u/-g syntax, or as lists of [guest, host, count]) and
+an optional nobody, exclude list and one_file_system flag (see
+idmapshift.prune):
+
+    [{"path": "/var/lib/c1/rootfs", "uid": "0:100000:65536",
+      "gid": "0:100000:65536"},
+     {"path": "/var/lib/c2/rootfs", "uid": [[0, 200000, 65536]],
+      "gid": [[0, 200000, 65536]], "nobody": 65534,
+      "exclude": ["var/cache"], "one_file_system": true}]
+"""
+
+import argparse
+import collections
+from concurrent import futures
+import json
+import os
+
+import idmapshift
+from idmapshift import main
+from idmapshift import parallel
+from idmapshift import prune
+
+
+class MapCache(object):
+    """Compiled IdMaps and memos shared by trees with the same maps.
+
+    find_target_id always stores the same value for an id under a given
+    map and nobody, so one memo can serve every tree that uses them.
+    """
+
+    def __init__(self):
+        self._maps = {}
+        self._memos = {}
+
+    def id_map(self, mappings):
+        key = tuple(tuple(m) for m in mappings)
+        if key not in self._maps:
+            self._maps[key] = idmapshift.IdMap(mappings)
+        return self._maps[key]
+
+    def memo(self, id_map, nobody):
+        return self._memos.setdefault((tuple(id_map), nobody), dict())
+
+
+class Tree(object):
+    """One tree of a batch, with its compiled maps, memos and result.
+
+    error holds the exception that stopped the tree, if any. excludes and
+    one_file_system prune the tree's walk as for IdMapShifter.
+    """
+
+    def __init__(self, path, uid_mappings, gid_mappings, nobody, cache,
+                 excludes=None, one_file_system=False):
+        self.path = path
+        self.nobody = nobody
+        self.uid_mappings = cache.id_map(uid_mappings)
+        self.gid_mappings = cache.id_map(gid_mappings)
+        self.uid_memo = cache.memo(self.uid_mappings, nobody)
+        self.gid_memo = cache.memo(self.gid_mappings, nobody)
+        self.excludes = tuple(excludes or ())
+        self.one_file_system = one_file_system
+        prune.compile_excludes(self.excludes)
+        self.prune = None
+        self.result = idmapshift.ShiftResult()
+        self.error = None
+        self.pending = []
+
+
+def _parse_maps(value):
+    if isinstance(value, str):
+        try:
+            return main.id_map_type(value)
+        except argparse.ArgumentTypeError as e:
+            raise ValueError(str(e))
+    return [tuple(m) for m in value]
+
+
+def load_spec(path, cache=None, excludes=None, one_file_system=False):
+    """Read a batch spec file and return its Trees.
+
+    excludes are added to every tree's own, and one_file_system applies to
+    every tree when set.
+    """
+    if cache is None:
+        cache = MapCache()
+    with open(path) as f:
+        spec = json.load(f)
+    if not isinstance(spec, list):
+        raise ValueError('Batch spec %s must be a list of trees' % path)
+    trees = []
+    for i, entry in enumerate(spec):
+        if not isinstance(entry, dict):
+            raise ValueError('Invalid tree %d in batch spec %s: not an '
+                             'object' % (i, path))
+        try:
+            tree_excludes = entry.get('exclude', [])
+            if isinstance(tree_excludes, str):
+                tree_excludes = [tree_excludes]
+            tree_excludes = list(tree_excludes) + list(excludes or ())
+            tree_one_fs = bool(entry.get('one_file_system', False))
+            trees.append(Tree(entry['path'], _parse_maps(entry['uid']),
+                              _parse_maps(entry['gid']),
+                              entry.get('nobody', main.NOBODY_ID), cache,
+                              excludes=tree_excludes,
+                              one_file_system=one_file_system or tree_one_fs))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError('Invalid tree %d in batch spec %s: %s' %
+                             (i, path, e))
+    return trees
+
+
+def shift_trees(trees, jobs=1, dry_run=False, idempotent=False,
+                stats=None, xattrs=False, statx=False, dont_sync=False):
+    """Shift every tree with one pool of jobs threads.
+
+    As in shift_dir_threads, each directory listing is a task, run by
+    idmapshift.parallel.shift_listing, but the pool is shared by all the
+    trees and at most two tasks per thread are queued at a time, taken
+    from the trees round robin. A small tree therefore finishes in step
+    with its share of the pool rather than after every directory of a
+    huge one. Hard links are tracked across the whole batch. A tree that
+    fails, say because its path is missing, keeps its exception in
+    Tree.error and the rest carry on. xattrs is
+    passed to shift_path, and statx and dont_sync are as for
+    IdMapShifter. With idempotent, a tree that already confirms is left
+    alone, as by IdMapShifter.shift. Returns trees.
+    """
+    if dont_sync and not statx:
+        raise ValueError('dont_sync requires statx')
+    lstat = None
+    if statx:
+        from idmapshift import statx as statx_module
+        lstat = statx_module.Lstat(dont_sync)
+    hardlinks = idmapshift.InodeSet()
+
+    def shifted_already(tree, result, root_stats):
+        shifter = idmapshift.IdMapShifter(
+            tree.uid_mappings, tree.gid_mappings, tree.nobody,
+            stats=root_stats, excludes=tree.excludes,
+            one_file_system=tree.one_file_system, statx=statx,
+            dont_sync=dont_sync)
+        return shifter._shifted_already(tree.path, 1, 1, None, result)
+
+    def shift_listing(tree, dirpath):
+        skip_ranges = None
+        if idempotent:
+            skip_ranges = (tree.uid_mappings, tree.gid_mappings)
+        kwargs = dict(uid_memo=tree.uid_memo, gid_memo=tree.gid_memo,
+                      dry_run=dry_run, skip_ranges=skip_ranges,
+                      hardlinks=hardlinks, xattrs=xattrs)
+        if dirpath is not None:
+            return parallel.shift_listing(dirpath, tree.uid_mappings,
+                                          tree.gid_mappings, tree.nobody,
+                                          stats=stats, prune=tree.prune,
+                                          lstat=lstat, **kwargs)
+        result = idmapshift.ShiftResult()
+        root_stats = stats.spawn() if stats is not None else None
+        if idempotent and shifted_already(tree, result, root_stats):
+            return result, root_stats, []
+        idmapshift.shift_path(tree.path, tree.uid_mappings,
+                              tree.gid_mappings, tree.nobody,
+                              stat=(lstat or os.lstat)(tree.path),
+                              result=result, stats=root_stats, **kwargs)
+        if tree.excludes or tree.one_file_system:
+            tree.prune = prune.Pruner(tree.path, tree.excludes,
+                                      tree.one_file_system)
+        listing, listing_stats, subdirs = parallel.shift_listing(
+            tree.path, tree.uid_mappings, tree.gid_mappings, tree.nobody,
+            stats=stats, prune=tree.prune, lstat=lstat, **kwargs)
+        result.merge(listing)
+        if stats is not None:
+            root_stats.merge(listing_stats)
+        return result, root_stats, subdirs
+
+    for tree in trees:
+        tree.pending = [None]
+    ready = collections.deque(trees)
+    slots = max(1, jobs) * 2
+    running = {}
+    with futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        while ready or running:
+            while ready and len(running) < slots:
+                tree = ready.popleft()
+                if not tree.pending:
+                    continue
+                running[executor.submit(shift_listing, tree,
+                                        tree.pending.pop())] = tree
+                if tree.pending:
+                    ready.append(tree)
+            done, _ = futures.wait(running,
+                                   return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                tree = running.pop(future)
+                try:
+                    result, listing_stats, subdirs = future.result()
+                except Exception as e:
+                    tree.error = e
+                    tree.pending = []
+                    continue
+                tree.result.merge(result)
+                if stats is not None:
+                    stats.merge(listing_stats)
+                if subdirs and not tree.pending and tree.error is None:
+                    ready.append(tree)
+                if tree.error is None:
+                    tree.pending.extend(reversed(subdirs))
+    for tree in trees:
+        if tree.prune is not None:
+            tree.result.pruned += tree.prune.pruned
+            if stats is not None:
+                stats.pruned += tree.prune.pruned
+    return trees
@@ -0,0 +1,314 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Throughput benchmarks on generated trees.
+
+    python -m idmapshift.bench --size 100000 --output before.json
+    python -m idmapshift.bench --size 100000 --compare before.json
+
+Each tree shape is generated under --dir, /dev/shm by default so the
+numbers measure idmapshift rather than the disk, and every engine is
+timed shifting it, dry-running the shift and confirming it. Real shifts
+need to be able to chown, so they only run as root, which includes root
+in a user namespace whose map covers --uid/--gid; otherwise only the
+dry-run and confirm operations are timed. Results are written as JSON
+so runs from different commits can be compared.
+
+The statx engines walk serially like serial but stat with statx; see
+idmapshift.statx. On a local filesystem the ctypes call makes them
+slower than lstat; pointing --dir at an NFS or CephFS mount shows the
+attribute round trips they save:
+
+    python -m idmapshift.bench --dir /mnt/nfs \
+        --engines serial,statx,statx-dont-sync
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import idmapshift
+from idmapshift import main as idmapshift_main
+
+SHAPES = ('wide', 'deep', 'hardlinks', 'symlinks', 'mixed')
+ENGINES = {'serial': {}, 'fd': {'fd_relative': True},
+           'threads': {'jobs': 4}, 'processes': {'processes': 4},
+           'statx': {'statx': True},
+           'statx-dont-sync': {'statx': True, 'dont_sync': True}}
+OPS = ('shift', 'dry-run', 'confirm')
+
+# Directories per chain in the deep shape, kept well inside PATH_MAX and
+# the recursion limit of shutil.rmtree.
+CHAIN_DEPTH = 200
+
+# Guest ids given to generated entries; some fall outside the default
+# maps on purpose, so lookups that end in nobody are exercised too.
+GUEST_IDS = list(range(0, 1000, 7)) + [5000, 65533]
+
+
+def can_chown():
+    return os.geteuid() == 0
+
+
+def _own(path, rng):
+    if can_chown():
+        os.lchown(path, rng.choice(GUEST_IDS), rng.choice(GUEST_IDS))
+
+
+def generate_tree(root, shape, size, seed=0):
+    """Create a tree of about size entries under root. Returns its count.
+
+    wide is one flat directory, deep chains of CHAIN_DEPTH directories
+    with a file in each, hardlinks a farm of files with four links apiece
+    spread over a few directories, symlinks a mix of files and relative
+    and dangling links, and mixed a random tree of directories, files
+    and links. When running as root entries get random guest ownership.
+    """
+    rng = random.Random(seed)
+    os.makedirs(root)
+    _own(root, rng)
+    count = 1
+
+    def make_file(path):
+        with open(path, 'w'):
+            pass
+        _own(path, rng)
+
+    if shape == 'wide':
+        for i in range(size - 1):
+            make_file(os.path.join(root, 'f%d' % i))
+        return size
+    if shape == 'deep':
+        depth = CHAIN_DEPTH
+        while count < size:
+            if depth == CHAIN_DEPTH:
+                path = os.path.join(root, 'c%d' % count)
+                depth = 0
+            else:
+                path = os.path.join(path, 'd')
+            os.mkdir(path)
+            _own(path, rng)
+            make_file(os.path.join(path, 'f'))
+            depth += 1
+            count += 2
+        return count
+    if shape == 'hardlinks':
+        dirs = []
+        for i in range(4):
+            dirs.append(os.path.join(root, 'd%d' % i))
+            os.mkdir(dirs[-1])
+            _own(dirs[-1], rng)
+        count += len(dirs)
+        i = 0
+        while count < size:
+            first = os.path.join(dirs[0], 'f%d' % i)
+            make_file(first)
+            for other in dirs[1:]:
+                os.link(first, os.path.join(other, 'f%d' % i))
+            count += len(dirs)
+            i += 1
+        return count
+    if shape == 'symlinks':
+        i = 0
+        while count < size:
+            make_file(os.path.join(root, 'f%d' % i))
+            link = os.path.join(root, 'l%d' % i)
+            os.symlink('f%d' % i if i % 2 else 'missing%d' % i, link)
+            _own(link, rng)
+            count += 2
+            i += 1
+        return count
+    if shape == 'mixed':
+        dirs = [root]
+        while count < size:
+            parent = rng.choice(dirs)
+            path = os.path.join(parent, 'e%d' % count)
+            kind = rng.random()
+            if kind < 0.1:
+                os.mkdir(path)
+                dirs.append(path)
+                _own(path, rng)
+            elif kind < 0.2:
+                os.symlink(os.path.basename(parent), path)
+                _own(path, rng)
+            else:
+                make_file(path)
+            count += 1
+        return count
+    raise ValueError('unknown tree shape %r' % shape)
+
+
+def time_op(tree, op, engine, uid_mappings, gid_mappings, nobody):
+    kwargs = dict(ENGINES[engine])
+    start = time.perf_counter()
+    if op == 'confirm':
+        kwargs.pop('fd_relative', None)
+        idmapshift.confirm_dir(tree, uid_mappings, gid_mappings, nobody,
+                               **kwargs)
+    else:
+        idmapshift.shift_dir(tree, uid_mappings, gid_mappings, nobody,
+                             dry_run=op == 'dry-run', **kwargs)
+    return time.perf_counter() - start
+
+
+def run_benchmarks(workdir, shapes=SHAPES, size=10000, engines=ENGINES,
+                   ops=OPS, repeat=3, uid_mappings=((0, 10000, 2000),),
+                   gid_mappings=((0, 10000, 2000),),
+                   nobody=idmapshift_main.NOBODY_ID, seed=0):
+    """Time every op on every engine and shape. Returns result dicts.
+
+    Each result holds the best of repeat runs. Shifts and dry runs are
+    timed on a freshly generated tree, regenerated after every real
+    shift, and confirms on a shifted one so the whole tree is walked.
+    Without the right to chown, shifts are skipped and confirms check
+    the tree against maps onto the caller's own ids instead. Generating
+    and preparing trees is not timed.
+    """
+    if can_chown():
+        confirm_maps = (uid_mappings, gid_mappings)
+    else:
+        confirm_maps = ([(0, os.geteuid(), 1)], [(0, os.getegid(), 1)])
+    results = []
+    for shape in shapes:
+        tree = os.path.join(workdir, shape)
+        entries = generate_tree(tree, shape, size, seed)
+        state = ['fresh']
+
+        def prepare(wanted):
+            if state[0] == wanted:
+                return
+            if state[0] != 'fresh':
+                shutil.rmtree(tree)
+                generate_tree(tree, shape, size, seed)
+            if wanted == 'shifted':
+                idmapshift.shift_dir(tree, uid_mappings, gid_mappings,
+                                     nobody)
+            state[0] = wanted
+
+        for op in ops:
+            if op == 'shift' and not can_chown():
+                continue
+            for engine in engines:
+                if op == 'confirm' and engine == 'fd':
+                    # confirm_dir has no fd-relative walk.
+                    continue
+                times = []
+                for i in range(repeat):
+                    if op == 'confirm':
+                        prepare('shifted' if can_chown() else 'fresh')
+                        times.append(time_op(tree, op, engine,
+                                             confirm_maps[0],
+                                             confirm_maps[1], nobody))
+                        continue
+                    prepare('fresh')
+                    times.append(time_op(tree, op, engine, uid_mappings,
+                                         gid_mappings, nobody))
+                    if op == 'shift':
+                        state[0] = 'dirty'
+                best = min(times)
+                results.append({'shape': shape, 'op': op, 'engine': engine,
+                                'entries': entries, 'seconds': best,
+                                'entries_per_sec': entries / best})
+        shutil.rmtree(tree)
+    return results
+
+
+def compare(old, new):
+    """Return lines comparing two result lists by entries_per_sec."""
+    def key(result):
+        return result['shape'], result['op'], result['engine']
+
+    before = dict((key(result), result) for result in old)
+    lines = []
+    for result in new:
+        if key(result) not in before:
+            continue
+        was = before[key(result)]['entries_per_sec']
+        now = result['entries_per_sec']
+        lines.append('%-10s %-8s %-15s %12.0f -> %12.0f /s  %+6.1f%%' % (
+            key(result) + (was, now, (now - was) * 100.0 / was)))
+    return lines
+
+
+def _split(value, choices):
+    values = value.split(',')
+    for value in values:
+        if value not in choices:
+            raise argparse.ArgumentTypeError(
+                '%s is not one of %s' % (value, ', '.join(choices)))
+    return values
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser('idmapshift benchmarks')
+    default_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    parser.add_argument('--dir', default=default_dir,
+                        help='Where to generate trees, ideally a tmpfs')
+    parser.add_argument('--size', default=10000, type=int,
+                        help='Entries per tree')
+    parser.add_argument('--shapes', default=list(SHAPES),
+                        type=lambda v: _split(v, SHAPES))
+    parser.add_argument('--engines', default=list(ENGINES),
+                        type=lambda v: _split(v, ENGINES))
+    parser.add_argument('--ops', default=list(OPS),
+                        type=lambda v: _split(v, OPS))
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('-u', '--uid', type=idmapshift_main.id_map_type,
+                        default=[(0, 10000, 2000)])
+    parser.add_argument('-g', '--gid', type=idmapshift_main.id_map_type,
+                        default=[(0, 10000, 2000)])
+    parser.add_argument('--label', default=None,
+                        help='Recorded with the results, e.g. a commit')
+    parser.add_argument('--output', default=None,
+                        help='Write results to this JSON file')
+    parser.add_argument('--compare', default=None,
+                        help='Compare with results from an earlier run')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='idmapshift-bench-', dir=args.dir)
+    try:
+        results = run_benchmarks(workdir, args.shapes, args.size,
+                                 args.engines, args.ops, args.repeat,
+                                 args.uid, args.gid, seed=args.seed)
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {'label': args.label, 'size': args.size, 'seed': args.seed,
+              'python': platform.python_version(),
+              'platform': platform.platform(), 'can_chown': can_chown(),
+              'time': time.time(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+        lines = compare(old, results)
+    else:
+        lines = ['%-10s %-8s %-15s %12.0f /s' % (
+            r['shape'], r['op'], r['engine'], r['entries_per_sec'])
+            for r in results]
+    sys.stdout.write(''.join(line + '\n' for line in lines))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _find_overlap(ranges):
+    """Return the first pair of overlapping (start, count) ranges, if any.
+
+    ranges must be sorted by start.
+    """
+    for prev, cur in zip(ranges, ranges[1:]):
+        if prev[0] + prev[1] > cur[0]:
+            return prev, cur
+    return None
+
+
+class IdMap(object):
+    """A validated, sorted set of guest-id:host-id:count mappings.
+
+    Built once from the (guest, host, count) tuples that main.id_map_type
+    produces. Like the kernel's uid_map, ranges may not overlap on either
+    the guest or the host side, and a ValueError is raised if they do.
+    Lookups in both directions are binary searches over the sorted ranges.
+    Iterating an IdMap yields its (guest, host, count) tuples in guest id
+    order, so it can be used anywhere a list of mappings is expected.
+    """
+
+    def __init__(self, mappings):
+        ranges = sorted(tuple(m) for m in mappings)
+        for start, target, count in ranges:
+            if start < 0 or target < 0 or count < 1:
+                raise ValueError('Invalid id map %s:%s:%s'
+                                 % (start, target, count))
+
+        overlap = _find_overlap([(s, c) for s, t, c in ranges])
+        if overlap:
+            raise ValueError('Guest id ranges %s+%s and %s+%s overlap'
+                             % (overlap[0] + overlap[1]))
+        host = sorted((t, c, s) for s, t, c in ranges)
+        overlap = _find_overlap([(t, c) for t, c, s in host])
+        if overlap:
+            raise ValueError('Host id ranges %s+%s and %s+%s overlap'
+                             % (overlap[0] + overlap[1]))
+
+        self._ranges = ranges
+        self._starts = [s for s, t, c in ranges]
+        self._host = host
+        self._host_starts = [t for t, c, s in host]
+        self._table = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_table'] = None
+        return state
+
+    def __iter__(self):
+        return iter(self._ranges)
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def __eq__(self, other):
+        return isinstance(other, IdMap) and self._ranges == other._ranges
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'IdMap(%r)' % (self._ranges,)
+
+    def lookup(self, guest_id, default=None):
+        """Return the host id guest_id maps to, or default."""
+        i = bisect.bisect_right(self._starts, guest_id) - 1
+        if i >= 0:
+            start, target, count = self._ranges[i]
+            if guest_id < start + count:
+                return guest_id - start + target
+        return default
+
+    def lookup_many(self, guest_ids, default):
+        """Map a batch of guest ids to host ids, using default for misses.
+
+        With NumPy installed this is a single vectorized searchsorted over
+        the range starts; without it, each id goes through lookup. Returns
+        an int64 ndarray if guest_ids is an ndarray, otherwise a list.
+        """
+        if numpy is None:
+            return [self.lookup(i, default) for i in guest_ids]
+
+        ids = numpy.asarray(guest_ids, dtype=numpy.int64)
+        if not self._ranges:
+            mapped = numpy.full(ids.shape, default, dtype=numpy.int64)
+        else:
+            if self._table is None:
+                self._table = numpy.array(self._ranges,
+                                          dtype=numpy.int64).T
+            starts, targets, counts = self._table
+            index = numpy.searchsorted(starts, ids, side='right') - 1
+            found = index >= 0
+            index[~found] = 0
+            offsets = ids - starts[index]
+            found &= offsets < counts[index]
+            mapped = numpy.where(found, targets[index] + offsets, default)
+        if isinstance(guest_ids, numpy.ndarray):
+            return mapped
+        return mapped.tolist()
+
+    def reverse_lookup(self, host_id, default=None):
+        """Return the guest id that maps to host_id, or default."""
+        i = bisect.bisect_right(self._host_starts, host_id) - 1
+        if i >= 0:
+            target, count, start = self._host[i]
+            if host_id < target + count:
+                return host_id - target + start
+        return default
+
+    def contains_host(self, host_id):
+        """Return True if some guest id maps to host_id."""
+        return self.reverse_lookup(host_id) is not None
+
+
+def compose_maps(src, dst):
+    """Compose two id maps into one host-to-host map.
+
+    src and dst both map the same guest ids to host ids. The result maps
+    each host id that src gives a guest id to the host id dst gives that
+    guest, so ownership can be moved from src's allocation to dst's in a
+    single pass. Host ids whose guest id dst does not map are left out,
+    and so fall back to nobody like any other unmapped id.
+    """
+    src = sorted(IdMap(src))
+    dst = sorted(IdMap(dst))
+    composed = []
+    i = j = 0
+    while i < len(src) and j < len(dst):
+        src_start, src_target, src_count = src[i]
+        dst_start, dst_target, dst_count = dst[j]
+        low = max(src_start, dst_start)
+        high = min(src_start + src_count, dst_start + dst_count)
+        if low < high:
+            composed.append((low - src_start + src_target,
+                             low - dst_start + dst_target, high - low))
+        if src_start + src_count < dst_start + dst_count:
+            i += 1
+        else:
+            j += 1
+    return IdMap(composed)
+
+
+class HostIdSet(object):
+    """A set of allowed host ids with O(1) membership tests.
+
+    Built from inclusive (first, last) ranges, such as get_ranges returns,
+    plus any extra single ids (confirm_dir adds nobody). The extra ids are
+    kept in a set of their own, so a far-off nobody does not widen the
+    ranges. A single merged range is checked against its bounds; several
+    are kept as a bitmap over [lowest, highest], one bit per id, so a
+    typical 65536-id allocation costs 8KiB. If that span is wider than
+    MAX_SPAN ids the bitmap would be too large, so membership falls back
+    to a binary search over the merged ranges.
+    """
+
+    MAX_SPAN = 1 << 27
+
+    def __init__(self, ranges, extra=()):
+        merged = []
+        for first, last in sorted(ranges):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        self._ranges = [tuple(r) for r in merged]
+        self._firsts = [first for first, last in self._ranges]
+        self._bits = None
+        self._low = 0
+        self._high = -1
+        if len(self._ranges) == 1:
+            self._low, self._high = self._ranges[0]
+        elif self._ranges:
+            self._low = self._ranges[0][0]
+            span = self._ranges[-1][1] - self._low + 1
+            if span <= self.MAX_SPAN:
+                self._bits = bytearray((span + 7) // 8)
+                for first, last in self._ranges:
+                    self._set_bits(first - self._low, last - self._low)
+        self._extra = frozenset(i for i in extra
+                                if not self._in_ranges(i))
+
+    def _set_bits(self, first, last):
+        while first <= last and first % 8:
+            self._bits[first >> 3] |= 1 << (first & 7)
+            first += 1
+        while first <= last and (last + 1) % 8:
+            self._bits[last >> 3] |= 1 << (last & 7)
+            last -= 1
+        if first <= last:
+            self._bits[first >> 3:(last >> 3) + 1] = (
+                b'\xff' * ((last - first + 1) >> 3))
+
+    def __contains__(self, host_id):
+        if host_id in self._extra:
+            return True
+        return self._in_ranges(host_id)
+
+    def _in_ranges(self, host_id):
+        if self._bits is not None:
+            offset = host_id - self._low
+            if offset < 0 or offset >= len(self._bits) << 3:
+                return False
+            return bool(self._bits[offset >> 3] & (1 << (offset & 7)))
+        if len(self._ranges) <= 1:
+            return self._low <= host_id <= self._high
+        i = bisect.bisect_right(self._firsts, host_id) - 1
+        return i >= 0 and host_id <= self._ranges[i][1]
+
+    def __eq__(self, other):
+        if not isinstance(other, HostIdSet):
+            return False
+        if self._ranges != other._ranges:
+            return False
+        return self._extra == other._extra
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'HostIdSet(%r, %r)' % (self._ranges, sorted(self._extra))
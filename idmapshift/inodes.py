@@ -0,0 +1,72 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import bisect
+import threading
+
+
+def _merge(inodes, new):
+    """Return a sorted array('Q') of inodes with the sorted list new.
+
+    Runs of inodes between insertion points are copied as array slices,
+    so the merge never holds more than the old and new arrays, 8 bytes
+    an inode, rather than a Python int for every element.
+    """
+    merged = array.array('Q')
+    lo = 0
+    for ino in new:
+        i = bisect.bisect_left(inodes, ino, lo)
+        merged.extend(inodes[lo:i])
+        merged.append(ino)
+        lo = i
+    merged.extend(inodes[lo:])
+    return merged
+
+
+class InodeSet(object):
+    """A compact, thread-safe set of (st_dev, st_ino) pairs.
+
+    Inode numbers are kept per device in a sorted array of unsigned 64-bit
+    ints, 8 bytes each, instead of a set of tuples. New inodes go into a
+    small set first, which is merged into the array once it grows past an
+    eighth of the array, so inserts stay amortized O(log n) and the
+    Python-object overhead is bounded to that fraction.
+    """
+
+    MIN_MERGE = 1024
+
+    def __init__(self):
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def add(self, dev, ino):
+        """Add (dev, ino) and return True if it was not already present."""
+        with self._lock:
+            inodes, recent = self._devices.setdefault(
+                dev, (array.array('Q'), set()))
+            if ino in recent:
+                return False
+            i = bisect.bisect_left(inodes, ino)
+            if i < len(inodes) and inodes[i] == ino:
+                return False
+            recent.add(ino)
+            if len(recent) > max(self.MIN_MERGE, len(inodes) >> 3):
+                inodes[:] = _merge(inodes, sorted(recent))
+                recent.clear()
+            return True
+
+    def __len__(self):
+        return sum(len(inodes) + len(recent)
+                   for inodes, recent in self._devices.values())
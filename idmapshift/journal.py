@@ -0,0 +1,241 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import stat as stat_module
+import time
+
+import idmapshift
+
+MAGIC = b'idmapshift-journal 2 '
+LISTED = b'L'
+FINISHED = b'S'
+NOBODY = b'N'
+CHUNK = 1024
+
+
+def fingerprint(fsdir, uid_mappings, gid_mappings, nobody, prune=None):
+    """Identify a shift, so a journal is only resumed by the same one."""
+    key = repr((os.path.abspath(fsdir), list(uid_mappings),
+                list(gid_mappings), nobody))
+    if prune is not None:
+        key += repr(prune.key())
+    return hashlib.sha1(key.encode('utf-8')).hexdigest().encode('ascii')
+
+
+class JournalMismatch(ValueError):
+    """Raised when a journal is resumed by a shift it does not belong to."""
+
+
+class Journal(object):
+    """An append-only record of the directories a shift has finished.
+
+    The file is a header line holding the shift's fingerprint followed by
+    NUL-terminated records: L<relpath> once every entry of a directory has
+    been shifted and S<relpath> once its whole subtree has. Those records
+    are held back and written every sync_every records or sync_interval
+    seconds, and on close: the filesystems are synced first, so the
+    chowns a record vouches for are on disk before it is, and then the
+    journal is fsync'ed. A crash therefore costs at most the work since
+    the last sync, which a resumed run redoes.
+
+    N<relpath> records an entry about to be chowned to nobody, so a
+    resumed run can tell it from a guest's own nobody. Those are fsync'ed
+    before the chown, as a lost one would make the entry be shifted again.
+
+    With resume, an existing journal for the same fingerprint is loaded
+    and appended to; a journal for a different shift raises
+    JournalMismatch.
+    Otherwise the file is started afresh.
+    """
+
+    def __init__(self, path, fingerprint, resume=False, sync_every=1024,
+                 sync_interval=1.0):
+        self.path = path
+        self.listed = set()
+        self.finished = set()
+        self.nobodies = set()
+        self.resumed = False
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._pending = []
+        self._last_sync = time.time()
+
+        header = MAGIC + fingerprint + b'\n'
+        if resume and os.path.exists(path):
+            self._load(header)
+            self.resumed = True
+            self._fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        else:
+            self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                               0o600)
+            os.write(self._fd, header)
+            os.fsync(self._fd)
+
+    def _load(self, header):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(header):
+            raise JournalMismatch('Journal %s does not belong to this '
+                                  'shift' % self.path)
+        records = data[len(header):].split(b'\0')
+        # The last piece is empty, or a record torn by a crash.
+        for record in records[:-1]:
+            kind, relpath = record[:1], os.fsdecode(record[1:])
+            if kind == LISTED:
+                self.listed.add(relpath)
+            elif kind == FINISHED:
+                self.finished.add(relpath)
+            elif kind == NOBODY:
+                self.nobodies.add(relpath)
+
+    def _append(self, kind, relpath):
+        self._pending.append(kind + os.fsencode(relpath) + b'\0')
+        elapsed = time.time() - self._last_sync
+        if len(self._pending) >= self.sync_every:
+            self.sync()
+        elif elapsed >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """Write the held records once the chowns before them are synced."""
+        if self._pending:
+            os.sync()
+            os.write(self._fd, b''.join(self._pending))
+            os.fsync(self._fd)
+            self._pending = []
+        self._last_sync = time.time()
+
+    def record_listed(self, relpath):
+        self.listed.add(relpath)
+        self._append(LISTED, relpath)
+
+    def record_finished(self, relpath):
+        self.finished.add(relpath)
+        self._append(FINISHED, relpath)
+
+    def record_nobodies(self, relpaths):
+        """Record relpaths as mapped to nobody, and fsync them."""
+        self.nobodies.update(relpaths)
+        os.write(self._fd, b''.join(NOBODY + os.fsencode(relpath) + b'\0'
+                                    for relpath in relpaths))
+        os.fsync(self._fd)
+
+    def close(self):
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
+
+
+def shift_dir_journaled(fsdir, uid_mappings, gid_mappings, nobody, journal,
+                        skip_ranges=None, prune=None, **kwargs):
+    """Shift fsdir serially, recording progress in journal.
+
+    Subtrees the journal has finished are skipped without being listed.
+    Directories whose entries are all done are only listed, by d_type, to
+    find their subdirectories.
+
+    Any other directory may have been partly shifted before the previous
+    run died, and find_target_id is not idempotent: a shifted id would be
+    mapped again. So when resuming, those entries are shifted as with
+    shift_dir(idempotent=True), and an entry whose ownership already falls
+    in the target ranges is left alone. Host nobody only counts as shifted
+    for the entries the journal recorded as mapped to nobody; those are
+    listed CHUNK entries at a time, before the chunk is chowned. That is
+    exact as long as the unshifted ids are not themselves inside the
+    target host ranges. Entries prune(path, stat) returns True for are
+    skipped along with their subtrees. kwargs are passed to shift_path.
+    """
+    stats = kwargs.get('stats')
+    uid_memo = kwargs['uid_memo']
+    gid_memo = kwargs['gid_memo']
+    resume_ranges = skip_ranges
+    nobody_ranges = skip_ranges
+    if journal.resumed:
+        resume_ranges = (uid_mappings, gid_mappings)
+        nobody_ranges = (
+            idmapshift.HostIdSet(idmapshift.get_ranges(uid_mappings),
+                                 [nobody]),
+            idmapshift.HostIdSet(idmapshift.get_ranges(gid_mappings),
+                                 [nobody]))
+
+    def to_nobody(stat):
+        uid = idmapshift.find_target_id(stat.st_uid, uid_mappings, nobody,
+                                        uid_memo)
+        if uid == nobody and stat.st_uid != nobody:
+            return True
+        gid = idmapshift.find_target_id(stat.st_gid, gid_mappings, nobody,
+                                        gid_memo)
+        return gid == nobody and stat.st_gid != nobody
+
+    def shift(chunk):
+        nobodies = [relpath for relpath, path, stat in chunk
+                    if relpath not in journal.nobodies and to_nobody(stat)]
+        if nobodies:
+            journal.record_nobodies(nobodies)
+        for relpath, path, stat in chunk:
+            ranges = resume_ranges
+            if relpath in journal.nobodies:
+                ranges = nobody_ranges
+            idmapshift.shift_path(path, uid_mappings, gid_mappings, nobody,
+                                  stat=stat, skip_ranges=ranges, **kwargs)
+        del chunk[:]
+
+    if not (journal.listed or journal.finished):
+        shift([('', fsdir, os.lstat(fsdir))])
+    pending = [(False, '')]
+    while pending:
+        done, relpath = pending.pop()
+        if done:
+            journal.record_finished(relpath)
+            continue
+        if relpath in journal.finished:
+            continue
+        listed = relpath in journal.listed
+        dirpath = os.path.join(fsdir, relpath) if relpath else fsdir
+        try:
+            entries = os.scandir(dirpath)
+        except OSError:
+            continue
+        if stats is not None:
+            stats.dirs += 1
+        prefix = relpath + '/' if relpath else ''
+        subdirs = []
+        chunk = []
+        with entries:
+            for entry in entries:
+                if listed:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    if prune is not None:
+                        stat = idmapshift.lstat_entry(entry, stats)
+                        if prune(entry.path, stat):
+                            continue
+                    subdirs.append(entry.name)
+                    continue
+                stat = idmapshift.lstat_entry(entry, stats)
+                if prune is not None and prune(entry.path, stat):
+                    continue
+                chunk.append((prefix + entry.name, entry.path, stat))
+                if len(chunk) >= CHUNK:
+                    shift(chunk)
+                if stat_module.S_ISDIR(stat.st_mode):
+                    subdirs.append(entry.name)
+        shift(chunk)
+        if not listed:
+            journal.record_listed(relpath)
+        pending.append((True, relpath))
+        pending.extend((False, prefix + name) for name in reversed(subdirs))
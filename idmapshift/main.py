@@ -14,8 +14,12 @@
 
 import argparse
 import sys
+import time
 
 import idmapshift
+from idmapshift import journal
+from idmapshift import output
+from idmapshift import prune
 
 NOBODY_ID = 65534
 
@@ -38,28 +42,407 @@ def id_map_type(val):
             raise argparse.ArgumentTypeError(msg)
 
         id_maps.append(tuple(vals))
+
+    try:
+        idmapshift.IdMap(id_maps)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError('Invalid id map %s, %s' % (val, e))
     return id_maps
 
 
+def shift_batch(parser, args, remap, stats):
+    from idmapshift import batch
+
+    if args.path is not None or args.confirm or args.verbose or remap:
+        parser.error('--batch cannot be used with a path, --confirm, '
+                     '--verbose or --from-uid/--from-gid')
+    if args.fd_relative or args.processes > 1 or args.journal is not None:
+        parser.error('--batch cannot be used with --fd-relative, '
+                     '--processes or --journal')
+    if args.manifest is not None or args.profile is not None:
+        parser.error('--batch cannot be used with --manifest or --profile')
+    if args.tar or args.paths_from is not None:
+        parser.error('--batch cannot be used with --tar or --paths-from')
+    try:
+        trees = batch.load_spec(args.batch, excludes=args.exclude,
+                                one_file_system=args.one_file_system)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    batch.shift_trees(trees, jobs=args.jobs, dry_run=args.dry_run,
+                      idempotent=args.idempotent, stats=stats,
+                      xattrs=args.xattrs, **statx_options(args))
+    if stats is not None:
+        stats.write_json(args.stats_json)
+    for tree in trees:
+        if tree.prune is not None:
+            sys.stderr.write('%s: pruned %d entries\n'
+                             % (tree.path, tree.result.pruned))
+    failed = [tree for tree in trees if tree.error is not None]
+    for tree in failed:
+        sys.stderr.write('%s: %s\n' % (tree.path, tree.error))
+    sys.exit(1 if failed else 0)
+
+
 def main():
     parser = argparse.ArgumentParser('User Namespace FS Owner Shift')
-    parser.add_argument('path')
+    parser.add_argument('path', nargs='?')
     parser.add_argument('-u', '--uid', type=id_map_type, default=[])
     parser.add_argument('-g', '--gid', type=id_map_type, default=[])
     parser.add_argument('-n', '--nobody', default=NOBODY_ID, type=int)
+    parser.add_argument('--from-uid', type=id_map_type, default=None,
+                        help='Uid map the path is currently shifted for; '
+                             'remap it to --uid')
+    parser.add_argument('--from-gid', type=id_map_type, default=None,
+                        help='Gid map the path is currently shifted for; '
+                             'remap it to --gid')
     parser.add_argument('-i', '--idempotent', action='store_true')
     parser.add_argument('-c', '--confirm', action='store_true')
     parser.add_argument('-d', '--dry-run', action='store_true')
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--fd-relative', action='store_true',
+                        help='Stat and chown relative to directory fds')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help='Number of threads to shift or confirm with')
+    parser.add_argument('-P', '--processes', default=1, type=int,
+                        help='Number of worker processes to shift or '
+                             'confirm with')
+    parser.add_argument('--journal', default=None,
+                        help='Record progress in this file')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume the shift recorded in --journal')
+    parser.add_argument('--manifest', default=None,
+                        help='Write an ownership manifest to this file and '
+                             'use an earlier one to skip unchanged '
+                             'directories')
+    parser.add_argument('--stats-json', default=None,
+                        help='Write counters and syscall timings for the '
+                             'run to this file as JSON')
+    parser.add_argument('--output-format', default='text',
+                        choices=output.FORMATS,
+                        help='Format of --verbose output')
+    parser.add_argument('--changes-only', action='store_true',
+                        help='Only list entries whose ownership changes in '
+                             '--verbose output')
+    parser.add_argument('--batch', default=None, metavar='SPEC',
+                        help='Shift every tree listed in this JSON spec '
+                             'file, sharing --jobs threads between them')
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help='Write cProfile data to FILE and phase times '
+                             'and the slowest paths to FILE.json')
+    parser.add_argument('--tar', action='store_true',
+                        help='Treat path as a tar archive, - for stdin, and '
+                             'write it with shifted ownership to '
+                             '--tar-output')
+    parser.add_argument('--tar-output', default='-', metavar='FILE',
+                        help='Where --tar writes the shifted archive, - for '
+                             'stdout (the default)')
+    parser.add_argument('--paths-from', default=None, metavar='FILE',
+                        help='Only shift or confirm the NUL-delimited paths '
+                             'listed in FILE, - for stdin; relative paths '
+                             'are taken from path when one is given; '
+                             'paths that no longer exist are skipped')
+    parser.add_argument('--exclude', action='append', default=None,
+                        metavar='PATTERN',
+                        help='Leave out entries matching PATTERN, a path '
+                             'prefix or glob relative to path, and '
+                             'everything beneath them; may be repeated')
+    parser.add_argument('--one-file-system', action='store_true',
+                        help='Leave out mount points and everything '
+                             'beneath them')
+    parser.add_argument('--statx', action='store_true',
+                        help='Stat entries with statx, asking only for the '
+                             'fields needed, which saves attribute fetches '
+                             'on network filesystems')
+    parser.add_argument('--statx-dont-sync', action='store_true',
+                        help='Like --statx, but let network filesystems '
+                             'answer from cached attributes')
+    parser.add_argument('--xattrs', action='store_true',
+                        help='Also shift the ids in POSIX ACLs and file '
+                             'capabilities')
+    parser.add_argument('--confirm-sample', default=None, type=int,
+                        metavar='N',
+                        help='Confirm from a random sample of about N '
+                             'entries, stopping at the first one out of '
+                             'range; a full --confirm can follow for an '
+                             'exact answer')
+    parser.add_argument('--confidence', default=0.95, type=float,
+                        help='Confidence of the bound --confirm-sample '
+                             'reports on the fraction out of range')
+    start = time.perf_counter()
     args = parser.parse_args()
+    parse_seconds = time.perf_counter() - start
+    remap = args.from_uid is not None or args.from_gid is not None
+    if remap and (args.from_uid is None or args.from_gid is None):
+        parser.error('--from-uid and --from-gid must be used together')
+
+    try:
+        prune.compile_excludes(args.exclude)
+    except ValueError as e:
+        parser.error(str(e))
+    statx = args.statx or args.statx_dont_sync
+    if statx and (args.journal or args.manifest or args.tar):
+        parser.error('--statx cannot be used with --journal, --manifest or '
+                     '--tar')
+    if args.jobs > 1 and args.processes > 1:
+        parser.error('--jobs and --processes are mutually exclusive')
+    if not args.confirm:
+        if args.fd_relative and (args.jobs > 1 or args.processes > 1):
+            parser.error('--fd-relative cannot be used with --jobs or '
+                         '--processes')
+        if args.verbose and args.processes > 1:
+            parser.error('--verbose cannot be used with --processes')
+        if args.journal is not None:
+            if args.fd_relative or args.jobs > 1 or args.processes > 1:
+                parser.error('--journal cannot be used with --fd-relative, '
+                             '--jobs or --processes')
+            if args.dry_run:
+                parser.error('--journal cannot be used with --dry-run')
+    if args.resume and args.journal is None:
+        parser.error('--resume requires --journal')
+    if args.manifest is not None:
+        if args.jobs > 1 or args.processes > 1:
+            parser.error('--manifest cannot be used with --jobs or '
+                         '--processes')
+        if not args.confirm and (args.fd_relative or args.journal):
+            parser.error('--manifest cannot be used with --fd-relative or '
+                         '--journal')
+        if not args.confirm and args.dry_run:
+            parser.error('--manifest cannot be used with --dry-run')
+
+    if args.confirm_sample is not None:
+        if args.jobs > 1 or args.processes > 1 or args.manifest:
+            parser.error('--confirm-sample cannot be used with --jobs, '
+                         '--processes or --manifest')
+        if args.batch or args.paths_from is not None or args.tar:
+            parser.error('--confirm-sample cannot be used with --batch, '
+                         '--paths-from or --tar')
+        if args.confirm_sample < 1:
+            parser.error('--confirm-sample must be at least 1')
+        if not 0 < args.confidence < 1:
+            parser.error('--confidence must be between 0 and 1')
+
+    serial = args.jobs == 1 and args.processes == 1
+    if args.confirm and args.stats_json:
+        if not serial or args.manifest is not None:
+            parser.error('--stats-json only supports the serial --confirm, '
+                         'without --jobs, --processes or --manifest')
 
-    if args.idempotent or args.confirm:
-        if idmapshift.confirm_dir(args.path, args.uid, args.gid,
-                                      args.nobody):
+    stats = idmapshift.Stats() if args.stats_json else None
+    if args.batch is not None:
+        shift_batch(parser, args, remap, stats)
+    if args.paths_from is not None:
+        if args.tar or args.fd_relative or args.journal or args.manifest:
+            parser.error('--paths-from cannot be used with --tar, '
+                         '--fd-relative, --journal or --manifest')
+        if args.jobs > 1 or args.processes > 1:
+            parser.error('--paths-from cannot be used with --jobs or '
+                         '--processes')
+        pruned = args.exclude or args.one_file_system
+        if pruned and args.path is None:
+            parser.error('--paths-from needs a path for --exclude or '
+                         '--one-file-system')
+    elif args.path is None:
+        parser.error('a path is required unless --batch is given')
+    if args.tar:
+        if args.confirm or args.dry_run or args.idempotent:
+            parser.error('--tar cannot be used with --confirm, --dry-run or '
+                         '--idempotent')
+        if args.fd_relative or args.jobs > 1 or args.processes > 1:
+            parser.error('--tar cannot be used with --fd-relative, --jobs '
+                         'or --processes')
+        if args.journal or args.manifest or args.stats_json:
+            parser.error('--tar cannot be used with --journal, --manifest '
+                         'or --stats-json')
+        if args.exclude or args.one_file_system or args.xattrs:
+            parser.error('--tar cannot be used with --exclude, '
+                         '--one-file-system or --xattrs')
+
+    profiler = None
+    if args.profile is not None:
+        from idmapshift import profiling
+        profiler = profiling.Profiler(stats)
+        profiler.add_phase('parse', parse_seconds)
+        stats = profiler.stats
+
+    def run(phase, func, *func_args, **func_kwargs):
+        if profiler is None:
+            return func(*func_args, **func_kwargs)
+        return profiler.run(phase, func, *func_args, **func_kwargs)
+
+    try:
+        shift_or_confirm(args, remap, stats, run)
+    except journal.JournalMismatch as e:
+        parser.error(str(e))
+    finally:
+        if profiler is not None:
+            profiler.write(args.profile)
+
+
+def shift_tar(args, remap, run):
+    from idmapshift import tar
+
+    uid = args.uid
+    gid = args.gid
+    if remap:
+        uid = idmapshift.compose_maps(args.from_uid, args.uid)
+        gid = idmapshift.compose_maps(args.from_gid, args.gid)
+    printer = None
+    if args.verbose:
+        # stdout may be carrying the archive.
+        printer = output.OutputSink(sys.stderr.buffer, args.output_format,
+                                    changes_only=args.changes_only)
+    src = sys.stdin.buffer if args.path == '-' else open(args.path, 'rb')
+    dst = (sys.stdout.buffer if args.tar_output == '-'
+           else open(args.tar_output, 'wb'))
+    try:
+        run('shift', tar.shift_tar, src, dst, uid, gid, args.nobody,
+            verbose=args.verbose, printer=printer)
+    finally:
+        if printer is not None:
+            printer.close()
+        if src is not sys.stdin.buffer:
+            src.close()
+        if dst is not sys.stdout.buffer:
+            dst.close()
+        else:
+            dst.flush()
+
+
+def shift_paths(args, remap, stats, run):
+    from idmapshift import pathlist
+
+    uid = args.uid
+    gid = args.gid
+    if remap:
+        uid = idmapshift.compose_maps(args.from_uid, args.uid)
+        gid = idmapshift.compose_maps(args.from_gid, args.gid)
+    shifter = idmapshift.IdMapShifter(uid, gid, args.nobody, stats=stats,
+                                      excludes=args.exclude,
+                                      one_file_system=args.one_file_system,
+                                      xattrs=args.xattrs,
+                                      **statx_options(args))
+    src = (sys.stdin.buffer if args.paths_from == '-'
+           else open(args.paths_from, 'rb'))
+    paths = pathlist.read_paths(src, base=args.path)
+    printer = None
+    try:
+        if args.confirm:
+            result = idmapshift.ShiftResult()
+            confirmed = run('confirm', shifter.confirm_paths, paths,
+                            root=args.path, result=result)
+            report_missing(result)
+            if args.stats_json:
+                stats.write_json(args.stats_json)
+            sys.exit(0 if confirmed else 1)
+        if args.verbose:
+            sys.stdout.flush()
+            printer = output.OutputSink(sys.stdout.buffer, args.output_format,
+                                        changes_only=args.changes_only)
+        result = run('shift', shifter.shift_paths, paths,
+                     dry_run=args.dry_run, verbose=args.verbose,
+                     idempotent=args.idempotent, printer=printer,
+                     root=args.path)
+    finally:
+        if printer is not None:
+            printer.close()
+        if src is not sys.stdin.buffer:
+            src.close()
+    report_pruned(args, result)
+    report_missing(result)
+    if args.stats_json:
+        stats.write_json(args.stats_json)
+
+
+def report_missing(result):
+    if result.missing:
+        sys.stderr.write('Skipped %d missing paths\n' % result.missing)
+
+
+def confirm_sample(args, stats, run):
+    shifter = idmapshift.IdMapShifter(args.uid, args.gid, args.nobody,
+                                      stats=stats, excludes=args.exclude,
+                                      one_file_system=args.one_file_system,
+                                      **statx_options(args))
+    result = run('confirm', shifter.confirm_sample, args.path,
+                 args.confirm_sample, confidence=args.confidence)
+    if result.first_out_of_range is not None:
+        sys.stderr.write('%s is out of range\n' % result.first_out_of_range)
+    sys.stderr.write('Sampled %d entries in %d directories: about %.4f%% '
+                     'out of range, at most %.4f%% with %g%% confidence\n'
+                     % (result.checked, result.dirs,
+                        100 * result.estimate(), 100 * result.upper_bound(),
+                        100 * args.confidence))
+    report_pruned(args, result)
+    if args.stats_json:
+        stats.write_json(args.stats_json)
+    sys.exit(0 if result.confirmed() else 1)
+
+
+def statx_options(args):
+    return dict(statx=args.statx or args.statx_dont_sync,
+                dont_sync=args.statx_dont_sync)
+
+
+def report_pruned(args, result):
+    if args.exclude or args.one_file_system:
+        sys.stderr.write('Pruned %d entries\n' % result.pruned)
+
+
+def shift_or_confirm(args, remap, stats, run):
+    if args.tar:
+        shift_tar(args, remap, run)
+        return
+    if args.paths_from is not None:
+        shift_paths(args, remap, stats, run)
+        return
+    if args.confirm_sample is not None:
+        confirm_sample(args, stats, run)
+        return
+    if args.confirm:
+        confirm_stats = stats
+        serial = args.jobs == 1 and args.processes == 1
+        if not serial or args.manifest is not None:
+            # Only the serial confirm collects stats; main() rejects
+            # --stats-json otherwise, so this only drops --profile's.
+            confirm_stats = None
+        confirmed = run('confirm', idmapshift.confirm_dir, args.path,
+                        args.uid, args.gid, args.nobody, jobs=args.jobs,
+                        processes=args.processes, manifest=args.manifest,
+                        stats=confirm_stats, excludes=args.exclude,
+                        one_file_system=args.one_file_system,
+                        **statx_options(args))
+        if args.stats_json:
+            stats.write_json(args.stats_json)
+        if confirmed:
             sys.exit(0)
         else:
-            if args.confirm:
-                sys.exit(1)
+            sys.exit(1)
 
-    idmapshift.shift_dir(args.path, args.uid, args.gid, args.nobody,
-                         dry_run=args.dry_run, verbose=args.verbose)
+    kwargs = dict(dry_run=args.dry_run, verbose=args.verbose,
+                  fd_relative=args.fd_relative, idempotent=args.idempotent,
+                  jobs=args.jobs, processes=args.processes,
+                  journal=args.journal, resume=args.resume,
+                  manifest=args.manifest, stats=stats, printer=None,
+                  excludes=args.exclude,
+                  one_file_system=args.one_file_system, xattrs=args.xattrs,
+                  **statx_options(args))
+    if args.verbose:
+        sys.stdout.flush()
+        kwargs['printer'] = output.OutputSink(
+            sys.stdout.buffer, args.output_format,
+            changes_only=args.changes_only)
+    try:
+        if remap:
+            result = run('shift', idmapshift.remap_dir, args.path,
+                         args.from_uid, args.from_gid, args.uid, args.gid,
+                         args.nobody, **kwargs)
+        else:
+            result = run('shift', idmapshift.shift_dir, args.path, args.uid,
+                         args.gid, args.nobody, **kwargs)
+    finally:
+        if kwargs['printer'] is not None:
+            kwargs['printer'].close()
+    report_pruned(args, result)
+    if args.stats_json:
+        stats.write_json(args.stats_json)
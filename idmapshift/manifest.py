@@ -0,0 +1,296 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Ownership manifests for incremental shift and confirm runs.
+
+A manifest describes every directory of a shifted tree as it was when the
+run finished: its inode, ctime and mtime, and a hash of the ownership of
+its entries. A later run that finds a directory with the same inode,
+ctime and mtime knows no entry was added, removed or renamed there, so it
+skips listing it and only checks its subdirectories. Ownership changed
+in place by someone else's chown is not detected; the manifest trusts
+that only idmapshift rewrites ownership in the tree.
+
+The file is laid out for mmap: a fixed header, then one fixed-size record
+per directory in breadth-first order, so the children of a directory are
+contiguous and sorted by name, then the names themselves.
+"""
+
+import bisect
+import hashlib
+import mmap
+import os
+import stat as stat_module
+import struct
+
+import idmapshift
+from idmapshift import journal
+
+MAGIC = b'IDMSMAN1'
+HEADER = struct.Struct('<8s40sII')
+# ino, dev, ctime_ns, mtime_ns, hash, name offset, name length,
+# first child, child count
+RECORD = struct.Struct('<QQqqQIIII')
+
+
+def entry_hash(name, uid, gid):
+    data = os.fsencode(name) + struct.pack('<II', uid, gid)
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          'little')
+
+
+class Manifest(object):
+    """Read-only view of a manifest file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.fingerprint, self.count, self._names = (
+            HEADER.unpack_from(self._map, 0))
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not an idmapshift manifest' % path)
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        """Return the manifest at path if it is for this shift, else None."""
+        try:
+            manifest = cls(path)
+        except (OSError, ValueError, struct.error):
+            return None
+        if manifest.fingerprint != fingerprint:
+            manifest.close()
+            return None
+        return manifest
+
+    def close(self):
+        self._map.close()
+
+    def record(self, index):
+        return RECORD.unpack_from(self._map,
+                                  HEADER.size + index * RECORD.size)
+
+    def name(self, index):
+        record = self.record(index)
+        start = self._names + record[5]
+        return self._map[start:start + record[6]]
+
+    def children(self, index):
+        record = self.record(index)
+        return range(record[7], record[7] + record[8])
+
+    def find_child(self, index, name):
+        """Return the index of the named subdirectory, or None."""
+        children = self.children(index)
+        names = _Names(self, children)
+        name = os.fsencode(name)
+        i = bisect.bisect_left(names, name)
+        if i < len(children) and names[i] == name:
+            return children[i]
+        return None
+
+    def matches(self, index, stat):
+        ino, dev, ctime_ns, mtime_ns = self.record(index)[:4]
+        return (ino, dev, ctime_ns, mtime_ns) == (
+            stat.st_ino, stat.st_dev, stat.st_ctime_ns, stat.st_mtime_ns)
+
+
+class _Names(object):
+    """Sequence of child names, for bisect."""
+
+    def __init__(self, manifest, children):
+        self.manifest = manifest
+        self.children = children
+
+    def __len__(self):
+        return len(self.children)
+
+    def __getitem__(self, i):
+        return self.manifest.name(self.children[i])
+
+
+class ManifestWriter(object):
+    """Collects directory records during a walk and writes a manifest."""
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self._dirs = {}
+
+    def add(self, relpath, stat, ownership_hash):
+        self._dirs[relpath] = (stat.st_ino, stat.st_dev, stat.st_ctime_ns,
+                               stat.st_mtime_ns, ownership_hash)
+
+    def write(self, path):
+        children = {}
+        for relpath in self._dirs:
+            if relpath:
+                parent, _, name = relpath.rpartition('/')
+                children.setdefault(parent, []).append(os.fsencode(name))
+
+        order = [('', b'')]
+        records = []
+        names = []
+        names_size = 0
+        i = 0
+        while i < len(order):
+            relpath, name = order[i]
+            kids = sorted(children.get(relpath, []))
+            prefix = relpath + '/' if relpath else ''
+            first = len(order)
+            order.extend((prefix + os.fsdecode(kid), kid) for kid in kids)
+            fields = self._dirs[relpath] + (names_size, len(name), first,
+                                            len(kids))
+            records.append(RECORD.pack(*fields))
+            names.append(name)
+            names_size += len(name)
+            i += 1
+
+        names_offset = HEADER.size + len(records) * RECORD.size
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.fingerprint, len(records),
+                                names_offset))
+            f.writelines(records)
+            f.writelines(names)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+
+
+def walk(fsdir, visit, manifest_path, fingerprint, stats=None, prune=None):
+    """Walk fsdir, listing only directories that changed since the manifest.
+
+    visit(path, stat) handles one entry and returns its ownership
+    afterwards as (uid, gid), or None to abandon the walk. Directories
+    that match their manifest record are not listed; their subdirectories,
+    known from the manifest, are still checked. A directory that changed
+    under an unchanged parent is visited itself before its entries.
+
+    On success a fresh manifest is written to manifest_path and True is
+    returned; an abandoned walk returns False and writes nothing. Returns
+    the number of directories skipped as the second item. Listings and
+    lstats are counted in stats when one is given. Entries prune(path,
+    stat) returns True for are left out of the walk and the manifest;
+    the fingerprint should cover prune, since a skipped directory's
+    subdirectories come from the manifest.
+    """
+    old = Manifest.load(manifest_path, fingerprint)
+    writer = ManifestWriter(fingerprint)
+    skipped = 0
+    pending = [('', fsdir, 0 if old is not None else None, False)]
+    try:
+        while pending:
+            relpath, dirpath, index, visited = pending.pop()
+            try:
+                stat = os.lstat(dirpath)
+            except OSError:
+                continue
+            if not stat_module.S_ISDIR(stat.st_mode):
+                continue
+            if index is not None and not visited and relpath:
+                # Known only from the old manifest, so not yet checked.
+                if prune is not None and prune(dirpath, stat):
+                    continue
+            prefix = relpath + '/' if relpath else ''
+
+            if index is not None and old.matches(index, stat):
+                skipped += 1
+                writer.add(relpath, stat, old.record(index)[4])
+                for child in reversed(old.children(index)):
+                    name = os.fsdecode(old.name(child))
+                    pending.append((prefix + name,
+                                    os.path.join(dirpath, name), child,
+                                    False))
+                continue
+
+            if not visited:
+                if visit(dirpath, stat) is None:
+                    return False, skipped
+                stat = os.lstat(dirpath)
+            try:
+                entries = os.scandir(dirpath)
+            except OSError:
+                continue
+            if stats is not None:
+                stats.dirs += 1
+            ownership_hash = 0
+            subdirs = []
+            with entries:
+                for entry in entries:
+                    entry_stat = idmapshift.lstat_entry(entry, stats)
+                    if prune is not None and prune(entry.path, entry_stat):
+                        continue
+                    ownership = visit(entry.path, entry_stat)
+                    if ownership is None:
+                        return False, skipped
+                    ownership_hash ^= entry_hash(entry.name, *ownership)
+                    if stat_module.S_ISDIR(entry_stat.st_mode):
+                        subdirs.append(entry.name)
+            writer.add(relpath, stat, ownership_hash)
+            for name in reversed(subdirs):
+                child = None
+                if index is not None:
+                    child = old.find_child(index, name)
+                pending.append((prefix + name, os.path.join(dirpath, name),
+                                child, True))
+    finally:
+        if old is not None:
+            old.close()
+    writer.write(manifest_path)
+    return True, skipped
+
+
+def shift_dir_manifest(fsdir, uid_mappings, gid_mappings, nobody,
+                       manifest_path, prune=None, **kwargs):
+    """Shift fsdir serially, skipping directories the manifest vouches for.
+
+    A directory that changed may hold both shifted and unshifted entries,
+    so entries are shifted as with shift_dir(idempotent=True). Returns the
+    number of directories skipped. prune is as for walk, and kwargs are
+    passed to shift_path.
+    """
+    uid_memo = kwargs['uid_memo']
+    gid_memo = kwargs['gid_memo']
+
+    def visit(path, stat):
+        if not idmapshift.shift_path(path, uid_mappings, gid_mappings,
+                                     nobody, stat=stat, **kwargs):
+            return stat.st_uid, stat.st_gid
+        return (idmapshift.find_target_id(stat.st_uid, uid_mappings, nobody,
+                                          uid_memo),
+                idmapshift.find_target_id(stat.st_gid, gid_mappings, nobody,
+                                          gid_memo))
+
+    fingerprint = journal.fingerprint(fsdir, uid_mappings, gid_mappings,
+                                      nobody, prune)
+    return walk(fsdir, visit, manifest_path, fingerprint,
+                kwargs.get('stats'), prune)[1]
+
+
+def confirm_dir_manifest(fsdir, uid_mappings, gid_mappings, nobody,
+                         uid_ranges, gid_ranges, manifest_path, prune=None):
+    """Confirm fsdir, skipping directories the manifest vouches for.
+
+    The manifest is refreshed when the tree confirms. prune is as for
+    walk. Returns True or False like confirm_dir.
+    """
+    def visit(path, stat):
+        if not idmapshift.confirm_path(path, uid_ranges, gid_ranges, nobody,
+                                       stat=stat):
+            return None
+        return stat.st_uid, stat.st_gid
+
+    fingerprint = journal.fingerprint(fsdir, uid_mappings, gid_mappings,
+                                      nobody, prune)
+    return walk(fsdir, visit, manifest_path, fingerprint, prune=prune)[0]
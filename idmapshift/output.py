@@ -0,0 +1,91 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Buffered verbose output in text, NDJSON or NUL-delimited form."""
+
+import json
+import os
+
+FORMATS = ('text', 'ndjson', 'nul')
+NDJSON = (b'{"path": %s, "uid": %d, "gid": %d, "target_uid": %d, '
+          b'"target_gid": %d}\n')
+
+
+def format_text(path, uid, gid, target_uid, target_gid):
+    return b'%s %d:%d -> %d:%d\n' % (os.fsencode(path), uid, gid,
+                                     target_uid, target_gid)
+
+
+def format_ndjson(path, uid, gid, target_uid, target_gid):
+    # Undecodable bytes in path come through os.fsdecode as lone
+    # surrogates, which json escapes as \udcXX.
+    return NDJSON % (json.dumps(os.fsdecode(path)).encode('ascii'),
+                     uid, gid, target_uid, target_gid)
+
+
+def format_nul(path, uid, gid, target_uid, target_gid):
+    return b'%s\0%d:%d\0%d:%d\0' % (os.fsencode(path), uid, gid,
+                                    target_uid, target_gid)
+
+
+FORMATTERS = {'text': format_text, 'ndjson': format_ndjson,
+              'nul': format_nul}
+
+
+class OutputSink(object):
+    """A printer for shift_dir that batches its writes.
+
+    Called with print_chown's arguments, it formats each entry into an
+    in-memory batch and writes the batch to stream, a binary file, once
+    it reaches buffer_size bytes, so a large tree costs a few large
+    writes instead of a print per inode. With changes_only, entries whose
+    ownership is left as it is are not written. close() flushes the last
+    batch; the sink can also be used as a context manager.
+    """
+
+    def __init__(self, stream, fmt='text', changes_only=False,
+                 buffer_size=1 << 20):
+        if fmt not in FORMATTERS:
+            raise ValueError('unknown output format %r' % fmt)
+        self.stream = stream
+        self.changes_only = changes_only
+        self.buffer_size = buffer_size
+        self._format = FORMATTERS[fmt]
+        self._batch = []
+        self._size = 0
+
+    def __call__(self, path, uid, gid, target_uid, target_gid):
+        if self.changes_only and uid == target_uid and gid == target_gid:
+            return
+        line = self._format(path, uid, gid, target_uid, target_gid)
+        self._batch.append(line)
+        self._size += len(line)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self.stream.write(b''.join(self._batch))
+            self._batch = []
+            self._size = 0
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
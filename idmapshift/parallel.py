@@ -0,0 +1,387 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent import futures
+import multiprocessing
+import os
+import stat as stat_module
+import threading
+
+import idmapshift
+
+# Entries a worker process handles per task before handing the rest of its
+# subtrees back to be shared out again.
+TASK_BUDGET = 20000
+
+# Per-process state set up once by the pool initializer, so the mappings
+# aren't pickled into every task.
+_worker = {}
+
+
+def shift_listing(dirpath, uid_mappings, gid_mappings, nobody, stats=None,
+                  prune=None, lstat=None, **kwargs):
+    """Shift the entries of the directory dirpath, but not dirpath itself.
+
+    This is the task both shift_dir_threads and idmapshift.batch run for
+    each directory. Counts go to a fresh ShiftResult, and to a Stats
+    spawned from stats when one is given, for the caller to merge.
+    Entries prune(path, stat) returns True for are skipped, lstat is as
+    for iter_tree and kwargs are passed to shift_path. Returns (result,
+    stats, subdirs), subdirs being the paths of the subdirectories in
+    listing order; a directory that cannot be listed has none.
+    """
+    result = idmapshift.ShiftResult()
+    listing_stats = stats.spawn() if stats is not None else None
+    subdirs = []
+    try:
+        entries = os.scandir(dirpath)
+    except OSError:
+        return result, listing_stats, subdirs
+    if listing_stats is not None:
+        listing_stats.dirs += 1
+    with entries:
+        for entry in entries:
+            stat = idmapshift.lstat_entry(entry, listing_stats, lstat)
+            if prune is not None and prune(entry.path, stat):
+                continue
+            idmapshift.shift_path(entry.path, uid_mappings, gid_mappings,
+                                  nobody, stat=stat, result=result,
+                                  stats=listing_stats, **kwargs)
+            if stat_module.S_ISDIR(stat.st_mode):
+                subdirs.append(entry.path)
+    return result, listing_stats, subdirs
+
+
+def shift_dir_threads(fsdir, uid_mappings, gid_mappings, nobody, jobs,
+                      result, verbose=False, stats=None, printer=None,
+                      prune=None, lstat=None, **kwargs):
+    """Shift fsdir with a pool of jobs threads.
+
+    Every directory listing is a task on the pool: a worker stats and
+    shifts the listing's entries with shift_listing, then queues a task
+    for each subdirectory it found. The uid/gid memos in kwargs are
+    shared by all workers; find_target_id always stores the same value
+    for an id, so a race between two workers only repeats a lookup.
+
+    Verbose lines are buffered per listing and passed to printer, or
+    print_chown, by the calling thread in the order iter_tree would visit
+    them, so the output matches a serial run. Counts from every listing
+    are merged into result, and into stats when one is given, and the
+    first error raised by a worker is re-raised here once the outstanding
+    tasks have been abandoned. Entries prune(path, stat) returns True for
+    are skipped along with their subtrees. lstat is as for iter_tree.
+    """
+    stop = threading.Event()
+
+    def shift_task(dirpath):
+        lines = []
+        if stop.is_set():
+            listing_stats = stats.spawn() if stats is not None else None
+            return idmapshift.ShiftResult(), listing_stats, lines, []
+        listing, listing_stats, subdirs = shift_listing(
+            dirpath, uid_mappings, gid_mappings, nobody, stats=stats,
+            prune=prune, lstat=lstat, verbose=verbose,
+            printer=lambda *a: lines.append(a), **kwargs)
+        children = [executor.submit(shift_task, path) for path in subdirs]
+        return listing, listing_stats, lines, children
+
+    idmapshift.shift_path(fsdir, uid_mappings, gid_mappings, nobody,
+                          stat=(lstat or os.lstat)(fsdir), verbose=verbose,
+                          result=result, stats=stats, printer=printer,
+                          **kwargs)
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = [executor.submit(shift_task, fsdir)]
+        try:
+            while pending:
+                listing, listing_stats, lines, children = (
+                    pending.pop().result())
+                result.merge(listing)
+                if stats is not None:
+                    stats.merge(listing_stats)
+                for line in lines:
+                    (printer or idmapshift.print_chown)(*line)
+                pending.extend(reversed(children))
+        except BaseException:
+            stop.set()
+            raise
+
+
+def _init_shift_worker(uid_mappings, gid_mappings, nobody, dry_run,
+                       skip_ranges, claims, keep_slowest=None, prune=None,
+                       lstat=None, xattrs=False):
+    _worker.clear()
+    _worker.update(uid_mappings=uid_mappings, gid_mappings=gid_mappings,
+                   nobody=nobody, dry_run=dry_run, skip_ranges=skip_ranges,
+                   uid_memo=dict(), gid_memo=dict(), claims=claims,
+                   hardlinks=idmapshift.InodeSet(),
+                   keep_slowest=keep_slowest, prune=prune, lstat=lstat,
+                   xattrs=xattrs)
+
+
+def _claim(stat):
+    """Return True if this worker is the one to shift a hard-linked inode.
+
+    The worker's own InodeSet answers for links it has seen before, so
+    the shared claims are asked once per inode per worker.
+    """
+    if not _worker['hardlinks'].add(stat.st_dev, stat.st_ino):
+        return False
+    pid = os.getpid()
+    return _worker['claims'].setdefault((stat.st_dev, stat.st_ino),
+                                        pid) == pid
+
+
+def _init_confirm_worker(uid_ranges, gid_ranges, nobody, stop, prune=None,
+                         lstat=None):
+    _worker.clear()
+    _worker.update(uid_ranges=uid_ranges, gid_ranges=gid_ranges,
+                   nobody=nobody, stop=stop, prune=prune, lstat=lstat)
+
+
+def _walk_budget(dirpaths, budget, visit, stop=None, stats=None,
+                 prune=None, lstat=None):
+    """Walk the entries below dirpaths until budget entries are visited.
+
+    visit(path, stat) is called for each entry and returns False to stop
+    early. The walk also stops, before listing another directory, once the
+    stop event is set. Entries prune(path, stat) returns True for are
+    skipped along with their subtrees, and lstat is as for iter_tree.
+    Listings and lstats are counted in stats if given.
+    Returns (visited, unfinished, stopped), where unfinished lists the
+    directories that were queued but not yet listed.
+    """
+    pending = list(reversed(dirpaths))
+    visited = 0
+    while pending and visited < budget:
+        if stop is not None and stop.is_set():
+            return visited, [], True
+        dirpath = pending.pop()
+        try:
+            entries = os.scandir(dirpath)
+        except OSError:
+            continue
+        if stats is not None:
+            stats.dirs += 1
+        subdirs = []
+        with entries:
+            for entry in entries:
+                stat = idmapshift.lstat_entry(entry, stats, lstat)
+                if prune is not None and prune(entry.path, stat):
+                    continue
+                visited += 1
+                if not visit(entry.path, stat):
+                    return visited, [], True
+                if stat_module.S_ISDIR(stat.st_mode):
+                    subdirs.append(entry.path)
+        pending.extend(reversed(subdirs))
+    return visited, list(reversed(pending)), False
+
+
+def _shift_task(dirpaths, budget):
+    result = idmapshift.ShiftResult()
+    stats = None
+    if _worker['keep_slowest'] is not None:
+        stats = idmapshift.Stats(_worker['keep_slowest'])
+
+    def visit(path, stat):
+        if idmapshift.is_hardlinked(stat) and not _claim(stat):
+            result.hardlinks_skipped += 1
+            if stats is not None:
+                stats.skips += 1
+            return True
+        idmapshift.shift_path(path, _worker['uid_mappings'],
+                              _worker['gid_mappings'], _worker['nobody'],
+                              _worker['uid_memo'], _worker['gid_memo'],
+                              dry_run=_worker['dry_run'], stat=stat,
+                              result=result,
+                              skip_ranges=_worker['skip_ranges'],
+                              stats=stats, xattrs=_worker['xattrs'])
+        return True
+
+    prune = _worker['prune']
+    pruned = prune.pruned if prune is not None else 0
+    visited, unfinished, stopped = _walk_budget(dirpaths, budget, visit,
+                                                stats=stats, prune=prune,
+                                                lstat=_worker['lstat'])
+    if prune is not None:
+        result.pruned += prune.pruned - pruned
+    return (result, stats), unfinished
+
+
+def _confirm_task(dirpaths, budget):
+    def visit(path, stat):
+        return idmapshift.confirm_path(path, _worker['uid_ranges'],
+                                       _worker['gid_ranges'],
+                                       _worker['nobody'], stat=stat)
+
+    stop = _worker['stop']
+    visited, unfinished, stopped = _walk_budget(dirpaths, budget, visit,
+                                                stop=stop,
+                                                prune=_worker['prune'],
+                                                lstat=_worker['lstat'])
+    if stopped:
+        stop.set()
+    return not stopped, unfinished
+
+
+def _schedule(executor, fsdir, task, processes, merge):
+    """Run task over the directories below fsdir on executor.
+
+    Directories wait in one shared queue. Each task takes a slice of it,
+    works through at most TASK_BUDGET entries and returns the directories
+    it did not get to, which go back on the queue for whichever worker is
+    free next. A single huge subtree is therefore spread over every worker
+    instead of pinning one. merge(value) receives each task's value and
+    returns False to abandon the walk. Returns False if it was abandoned.
+    """
+    queue = [fsdir]
+    running = set()
+    slots = processes * 2
+    try:
+        while queue or running:
+            while queue and len(running) < slots:
+                count = max(1, len(queue) // (slots - len(running)))
+                batch = queue[-count:]
+                del queue[-count:]
+                running.add(executor.submit(task, batch, TASK_BUDGET))
+            done, running = futures.wait(
+                running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                value, unfinished = future.result()
+                if not merge(value):
+                    return False
+                queue.extend(unfinished)
+    finally:
+        for future in running:
+            future.cancel()
+    return True
+
+
+def shift_dir_processes(fsdir, uid_mappings, gid_mappings, nobody,
+                        processes, result, dry_run=False, skip_ranges=None,
+                        stats=None, prune=None, lstat=None, xattrs=False):
+    """Shift fsdir with a pool of worker processes.
+
+    The mappings are sent to each worker once, when the pool starts, and
+    every worker keeps its own memos. Workers send back only their counts
+    and the directories left unlisted when their budget ran out (see
+    _schedule), so per-entry work never crosses a process boundary.
+
+    Links to one inode can land in different workers, so a worker only
+    shifts a hard-linked file once it has claimed the inode's
+    (st_dev, st_ino) in a dict shared through a multiprocessing manager;
+    the first claim wins and every other link is skipped. The counts are
+    merged into result, and workers' timings into stats when one is
+    given; a worker error is re-raised here. prune and lstat, which must
+    pickle, are sent to the workers, and what they prune is counted in
+    result.pruned. xattrs is passed to shift_path.
+    """
+    idmapshift.shift_path(fsdir, uid_mappings, gid_mappings, nobody,
+                          dict(), dict(), dry_run=dry_run,
+                          stat=(lstat or os.lstat)(fsdir), result=result,
+                          skip_ranges=skip_ranges, stats=stats,
+                          xattrs=xattrs)
+    with multiprocessing.Manager() as manager:
+        initargs = (uid_mappings, gid_mappings, nobody, dry_run,
+                    skip_ranges, manager.dict(),
+                    stats.keep_slowest if stats is not None else None,
+                    prune, lstat, xattrs)
+        with futures.ProcessPoolExecutor(max_workers=processes,
+                                         initializer=_init_shift_worker,
+                                         initargs=initargs) as executor:
+            def merge(value):
+                result.merge(value[0])
+                if stats is not None:
+                    stats.merge(value[1])
+                return True
+
+            _schedule(executor, fsdir, _shift_task, processes, merge)
+
+
+def confirm_dir_processes(fsdir, uid_ranges, gid_ranges, nobody,
+                          processes, prune=None, lstat=None):
+    """Confirm fsdir with a pool of worker processes.
+
+    Work is shared out as in shift_dir_processes. A worker that finds an
+    entry outside the ranges sets a shared event, which every other worker
+    checks before listing its next directory, and the parent stops handing
+    out work as soon as that task reports back. prune and lstat are as for
+    shift_dir_processes.
+    """
+    if not idmapshift.confirm_path(fsdir, uid_ranges, gid_ranges, nobody,
+                                   stat=(lstat or os.lstat)(fsdir)):
+        return False
+    initargs = (uid_ranges, gid_ranges, nobody, multiprocessing.Event(),
+                prune, lstat)
+    with futures.ProcessPoolExecutor(max_workers=processes,
+                                     initializer=_init_confirm_worker,
+                                     initargs=initargs) as executor:
+        return _schedule(executor, fsdir, _confirm_task, processes,
+                         lambda ok: ok)
+
+
+def confirm_dir_threads(fsdir, uid_ranges, gid_ranges, nobody, jobs,
+                        prune=None, lstat=None):
+    """Confirm fsdir with a pool of jobs threads.
+
+    Each directory listing is a task, as in shift_dir_threads. The first
+    entry found outside the ranges sets a shared event that every worker
+    checks between entries, so the remaining tasks return straight away
+    and the answer comes back without waiting for the rest of the tree.
+    prune and lstat are as for shift_dir_threads.
+    """
+    if not idmapshift.confirm_path(fsdir, uid_ranges, gid_ranges, nobody,
+                                   stat=(lstat or os.lstat)(fsdir)):
+        return False
+    stop = threading.Event()
+
+    def confirm_listing(dirpath):
+        children = []
+        if stop.is_set():
+            return True, children
+        try:
+            entries = os.scandir(dirpath)
+        except OSError:
+            return True, children
+        with entries:
+            for entry in entries:
+                if stop.is_set():
+                    return True, children
+                stat = idmapshift.lstat_entry(entry, lstat=lstat)
+                if prune is not None and prune(entry.path, stat):
+                    continue
+                if not idmapshift.confirm_path(entry.path, uid_ranges,
+                                               gid_ranges, nobody,
+                                               stat=stat):
+                    stop.set()
+                    return False, children
+                if stat_module.S_ISDIR(stat.st_mode):
+                    children.append(executor.submit(confirm_listing,
+                                                    entry.path))
+        return True, children
+
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = set([executor.submit(confirm_listing, fsdir)])
+        try:
+            while running:
+                done, running = futures.wait(
+                    running, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    ok, children = future.result()
+                    if not ok:
+                        return False
+                    running.update(children)
+        finally:
+            stop.set()
+    return True
@@ -0,0 +1,48 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Read the NUL-delimited path lists find -print0 and friends write."""
+
+import os
+
+CHUNK_SIZE = 1 << 16
+
+
+def read_paths(stream, base=None, chunk_size=CHUNK_SIZE):
+    """Yield the paths in the NUL-delimited binary stream.
+
+    The stream is read chunk_size bytes at a time, so memory use is
+    bounded by the longest path rather than the length of the list. A
+    final path without a trailing NUL is still yielded, empty entries
+    are dropped and, with base, relative paths are joined onto it.
+    """
+    pending = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        parts = (pending + chunk).split(b'\0')
+        pending = parts.pop()
+        for part in parts:
+            if part:
+                yield _resolve(part, base)
+    if pending:
+        yield _resolve(pending, base)
+
+
+def _resolve(raw, base):
+    path = os.fsdecode(raw)
+    if base is not None:
+        path = os.path.join(base, path)
+    return path
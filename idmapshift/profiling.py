@@ -0,0 +1,71 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Profiling for idmapshift --profile."""
+
+import cProfile
+import json
+import time
+
+import idmapshift
+
+# Slowest lstat and chown calls kept for the summary.
+SLOWEST = 25
+
+
+class Profiler(object):
+    """Profiles one CLI run.
+
+    Each phase run through run() is profiled with cProfile and its wall
+    time recorded. stats, a Stats keeping the slowest paths, should be
+    passed to the profiled call so write() can split its wall time into
+    lstat, id lookup, chown and the rest of the traversal. write(path)
+    dumps the cProfile data to path, for pstats or snakeviz, and a JSON
+    summary of the phases and slowest paths to path + '.json'. Only the
+    calling process is profiled; worker processes are only covered by
+    stats.
+    """
+
+    def __init__(self, stats=None):
+        self.profile = cProfile.Profile()
+        self.stats = stats or idmapshift.Stats(SLOWEST)
+        if not self.stats.keep_slowest:
+            self.stats.keep_slowest = SLOWEST
+        self.phases = {}
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def run(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.profile.runcall(func, *args, **kwargs)
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def summary(self):
+        stats = self.stats
+        breakdown = {'lstat': stats.lstat.total_ns / 1e9,
+                     'lookup': stats.lookup_ns / 1e9,
+                     'chown': stats.lchown.total_ns / 1e9}
+        breakdown['traversal'] = max(
+            0.0, stats.wall_ns / 1e9 - sum(breakdown.values()))
+        return {'phases': self.phases, 'breakdown': breakdown,
+                'slowest': stats.as_dict().get('slowest', [])}
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+        with open(path + '.json', 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+            f.write('\n')
@@ -0,0 +1,134 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Leave mount points and excluded subtrees out of a walk.
+
+An exclude pattern without glob characters is a prefix: it names an
+entry by its path relative to the root, and everything beneath it goes
+too. A pattern with glob characters is matched against the whole
+relative path when it holds a slash, or against any single path
+component when it does not, so '*.cache' excludes every directory of
+that name wherever it is. '*', '?' and '[...]' never match a slash.
+"""
+
+import os
+import re
+import threading
+
+GLOB_CHARS = re.compile(r'[*?[]')
+
+
+def glob_to_regex(pattern):
+    """Return a regex, without anchors, for a glob pattern."""
+    parts = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        i += 1
+        if char == '*':
+            parts.append('[^/]*')
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '[':
+            end = pattern.find(']', i + 1 if pattern[i:i + 1] in '!]' else i)
+            if end < 0:
+                parts.append(re.escape(char))
+                continue
+            body = pattern[i:end].replace('\\', '\\\\')
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            parts.append('(?!/)[%s]' % body)
+            i = end + 1
+        else:
+            parts.append(re.escape(char))
+    return ''.join(parts)
+
+
+def compile_excludes(patterns):
+    """Compile exclude patterns into one regex, or None if there are none.
+
+    The regex is searched for in a path relative to the root and matches
+    the excluded entry and everything beneath it.
+    """
+    alternatives = []
+    for pattern in patterns or ():
+        pattern = pattern.strip('/')
+        if not pattern:
+            raise ValueError('Empty exclude pattern')
+        if not GLOB_CHARS.search(pattern):
+            alternatives.append(r'\A%s(?:/|\Z)' % re.escape(pattern))
+        elif '/' in pattern:
+            alternatives.append(r'\A%s(?:/|\Z)' % glob_to_regex(pattern))
+        else:
+            alternatives.append(r'(?:\A|/)%s(?:/|\Z)'
+                                % glob_to_regex(pattern))
+    if not alternatives:
+        return None
+    return re.compile('|'.join(alternatives), re.DOTALL)
+
+
+class Pruner(object):
+    """Decides which entries below fsdir a walk leaves out.
+
+    Called as prune(path, stat) for an entry below fsdir, it returns True
+    if the entry matches one of excludes or, with one_file_system, lives
+    on another device than fsdir, i.e. is a mount point or beneath one.
+    Walkers neither visit a pruned entry nor descend into it. Pruned
+    entries are counted in pruned; copies sent to worker processes start
+    counting afresh.
+    """
+
+    def __init__(self, fsdir, excludes=None, one_file_system=False):
+        self.excludes = tuple(excludes or ())
+        self.one_file_system = one_file_system
+        self.pattern = compile_excludes(self.excludes)
+        self.dev = os.lstat(fsdir).st_dev if one_file_system else None
+        self.root = os.path.join(fsdir, '')
+        self.skip = len(self.root)
+        self.pruned = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, path, stat):
+        if self.dev is not None and stat.st_dev != self.dev:
+            pass
+        elif self.pattern is None:
+            return False
+        elif self.pattern.search(path[self.skip:]) is None:
+            return False
+        with self._lock:
+            self.pruned += 1
+        return True
+
+    def listed(self, path, stat):
+        """Like calling the pruner, for a path that may not be below fsdir.
+
+        Paths outside fsdir are never pruned.
+        """
+        if not path.startswith(self.root):
+            return False
+        return self(path, stat)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['pruned'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def key(self):
+        """Return what a journal or manifest fingerprint should cover."""
+        return (self.excludes, self.one_file_system)
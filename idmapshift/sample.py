@@ -0,0 +1,196 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Confirm a tree from a random sample of its entries.
+
+A sampled confirm looks at a bounded number of entries rather than
+every inode, for admission checks that can accept a probabilistic
+answer. Directories are listed in random order, picked from all those
+found so far, and each listed directory is a stratum: it is checked
+itself and a random subset of its other entries is lstat'ed and
+checked, each standing in for its share of the directory. An entry out
+of range is proof that the tree does not confirm, so the walk stops at
+the first one by default. Otherwise the weighted fraction out of range
+and a one-sided Wilson score upper bound on it are reported. Subtrees
+the walk never reached are not represented, so a passing sample is not
+a substitute for an exact confirm, which can still be run afterwards.
+"""
+
+import math
+import os
+import random
+import stat as stat_module
+
+import idmapshift
+
+
+class SampleResult(object):
+    """What a sampled confirm found.
+
+    checked entries were checked in dirs listed directories, and
+    out_of_range of them were owned by an unmapped id, the first being
+    first_out_of_range. estimate is the fraction of entries out of range,
+    weighting each checked entry by the number of entries it stands in
+    for, and upper_bound bounds it with the given confidence. pruned
+    counts the entries left out by excludes or one_file_system.
+    """
+
+    def __init__(self, confidence):
+        self.confidence = confidence
+        self.checked = 0
+        self.dirs = 0
+        self.out_of_range = 0
+        self.first_out_of_range = None
+        self.pruned = 0
+        self.weight = 0.0
+        self.out_of_range_weight = 0.0
+        self.weight_squares = 0.0
+
+    def add(self, path, in_range, weight):
+        self.checked += 1
+        self.weight += weight
+        self.weight_squares += weight * weight
+        if not in_range:
+            self.out_of_range += 1
+            self.out_of_range_weight += weight
+            if self.first_out_of_range is None:
+                self.first_out_of_range = path
+
+    def confirmed(self):
+        return self.out_of_range == 0
+
+    def estimate(self):
+        if not self.weight:
+            return 0.0
+        return self.out_of_range_weight / self.weight
+
+    def effective_size(self):
+        """Return Kish's effective sample size for the weights."""
+        if not self.weight_squares:
+            return 0.0
+        return self.weight * self.weight / self.weight_squares
+
+    def upper_bound(self):
+        n = self.effective_size()
+        if not n:
+            return 1.0
+        p = self.estimate()
+        z = normal_quantile(self.confidence)
+        z2 = z * z
+        spread = z * math.sqrt(p * (1 - p) / n + z2 / (4 * n * n))
+        return min(1.0, (p + z2 / (2 * n) + spread) / (1 + z2 / n))
+
+
+def per_dir_quota(size):
+    """Return how many entries to check in each listed directory.
+
+    The square root spreads a sample of size entries across about as
+    many directories as it checks entries in each.
+    """
+    return max(1, int(math.sqrt(size)))
+
+
+def normal_quantile(p):
+    """Return the standard normal quantile for probability p.
+
+    Found by bisection on the CDF, as statistics.NormalDist is not in
+    Python 3.7.
+    """
+    low, high = -10.0, 10.0
+    for _ in range(64):
+        mid = (low + high) / 2
+        if (1 + math.erf(mid / math.sqrt(2))) / 2 < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def confirm_sample(fsdir, uid_ranges, gid_ranges, nobody, size,
+                   confidence=0.95, stop_early=True, stats=None, prune=None,
+                   lstat=None, entry_filter=None, rng=None):
+    """Check about size entries of fsdir, chosen at random.
+
+    uid_ranges, gid_ranges and nobody are as for confirm_path. Up to
+    size entries are checked, fsdir first; stats, prune and lstat are as
+    for iter_tree, and entries entry_filter rejects are not checked.
+    With stop_early, the walk stops at the first entry out of range. rng
+    is a random.Random, a fresh one by default. Returns a SampleResult.
+    """
+    if size < 1:
+        raise ValueError('a sample needs at least one entry')
+    if not 0 < confidence < 1:
+        raise ValueError('confidence must be between 0 and 1')
+    if rng is None:
+        rng = random.Random()
+    quota = per_dir_quota(size)
+    result = SampleResult(confidence)
+
+    def check(path, stat, weight):
+        if entry_filter is not None and not entry_filter(path, stat):
+            return True
+        if stats is not None:
+            stats.entries += 1
+        in_range = idmapshift.confirm_path(path, uid_ranges, gid_ranges,
+                                           nobody, stat=stat)
+        result.add(path, in_range, weight)
+        return in_range or not stop_early
+
+    pending = [fsdir]
+    while pending and result.checked < size:
+        index = rng.randrange(len(pending))
+        pending[index], pending[-1] = pending[-1], pending[index]
+        dirpath = pending.pop()
+        try:
+            stat = idmapshift._lstat(dirpath, stats, lstat)
+        except OSError:
+            continue
+        if dirpath != fsdir and prune is not None and prune(dirpath, stat):
+            continue
+        if not check(dirpath, stat, 1.0):
+            return result
+        if not stat_module.S_ISDIR(stat.st_mode):
+            continue
+        try:
+            with os.scandir(dirpath) as entries:
+                others = []
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if is_dir:
+                        pending.append(entry.path)
+                    else:
+                        others.append(entry)
+        except OSError:
+            continue
+        if stats is not None:
+            stats.dirs += 1
+        result.dirs += 1
+        count = min(len(others), quota, size - result.checked)
+        if not count:
+            continue
+        weight = len(others) / count
+        for entry in rng.sample(others, count):
+            try:
+                stat = idmapshift.lstat_entry(entry, stats, lstat)
+            except OSError:
+                continue
+            if prune is not None and prune(entry.path, stat):
+                continue
+            if not check(entry.path, stat, weight):
+                return result
+    return result
@@ -0,0 +1,165 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run statistics: where a shift spends its time."""
+
+import heapq
+import json
+import math
+import time
+
+
+class Latency(object):
+    """Count, total and a histogram of durations in nanoseconds.
+
+    Durations are bucketed on a log scale, BUCKETS_PER_DOUBLING buckets
+    per power of two, so memory stays constant however many are added
+    and percentiles are accurate to within one bucket (about 19%).
+    """
+
+    BUCKETS_PER_DOUBLING = 4
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.buckets = {}
+
+    def add(self, ns):
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        bucket = 0
+        if ns > 0:
+            bucket = int(math.log2(ns) * self.BUCKETS_PER_DOUBLING)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total_ns += other.total_ns
+        self.max_ns = max(self.max_ns, other.max_ns)
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def percentile(self, p):
+        """Return the upper bound, in ns, of the bucket holding p percent."""
+        if not self.count:
+            return 0
+        wanted = self.count * p / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= wanted:
+                break
+        upper = 2 ** ((bucket + 1) / float(self.BUCKETS_PER_DOUBLING))
+        return min(upper, self.max_ns)
+
+    def as_dict(self):
+        mean = self.total_ns / self.count if self.count else 0
+        return {'count': self.count,
+                'total_s': self.total_ns / 1e9,
+                'mean_us': mean / 1e3,
+                'p50_us': self.percentile(50) / 1e3,
+                'p90_us': self.percentile(90) / 1e3,
+                'p99_us': self.percentile(99) / 1e3,
+                'max_us': self.max_ns / 1e3}
+
+
+class Stats(object):
+    """Counters and timings collected by shift_dir and confirm_dir.
+
+    entries counts every inode looked at and dirs every directory listed.
+    chowns counts the chown calls made, and skips the entries left alone
+    because their ownership was already right or they were another link
+    to an inode already shifted. lstat and lchown are Latency histograms
+    of those syscalls; lookup_ns is the time spent in find_target_id and
+    memo_hits/lookups its memo hit rate. pruned counts the entries left
+    out of the walk by idmapshift.prune. wall_ns is the whole run.
+
+    With keep_slowest, that many of the slowest lstat and chown calls are
+    kept in slowest as (ns, path, syscall) tuples, so pathological paths
+    stand out.
+    """
+
+    COUNTERS = ('entries', 'dirs', 'chowns', 'skips', 'pruned', 'lookups',
+                'memo_hits', 'lookup_ns', 'wall_ns')
+
+    def __init__(self, keep_slowest=0):
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+        self.lstat = Latency()
+        self.lchown = Latency()
+        self.keep_slowest = keep_slowest
+        self.slowest = []
+
+    def spawn(self):
+        """Return an empty Stats with the same settings, to merge later."""
+        return Stats(self.keep_slowest)
+
+    def note(self, ns, path, syscall):
+        """Keep path if it is among the slowest seen."""
+        if len(self.slowest) < self.keep_slowest:
+            heapq.heappush(self.slowest, (ns, path, syscall))
+        elif self.slowest and ns > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (ns, path, syscall))
+
+    def merge(self, other):
+        for counter in self.COUNTERS:
+            setattr(self, counter,
+                    getattr(self, counter) + getattr(other, counter))
+        self.lstat.merge(other.lstat)
+        self.lchown.merge(other.lchown)
+        for slow in other.slowest:
+            self.note(*slow)
+
+    def as_dict(self):
+        data = dict((counter, getattr(self, counter))
+                    for counter in self.COUNTERS)
+        data['memo_hit_rate'] = (self.memo_hits / float(self.lookups)
+                                 if self.lookups else 0.0)
+        data['lstat'] = self.lstat.as_dict()
+        data['lchown'] = self.lchown.as_dict()
+        if self.keep_slowest:
+            data['slowest'] = [
+                {'path': path, 'syscall': syscall, 'us': ns / 1e3}
+                for ns, path, syscall in sorted(self.slowest, reverse=True)]
+        return data
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+def lstat_entry(entry, stats=None, lstat=None, dir_fd=None):
+    """Return entry.stat(follow_symlinks=False), timed into stats.
+
+    With lstat, e.g. an idmapshift.statx.Lstat, lstat(entry.path, dir_fd)
+    is returned instead.
+    """
+    if stats is None:
+        if lstat is None:
+            return entry.stat(follow_symlinks=False)
+        return lstat(entry.path, dir_fd)
+    start = time.perf_counter_ns()
+    if lstat is None:
+        stat = entry.stat(follow_symlinks=False)
+    else:
+        stat = lstat(entry.path, dir_fd)
+    elapsed = time.perf_counter_ns() - start
+    stats.lstat.add(elapsed)
+    if stats.keep_slowest:
+        stats.note(elapsed, entry.path, 'lstat')
+    return stat
@@ -0,0 +1,179 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""lstat through Linux statx(2), asking only for the fields we use.
+
+Walks only look at an entry's mode, inode, link count, owner and device.
+On network filesystems such as NFS and CephFS a plain lstat asks for
+every attribute and may cost a round trip to the server to revalidate
+them; statx with a narrow mask lets the client answer from what it
+has, and AT_STATX_DONT_SYNC lets it skip revalidation entirely, at the
+risk of acting on ownership another client changed moments ago.
+
+statx is called through ctypes, from libc when it exports it and as a
+raw syscall otherwise. Where neither works, Lstat falls back to
+os.lstat, so callers never need to check.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import platform
+
+AT_FDCWD = -100
+AT_SYMLINK_NOFOLLOW = 0x100
+AT_STATX_DONT_SYNC = 0x4000
+
+STATX_TYPE = 0x1
+STATX_MODE = 0x2
+STATX_NLINK = 0x4
+STATX_UID = 0x8
+STATX_GID = 0x10
+STATX_INO = 0x100
+# Everything a walk needs; the device number is always filled in.
+MASK = STATX_TYPE | STATX_MODE | STATX_NLINK | STATX_INO
+MASK |= STATX_UID | STATX_GID
+
+SYSCALLS = {'x86_64': 332, 'aarch64': 291, 'ppc64le': 383, 's390x': 379,
+            'i686': 383, 'armv7l': 397}
+
+
+class _Timestamp(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_int64), ('tv_nsec', ctypes.c_uint32),
+                ('reserved', ctypes.c_int32)]
+
+
+class _Statx(ctypes.Structure):
+    _fields_ = [('stx_mask', ctypes.c_uint32),
+                ('stx_blksize', ctypes.c_uint32),
+                ('stx_attributes', ctypes.c_uint64),
+                ('stx_nlink', ctypes.c_uint32),
+                ('stx_uid', ctypes.c_uint32),
+                ('stx_gid', ctypes.c_uint32),
+                ('stx_mode', ctypes.c_uint16),
+                ('spare0', ctypes.c_uint16),
+                ('stx_ino', ctypes.c_uint64),
+                ('stx_size', ctypes.c_uint64),
+                ('stx_blocks', ctypes.c_uint64),
+                ('stx_attributes_mask', ctypes.c_uint64),
+                ('stx_atime', _Timestamp),
+                ('stx_btime', _Timestamp),
+                ('stx_ctime', _Timestamp),
+                ('stx_mtime', _Timestamp),
+                ('stx_rdev_major', ctypes.c_uint32),
+                ('stx_rdev_minor', ctypes.c_uint32),
+                ('stx_dev_major', ctypes.c_uint32),
+                ('stx_dev_minor', ctypes.c_uint32),
+                ('spare2', ctypes.c_uint64 * 14)]
+
+
+class StatxResult(object):
+    """The os.stat_result fields a walk uses, filled in by statx."""
+
+    __slots__ = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid',
+                 'st_gid')
+
+    def __init__(self, buf):
+        self.st_mode = buf.stx_mode
+        self.st_ino = buf.stx_ino
+        self.st_dev = os.makedev(buf.stx_dev_major, buf.stx_dev_minor)
+        self.st_nlink = buf.stx_nlink
+        self.st_uid = buf.stx_uid
+        self.st_gid = buf.stx_gid
+
+
+def _load():
+    if not hasattr(os, 'makedev'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                ctypes.c_uint, ctypes.POINTER(_Statx)]
+    if hasattr(libc, 'statx'):
+        func = libc.statx
+        func.argtypes = argtypes
+        func.restype = ctypes.c_int
+        return func
+    number = SYSCALLS.get(platform.machine())
+    if number is None or not hasattr(libc, 'syscall'):
+        return None
+    syscall = libc.syscall
+    syscall.restype = ctypes.c_long
+
+    def func(dirfd, path, flags, mask, buf):
+        return syscall(ctypes.c_long(number), ctypes.c_int(dirfd),
+                       ctypes.c_char_p(path), ctypes.c_int(flags),
+                       ctypes.c_uint(mask), buf)
+    return func
+
+
+_statx = _load()
+
+
+def available():
+    """Return True if statx can be called here."""
+    return _statx is not None
+
+
+def statx(path, dir_fd=None, dont_sync=False):
+    """Return a StatxResult for path, without following a symlink.
+
+    Raises OSError as os.lstat would. Raises NotImplementedError when
+    statx is unavailable, including when a seccomp filter refuses it.
+    """
+    global _statx
+    if _statx is None:
+        raise NotImplementedError('statx is not available')
+    flags = AT_SYMLINK_NOFOLLOW
+    if dont_sync:
+        flags |= AT_STATX_DONT_SYNC
+    buf = _Statx()
+    dirfd = AT_FDCWD if dir_fd is None else dir_fd
+    if _statx(dirfd, os.fsencode(path), flags, MASK,
+              ctypes.byref(buf)) != 0:
+        err = ctypes.get_errno()
+        if err in (errno.ENOSYS, errno.EPERM):
+            _statx = None
+            raise NotImplementedError('statx is not available')
+        raise OSError(err, os.strerror(err), path)
+    if buf.stx_mask & MASK != MASK:
+        # The filesystem could not supply a field we need.
+        return None
+    return StatxResult(buf)
+
+
+class Lstat(object):
+    """An lstat for walks: statx with MASK, or os.lstat where it can't.
+
+    Called as lstat(path, dir_fd=None) it returns a StatxResult, or an
+    os.stat_result from the fallback, so only the fields StatxResult has
+    may be used. With dont_sync, AT_STATX_DONT_SYNC is passed. Instances
+    pickle, so they can be sent to worker processes.
+    """
+
+    def __init__(self, dont_sync=False):
+        self.dont_sync = dont_sync
+
+    def __call__(self, path, dir_fd=None):
+        if _statx is not None:
+            try:
+                result = statx(path, dir_fd, self.dont_sync)
+            except NotImplementedError:
+                result = None
+            if result is not None:
+                return result
+        return os.lstat(path, dir_fd=dir_fd)
@@ -0,0 +1,89 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shift the ownership recorded in a tar archive without extracting it."""
+
+import tarfile
+
+import idmapshift
+
+
+def shift_tar(src, dst, uid_mappings, gid_mappings, nobody, shifter=None,
+              result=None, verbose=False, printer=None):
+    """Copy the tar stream src to dst with every member's ids shifted.
+
+    src and dst are binary file objects; src may be compressed in any
+    format tarfile can read and dst is an uncompressed PAX archive. Both
+    are streamed and tarfile's member lists are emptied as each member
+    is copied, so only one member header is held at a time and member
+    data is copied straight through. Ids are translated with
+    IdMapShifter.translate, the same lookup shift_dir uses; pass shifter
+    to reuse its warm memos. PAX uid and gid records are rewritten along
+    with the header fields.
+
+    User and group names are cleared, since they name guest accounts and
+    an extractor would otherwise prefer them to the numeric ids. Counts
+    go to result and, with verbose, each member is passed to printer, as
+    for shift_path. Returns result.
+    """
+    if shifter is None:
+        shifter = idmapshift.IdMapShifter(uid_mappings, gid_mappings, nobody)
+    if result is None:
+        result = idmapshift.ShiftResult()
+    source = tarfile.open(fileobj=src, mode='r|*')
+    target = tarfile.open(fileobj=dst, mode='w|', format=tarfile.PAX_FORMAT)
+    try:
+        while True:
+            member = source.next()
+            if member is None:
+                break
+            uid = member.uid
+            gid = member.gid
+            target_uid, target_gid = shifter.translate(uid, gid)
+            member.uid = target_uid
+            member.gid = target_gid
+            member.uname = ''
+            member.gname = ''
+            for key in ('uname', 'gname'):
+                member.pax_headers.pop(key, None)
+            if 'uid' in member.pax_headers:
+                member.pax_headers['uid'] = str(target_uid)
+            if 'gid' in member.pax_headers:
+                member.pax_headers['gid'] = str(target_gid)
+
+            changed = target_uid != uid or target_gid != gid
+            result.visited += 1
+            if changed:
+                result.changed += 1
+            else:
+                result.unchanged += 1
+            if target_uid == nobody != uid or target_gid == nobody != gid:
+                result.mapped_to_nobody += 1
+            if verbose:
+                (printer or idmapshift.print_chown)(
+                    member.name, uid, gid, target_uid, target_gid)
+
+            if member.isreg():
+                target.addfile(member, source.extractfile(member))
+            else:
+                target.addfile(member)
+            # tarfile remembers every member, even in stream mode.
+            del source.members[:]
+            del target.members[:]
+        # Only terminate the archive once every member made it across, so
+        # a failed run leaves a visibly truncated stream behind.
+        target.close()
+    finally:
+        source.close()
+    return result
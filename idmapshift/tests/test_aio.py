@@ -0,0 +1,151 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import idmapshift
+from idmapshift import aio
+from idmapshift import main
+from idmapshift import statx
+from idmapshift.tests.test_idmapshift import BaseTestCase
+from idmapshift.tests.test_idmapshift import dir_stat
+from idmapshift.tests.test_idmapshift import FakeStat
+from idmapshift.tests.test_idmapshift import scandir_side_effect
+from idmapshift.tests.test_parallel import build_tree
+
+
+class AsyncTestCase(BaseTestCase):
+    def setUp(self):
+        patches = [mock.patch('os.lstat'), mock.patch('os.scandir'),
+                   mock.patch('os.lchown')]
+        self.mock_lstat, self.mock_scandir, self.mock_lchown = [
+            patch.start() for patch in patches]
+        for patch in patches:
+            self.addCleanup(patch.stop)
+        self.mock_lstat.return_value = dir_stat(0, 0)
+        self.tree = build_tree(3, 2)
+        self.mock_scandir.side_effect = scandir_side_effect(self.tree)
+        self.total = sum(len(entries) for entries in self.tree.values()) + 1
+
+    def shift(self, **kwargs):
+        return aio.shift_dir_async('/tmp/test', self.uid_maps,
+                                   self.gid_maps, main.NOBODY_ID, **kwargs)
+
+    def test_shift_matches_shift_dir(self):
+        events = []
+        result = asyncio.run(self.shift(progress=events.append,
+                                        batch_size=10))
+        chowns = self.mock_lchown.mock_calls
+
+        self.mock_lchown.reset_mock()
+        self.mock_scandir.side_effect = scandir_side_effect(self.tree)
+        expected = idmapshift.shift_dir('/tmp/test', self.uid_maps,
+                                        self.gid_maps, main.NOBODY_ID)
+        self.assertEqual(expected.as_dict(), result.as_dict())
+        self.assertEqual(self.mock_lchown.mock_calls, chowns)
+
+        self.assertEqual(self.total, result.visited)
+        self.assertEqual(self.total // 10 + 1, len(events))
+        self.assertEqual([False] * (len(events) - 1) + [True],
+                         [event.done for event in events])
+        self.assertEqual(self.total, events[-1].visited)
+        self.assertTrue(events[-1].result is result)
+
+    def test_shift_many_concurrently(self):
+        async def shift_all():
+            return await asyncio.gather(*[self.shift(batch_size=7)
+                                          for i in range(4)])
+
+        results = asyncio.run(shift_all())
+        for result in results:
+            self.assertEqual(self.total, result.visited)
+
+    def test_cancel(self):
+        events = []
+
+        async def shift_and_cancel():
+            task = asyncio.ensure_future(self.shift(
+                progress=lambda event: (events.append(event), task.cancel()),
+                batch_size=5))
+            try:
+                await task
+            except asyncio.CancelledError:
+                return True
+            return False
+
+        self.assertTrue(asyncio.run(shift_and_cancel()))
+        self.assertEqual(1, len(events))
+        # The second batch may already have started when the task is
+        # cancelled, but it stops at its next entry.
+        self.assertTrue(5 <= len(self.mock_lchown.mock_calls) <= 10)
+
+    def test_confirm(self):
+        confirm = aio.confirm_dir_async('/tmp/test', self.uid_maps,
+                                        self.gid_maps, main.NOBODY_ID,
+                                        batch_size=4)
+        self.assertFalse(asyncio.run(confirm))
+
+        self.mock_lstat.return_value = dir_stat(10000, 10000)
+        self.mock_scandir.side_effect = scandir_side_effect({
+            '/tmp/test': [('a', FakeStat(10001, 10001)),
+                          ('b', FakeStat(main.NOBODY_ID, 10000))]})
+        events = []
+        confirm = aio.confirm_dir_async('/tmp/test', self.uid_maps,
+                                        self.gid_maps, main.NOBODY_ID,
+                                        progress=events.append)
+        self.assertTrue(asyncio.run(confirm))
+        self.assertEqual(3, events[-1].visited)
+        self.assertTrue(events[-1].done)
+
+    def test_shift_async_uses_shifter(self):
+        seen = []
+        shifter = idmapshift.IdMapShifter(
+            self.uid_maps, self.gid_maps, main.NOBODY_ID,
+            pre_entry=lambda path, stat: seen.append(path))
+        result = asyncio.run(aio.shift_async(shifter, '/tmp/test',
+                                             batch_size=10))
+        self.assertEqual(self.total, result.visited)
+        self.assertEqual(self.total, len(seen))
+        self.assertEqual(10000, shifter.uid_memo[0])
+
+    def test_shift_idempotent_confirms_first(self):
+        self.mock_lstat.return_value = dir_stat(10000, 10000)
+        self.mock_scandir.side_effect = scandir_side_effect({
+            '/tmp/test': [('a', FakeStat(10001, 10001)),
+                          ('b', FakeStat(main.NOBODY_ID, 10000))]})
+        result = asyncio.run(self.shift(idempotent=True))
+        self.assertEqual(0, result.visited)
+        self.assertFalse(self.mock_lchown.called)
+
+
+@unittest.skipUnless(statx.available(), 'statx is not available')
+class AsyncStatxTestCase(BaseTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        for name in ('a', 'b'):
+            open(os.path.join(self.tmp, name), 'w').close()
+
+    def test_shift_statx(self):
+        stats = idmapshift.Stats()
+        result = asyncio.run(aio.shift_dir_async(
+            self.tmp, self.uid_maps, self.gid_maps, main.NOBODY_ID,
+            dry_run=True, stats=stats, statx=True))
+        self.assertEqual(3, result.visited)
+        self.assertEqual(2, stats.lstat.count)
@@ -0,0 +1,148 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import idmapshift
+from idmapshift import batch
+from idmapshift import main
+from idmapshift import statx
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.roots = []
+        for i in range(3):
+            root = os.path.join(self.tmp, 'c%d' % i)
+            for sub in ('a', 'a/b', 'c'):
+                os.makedirs(os.path.join(root, sub))
+                open(os.path.join(root, sub, 'f'), 'w').close()
+            self.roots.append(root)
+        self.spec = [{'path': self.roots[0], 'uid': '0:10000:2000',
+                      'gid': '0:10000:2000'},
+                     {'path': self.roots[1], 'uid': [[0, 20000, 2000]],
+                      'gid': [[0, 20000, 2000]], 'nobody': 1},
+                     {'path': self.roots[2], 'uid': '0:10000:2000',
+                      'gid': '0:10000:2000'}]
+        self.spec_path = os.path.join(self.tmp, 'spec.json')
+        self.write_spec()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_spec(self):
+        with open(self.spec_path, 'w') as f:
+            json.dump(self.spec, f)
+
+    def test_load_spec_shares_maps(self):
+        trees = batch.load_spec(self.spec_path)
+        self.assertEqual(self.roots, [tree.path for tree in trees])
+        self.assertTrue(trees[0].uid_mappings is trees[2].uid_mappings)
+        self.assertTrue(trees[0].uid_memo is trees[2].uid_memo)
+        self.assertTrue(trees[0].uid_memo is trees[0].gid_memo)
+        self.assertFalse(trees[0].uid_memo is trees[1].uid_memo)
+        self.assertEqual(1, trees[1].nobody)
+        self.assertEqual(main.NOBODY_ID, trees[0].nobody)
+
+    def test_load_spec_invalid(self):
+        self.spec[1]['uid'] = '0:1'
+        self.write_spec()
+        self.assertRaises(ValueError, batch.load_spec, self.spec_path)
+        del self.spec[1]['uid']
+        self.write_spec()
+        self.assertRaises(ValueError, batch.load_spec, self.spec_path)
+        self.spec[1] = '/tmp/x'
+        self.write_spec()
+        self.assertRaises(ValueError, batch.load_spec, self.spec_path)
+
+    @mock.patch('os.lchown')
+    def test_shift_trees(self, mock_lchown):
+        trees = batch.shift_trees(batch.load_spec(self.spec_path), jobs=3)
+        owners = dict((call[1][0], call[1][1:]) for call in
+                      mock_lchown.mock_calls)
+        uid = os.getuid()
+        for root, host in zip(self.roots, (10000, 20000, 10000)):
+            self.assertEqual((uid + host, os.getgid() + host),
+                             owners[os.path.join(root, 'a', 'b', 'f')])
+            self.assertEqual((uid + host, os.getgid() + host), owners[root])
+        for tree in trees:
+            self.assertEqual(None, tree.error)
+            self.assertEqual(7, tree.result.visited)
+
+    @unittest.skipUnless(statx.available(), 'statx is not available')
+    @mock.patch('os.lchown')
+    def test_shift_trees_statx(self, mock_lchown):
+        stats = idmapshift.Stats()
+        trees = batch.shift_trees(batch.load_spec(self.spec_path), jobs=2,
+                                  stats=stats, statx=True, dont_sync=True)
+        for tree in trees:
+            self.assertEqual(None, tree.error)
+            self.assertEqual(7, tree.result.visited)
+        self.assertEqual(21, len(mock_lchown.mock_calls))
+        self.assertEqual(18, stats.lstat.count)
+
+    @mock.patch('os.lchown')
+    def test_failed_tree_does_not_stop_batch(self, mock_lchown):
+        self.spec[1]['path'] = os.path.join(self.tmp, 'missing')
+        self.write_spec()
+        trees = batch.shift_trees(batch.load_spec(self.spec_path), jobs=2)
+        self.assertTrue(isinstance(trees[1].error, OSError))
+        self.assertEqual(7, trees[0].result.visited)
+        self.assertEqual(7, trees[2].result.visited)
+        self.assertEqual(14, len(mock_lchown.mock_calls))
+
+    @mock.patch('os.lchown')
+    def test_idempotent_skips_shifted_tree(self, mock_lchown):
+        # The caller's own ids, mapped onto themselves, already confirm.
+        self.spec[1]['uid'] = [[os.getuid(), os.getuid(), 1]]
+        self.spec[1]['gid'] = [[os.getgid(), os.getgid(), 1]]
+        self.write_spec()
+        trees = batch.shift_trees(batch.load_spec(self.spec_path), jobs=2,
+                                  idempotent=True)
+        self.assertEqual([7, 0, 7], [tree.result.visited for tree in trees])
+        self.assertEqual(14, len(mock_lchown.mock_calls))
+
+    @mock.patch('os.lchown')
+    def test_main_batch(self, mock_lchown):
+        argv = ['idmapshift', '--batch', self.spec_path, '-j', '2']
+        if statx.available():
+            argv.append('--statx')
+        with mock.patch('sys.argv', argv):
+            try:
+                main.main()
+            except SystemExit as sys_exit:
+                self.assertEqual(0, sys_exit.code)
+        self.assertEqual(21, len(mock_lchown.mock_calls))
+
+        self.spec[0]['path'] = os.path.join(self.tmp, 'missing')
+        self.write_spec()
+        with mock.patch('sys.argv', argv), mock.patch('sys.stderr'):
+            try:
+                main.main()
+            except SystemExit as sys_exit:
+                self.assertEqual(1, sys_exit.code)
+
+    def test_main_batch_rejects_path(self):
+        argv = ['idmapshift', '--batch', self.spec_path, self.roots[0]]
+        with mock.patch('sys.argv', argv), mock.patch('sys.stderr'):
+            try:
+                main.main()
+            except SystemExit as sys_exit:
+                self.assertEqual(2, sys_exit.code)
@@ -0,0 +1,89 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from idmapshift import bench
+
+
+class BenchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def count(self, root):
+        return 1 + sum(len(dirs) + len(files)
+                       for _, dirs, files in os.walk(root))
+
+    def test_generate_tree_shapes(self):
+        for shape in bench.SHAPES:
+            root = os.path.join(self.tmp, shape)
+            count = bench.generate_tree(root, shape, 500)
+            self.assertTrue(500 <= count < 510, (shape, count))
+            self.assertEqual(count, self.count(root), shape)
+
+    def test_generate_tree_is_reproducible(self):
+        first = os.path.join(self.tmp, 'first')
+        second = os.path.join(self.tmp, 'second')
+        bench.generate_tree(first, 'mixed', 300, seed=4)
+        bench.generate_tree(second, 'mixed', 300, seed=4)
+        listing = [sorted(os.path.relpath(os.path.join(d, n), root)
+                          for d, dirs, files in os.walk(root)
+                          for n in dirs + files)
+                   for root in (first, second)]
+        self.assertEqual(listing[0], listing[1])
+
+    def test_hardlink_farm(self):
+        root = os.path.join(self.tmp, 'links')
+        bench.generate_tree(root, 'hardlinks', 100)
+        self.assertEqual(4, os.lstat(os.path.join(root, 'd2', 'f3')).st_nlink)
+
+    @mock.patch('idmapshift.bench.can_chown', return_value=False)
+    def test_unprivileged_run(self, mock_can_chown):
+        results = bench.run_benchmarks(self.tmp, shapes=['wide'], size=50,
+                                       engines=['serial', 'fd', 'statx'],
+                                       repeat=1)
+        self.assertEqual([('dry-run', 'serial'), ('dry-run', 'fd'),
+                          ('dry-run', 'statx'), ('confirm', 'serial'),
+                          ('confirm', 'statx')],
+                         [(r['op'], r['engine']) for r in results])
+        for result in results:
+            self.assertEqual(50, result['entries'])
+            self.assertTrue(result['entries_per_sec'] > 0)
+
+    @mock.patch('idmapshift.bench.can_chown', return_value=False)
+    @mock.patch('sys.stdout')
+    def test_main_output_and_compare(self, mock_stdout, mock_can_chown):
+        output = os.path.join(self.tmp, 'results.json')
+        args = ['--dir', self.tmp, '--size', '30', '--repeat', '1',
+                '--shapes', 'wide,deep', '--engines', 'serial',
+                '--ops', 'confirm']
+        bench.main(args + ['--output', output, '--label', 'abc'])
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual('abc', report['label'])
+        self.assertEqual(2, len(report['results']))
+
+        mock_stdout.reset_mock()
+        bench.main(args + ['--compare', output])
+        written = mock_stdout.write.call_args[0][0]
+        self.assertEqual(2, written.count('%'))
+        self.assertEqual(['results.json'], os.listdir(self.tmp))
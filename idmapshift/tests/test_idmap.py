@@ -0,0 +1,215 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import random
+import unittest
+
+import idmapshift
+from idmapshift import idmap
+from idmapshift import main
+
+
+def random_mappings(rand, ranges):
+    mappings = []
+    guest = host = 0
+    for i in range(ranges):
+        guest += rand.randint(0, 100)
+        host += rand.randint(0, 100)
+        count = rand.randint(1, 100)
+        mappings.append((guest, host, count))
+        guest += count
+        host += count
+    rand.shuffle(mappings)
+    return mappings, guest
+
+
+class IdMapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.id_map = idmapshift.IdMap([(10, 20000, 1000), (0, 10000, 10)])
+
+    def test_iter_sorted(self):
+        self.assertEqual([(0, 10000, 10), (10, 20000, 1000)],
+                         list(self.id_map))
+        self.assertEqual(2, len(self.id_map))
+
+    def test_lookup(self):
+        self.assertEqual(10000, self.id_map.lookup(0))
+        self.assertEqual(10009, self.id_map.lookup(9))
+        self.assertEqual(20000, self.id_map.lookup(10))
+        self.assertEqual(20999, self.id_map.lookup(1009))
+
+    def test_lookup_default(self):
+        self.assertEqual(None, self.id_map.lookup(1010))
+        self.assertEqual(main.NOBODY_ID,
+                         self.id_map.lookup(-1, main.NOBODY_ID))
+
+    def test_reverse_lookup(self):
+        self.assertEqual(0, self.id_map.reverse_lookup(10000))
+        self.assertEqual(1009, self.id_map.reverse_lookup(20999))
+        self.assertEqual(None, self.id_map.reverse_lookup(10010))
+        self.assertEqual(None, self.id_map.reverse_lookup(9999))
+
+    def test_contains_host(self):
+        self.assertTrue(self.id_map.contains_host(10005))
+        self.assertFalse(self.id_map.contains_host(21000))
+
+    def test_rejects_guest_overlap(self):
+        self.assertRaises(ValueError, idmapshift.IdMap,
+                          [(0, 10000, 10), (5, 20000, 10)])
+
+    def test_rejects_host_overlap(self):
+        self.assertRaises(ValueError, idmapshift.IdMap,
+                          [(0, 10000, 10), (100, 10009, 10)])
+
+    def test_rejects_empty_range(self):
+        self.assertRaises(ValueError, idmapshift.IdMap, [(0, 10000, 0)])
+
+    def test_adjacent_ranges(self):
+        id_map = idmapshift.IdMap([(0, 10000, 10), (10, 10010, 10)])
+        self.assertEqual(10010, id_map.lookup(10))
+
+    def test_matches_linear_find_target_id(self):
+        mappings, guest = random_mappings(random.Random(1), 50)
+        id_map = idmapshift.IdMap(mappings)
+
+        for fsid in range(guest + 10):
+            self.assertEqual(
+                idmapshift.find_target_id(fsid, mappings, main.NOBODY_ID,
+                                          dict()),
+                idmapshift.find_target_id(fsid, id_map, main.NOBODY_ID,
+                                          dict()))
+
+
+class LookupManyTestCase(unittest.TestCase):
+    def check_against_find_target_id(self):
+        rand = random.Random(2)
+        for trial in range(20):
+            mappings, top = random_mappings(rand, rand.randint(0, 20))
+            fsids = [rand.randint(0, top + 10) for i in range(500)]
+            expected = [idmapshift.find_target_id(fsid, mappings,
+                                                  main.NOBODY_ID, dict())
+                        for fsid in fsids]
+            self.assertEqual(expected,
+                             idmapshift.find_target_ids(fsids, mappings,
+                                                        main.NOBODY_ID))
+
+    @unittest.skipIf(idmap.numpy is None, 'NumPy is not installed')
+    def test_lookup_many_numpy(self):
+        self.check_against_find_target_id()
+
+    def test_lookup_many_pure_python(self):
+        with mock.patch.object(idmap, 'numpy', None):
+            self.check_against_find_target_id()
+
+    @unittest.skipIf(idmap.numpy is None, 'NumPy is not installed')
+    def test_lookup_many_ndarray(self):
+        id_map = idmapshift.IdMap([(0, 10000, 10)])
+        mapped = id_map.lookup_many(idmap.numpy.array([0, 9, 10]),
+                                    main.NOBODY_ID)
+        self.assertTrue(isinstance(mapped, idmap.numpy.ndarray))
+        self.assertEqual([10000, 10009, main.NOBODY_ID], mapped.tolist())
+
+    def test_lookup_many_empty_map(self):
+        id_map = idmapshift.IdMap([])
+        self.assertEqual([main.NOBODY_ID] * 2,
+                         id_map.lookup_many([0, 1], main.NOBODY_ID))
+
+
+class HostIdSetTestCase(unittest.TestCase):
+    def test_contains(self):
+        allowed = idmapshift.HostIdSet([(10000, 10009), (20000, 20999)],
+                                       [main.NOBODY_ID])
+        for host_id in (10000, 10009, 20000, 20500, 20999, main.NOBODY_ID):
+            self.assertTrue(host_id in allowed)
+        for host_id in (0, 9999, 10010, 19999, 21000, main.NOBODY_ID + 1):
+            self.assertFalse(host_id in allowed)
+
+    def test_matches_ranges(self):
+        rand = random.Random(3)
+        for trial in range(20):
+            ranges = []
+            for i in range(rand.randint(1, 10)):
+                first = rand.randint(0, 2000)
+                ranges.append((first, first + rand.randint(0, 50)))
+            allowed = idmapshift.HostIdSet(ranges)
+            for host_id in range(-5, 2100):
+                expected = any(first <= host_id <= last
+                               for first, last in ranges)
+                self.assertEqual(expected, host_id in allowed)
+
+    def test_wide_span_falls_back(self):
+        allowed = idmapshift.HostIdSet([(0, 9), (1 << 31, (1 << 31) + 9)])
+        self.assertEqual(None, allowed._bits)
+        self.assertTrue(5 in allowed)
+        self.assertTrue((1 << 31) + 9 in allowed)
+        self.assertFalse(10 in allowed)
+        self.assertFalse((1 << 31) + 10 in allowed)
+
+    def test_nobody_kept_out_of_span(self):
+        ranges = [(200000000, 200000009), (200065536, 200065545)]
+        allowed = idmapshift.HostIdSet(ranges, [main.NOBODY_ID])
+        self.assertNotEqual(None, allowed._bits)
+        self.assertEqual((65546 + 7) // 8, len(allowed._bits))
+        self.assertTrue(main.NOBODY_ID in allowed)
+        self.assertTrue(200065545 in allowed)
+        self.assertFalse(main.NOBODY_ID + 1 in allowed)
+        self.assertFalse(200000010 in allowed)
+
+    def test_single_wide_range(self):
+        allowed = idmapshift.HostIdSet([(1000000, 1000999999)],
+                                       [main.NOBODY_ID])
+        self.assertEqual(None, allowed._bits)
+        for host_id in (1000000, 500000000, 1000999999, main.NOBODY_ID):
+            self.assertTrue(host_id in allowed)
+        for host_id in (999999, 1001000000, main.NOBODY_ID - 1):
+            self.assertFalse(host_id in allowed)
+
+    def test_empty(self):
+        self.assertFalse(0 in idmapshift.HostIdSet([]))
+        self.assertTrue(7 in idmapshift.HostIdSet([], [7]))
+
+    def test_equality_merges_ranges(self):
+        self.assertEqual(idmapshift.HostIdSet([(0, 4), (5, 9)]),
+                         idmapshift.HostIdSet([(0, 9)]))
+        self.assertEqual(idmapshift.HostIdSet([(0, 9)], [5]),
+                         idmapshift.HostIdSet([(0, 9)]))
+        self.assertNotEqual(idmapshift.HostIdSet([(0, 9)], [50]),
+                            idmapshift.HostIdSet([(0, 9)]))
+
+
+class ComposeMapsTestCase(unittest.TestCase):
+    def test_compose(self):
+        src = [(0, 100000, 65536)]
+        dst = [(0, 200000, 1000), (1000, 300000, 64536)]
+        composed = idmapshift.compose_maps(src, dst)
+        self.assertEqual([(100000, 200000, 1000), (101000, 300000, 64536)],
+                         list(composed))
+
+    def test_compose_matches_two_passes(self):
+        rand = random.Random(5)
+        for trial in range(20):
+            src, src_top = random_mappings(rand, rand.randint(0, 10))
+            dst, dst_top = random_mappings(rand, rand.randint(0, 10))
+            src_map = idmapshift.IdMap(src)
+            dst_map = idmapshift.IdMap(dst)
+            composed = idmapshift.compose_maps(src, dst)
+            top = max(t + c for s, t, c in src + [(0, 0, 0)])
+            for host_id in range(top + 10):
+                guest_id = src_map.reverse_lookup(host_id)
+                expected = main.NOBODY_ID
+                if guest_id is not None:
+                    expected = dst_map.lookup(guest_id, main.NOBODY_ID)
+                self.assertEqual(expected,
+                                 composed.lookup(host_id, main.NOBODY_ID))
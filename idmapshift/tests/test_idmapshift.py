@@ -14,6 +14,10 @@
 
 import argparse
 import mock
+import os
+import shutil
+import stat
+import tempfile
 import unittest
 
 import idmapshift
@@ -29,9 +33,49 @@ def join_side_effect(root, *args):
 
 
 class FakeStat(object):
-    def __init__(self, uid, gid):
+    def __init__(self, uid, gid, mode=stat.S_IFREG, ino=0, nlink=1):
         self.st_uid = uid
         self.st_gid = gid
+        self.st_mode = mode
+        self.st_dev = 1
+        self.st_ino = ino
+        self.st_nlink = nlink
+
+
+class FakeDirEntry(object):
+    def __init__(self, root, name, stat):
+        self.name = name
+        self.path = join_side_effect(root, name)
+        self._stat = stat
+
+    def stat(self, follow_symlinks=True):
+        return self._stat
+
+
+class FakeScandir(object):
+    def __init__(self, entries):
+        self.entries = entries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        return iter(self.entries)
+
+
+def scandir_side_effect(tree):
+    """Build an os.scandir replacement from {dir: [(name, stat), ...]}."""
+    def scandir(path):
+        return FakeScandir([FakeDirEntry(path, name, st)
+                            for name, st in tree.get(path, [])])
+    return scandir
+
+
+def dir_stat(uid, gid):
+    return FakeStat(uid, gid, mode=stat.S_IFDIR)
 
 
 class BaseTestCase(unittest.TestCase):
@@ -129,54 +173,417 @@ class ShiftPathTestCase(BaseTestCase):
         mock_lchown.assert_has_calls([mock.call('/test/path', 10000, 10000)])
 
 
+class IterTreeTestCase(BaseTestCase):
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_iter_tree(self, mock_lstat, mock_scandir):
+        root_stat = dir_stat(0, 0)
+        a_stat = dir_stat(0, 0)
+        b_stat = FakeStat(0, 0)
+        c_stat = FakeStat(1, 1)
+        mock_lstat.return_value = root_stat
+        mock_scandir.side_effect = scandir_side_effect({
+            '/tmp/test': [('a', a_stat), ('b', b_stat)],
+            '/tmp/test/a': [('c', c_stat)],
+        })
+
+        result = list(idmapshift.iter_tree('/tmp/test'))
+
+        self.assertEqual([('/tmp/test', root_stat),
+                          ('/tmp/test/a', a_stat),
+                          ('/tmp/test/b', b_stat),
+                          ('/tmp/test/a/c', c_stat)], result)
+        mock_lstat.assert_has_calls([mock.call('/tmp/test')])
+        self.assertEqual(1, len(mock_lstat.mock_calls))
+        mock_scandir.assert_has_calls([mock.call('/tmp/test'),
+                                       mock.call('/tmp/test/a')])
+
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_iter_tree_lists_siblings_in_order(self, mock_lstat,
+                                               mock_scandir):
+        mock_lstat.return_value = dir_stat(0, 0)
+        mock_scandir.side_effect = scandir_side_effect({
+            '/': [('a', dir_stat(0, 0)), ('b', dir_stat(0, 0))],
+            '/a': [('1', FakeStat(0, 0))],
+            '/b': [('2', FakeStat(0, 0))],
+        })
+
+        paths = [path for path, st in idmapshift.iter_tree('/')]
+
+        self.assertEqual(['/', '/a', '/b', '/a/1', '/b/2'], paths)
+
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_iter_tree_skips_unreadable_dir(self, mock_lstat, mock_scandir):
+        mock_lstat.return_value = dir_stat(0, 0)
+        tree = {'/': [('a', dir_stat(0, 0)), ('b', FakeStat(0, 0))]}
+
+        def scandir(path):
+            if path == '/a':
+                raise OSError('Permission denied')
+            return scandir_side_effect(tree)(path)
+
+        mock_scandir.side_effect = scandir
+
+        paths = [path for path, st in idmapshift.iter_tree('/')]
+
+        self.assertEqual(['/', '/a', '/b'], paths)
+
+
+class IterTreeFdTestCase(BaseTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'a', 'b'))
+        open(os.path.join(self.root, 'a', 'f'), 'w').close()
+        os.symlink('a', os.path.join(self.root, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def open_fds(self):
+        return len(os.listdir('/proc/self/fd'))
+
+    def test_iter_tree_fd(self):
+        seen = []
+        for path, st, dir_fd, name in idmapshift.iter_tree_fd(self.root):
+            if dir_fd is None:
+                self.assertEqual(self.root, path)
+            else:
+                fd_stat = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+                self.assertEqual(st.st_ino, fd_stat.st_ino)
+                self.assertEqual(os.path.basename(path), name)
+            seen.append(os.path.relpath(path, self.root))
+
+        self.assertEqual(['.', 'a', 'a/b', 'a/f', 'link'], sorted(seen))
+
+    def test_iter_tree_fd_closes_fds(self):
+        before = self.open_fds()
+        list(idmapshift.iter_tree_fd(self.root))
+        self.assertEqual(before, self.open_fds())
+
+    def test_iter_tree_fd_closes_fds_on_early_exit(self):
+        before = self.open_fds()
+        walk = idmapshift.iter_tree_fd(self.root)
+        next(walk)
+        next(walk)
+        walk.close()
+        self.assertEqual(before, self.open_fds())
+
+
+class ShiftPathResultTestCase(BaseTestCase):
+    @mock.patch('os.lchown')
+    @mock.patch('os.lstat')
+    def test_shift_path_changed(self, mock_lstat, mock_lchown):
+        mock_lstat.return_value = FakeStat(0, 0)
+        result = idmapshift.ShiftResult()
+        changed = idmapshift.shift_path('/test/path', self.uid_maps,
+                                        self.gid_maps, main.NOBODY_ID,
+                                        dict(), dict(), result=result)
+        self.assertTrue(changed)
+        self.assertEqual(dict(visited=1, changed=1, unchanged=0,
+                              mapped_to_nobody=0, hardlinks_skipped=0,
+                              pruned=0, xattrs_shifted=0, missing=0),
+                         result.as_dict())
+
+    @mock.patch('os.lchown')
+    @mock.patch('os.lstat')
+    def test_shift_path_unchanged_skips_lchown(self, mock_lstat,
+                                               mock_lchown):
+        uid_maps = [(0, 0, 10)]
+        mock_lstat.return_value = FakeStat(5, 5)
+        result = idmapshift.ShiftResult()
+        changed = idmapshift.shift_path('/test/path', uid_maps, uid_maps,
+                                        main.NOBODY_ID, dict(), dict(),
+                                        result=result)
+        self.assertFalse(changed)
+        self.assertEqual(0, len(mock_lchown.mock_calls))
+        self.assertEqual(dict(visited=1, changed=0, unchanged=1,
+                              mapped_to_nobody=0, hardlinks_skipped=0,
+                              pruned=0, xattrs_shifted=0, missing=0),
+                         result.as_dict())
+
+    @mock.patch('os.lchown')
+    @mock.patch('os.lstat')
+    def test_shift_path_mapped_to_nobody(self, mock_lstat, mock_lchown):
+        mock_lstat.return_value = FakeStat(30000, 0)
+        result = idmapshift.ShiftResult()
+        idmapshift.shift_path('/test/path', self.uid_maps, self.gid_maps,
+                              main.NOBODY_ID, dict(), dict(), result=result)
+        mock_lchown.assert_has_calls([mock.call('/test/path',
+                                                main.NOBODY_ID, 10000)])
+        self.assertEqual(1, result.mapped_to_nobody)
+
+    @mock.patch('os.lchown')
+    @mock.patch('os.lstat')
+    def test_shift_path_skip_ranges(self, mock_lstat, mock_lchown):
+        mock_lstat.return_value = FakeStat(10000, 20090)
+        skip_ranges = (idmapshift.get_ranges(self.uid_maps),
+                       idmapshift.get_ranges(self.gid_maps))
+        result = idmapshift.ShiftResult()
+        changed = idmapshift.shift_path('/test/path', self.uid_maps,
+                                        self.gid_maps, main.NOBODY_ID,
+                                        dict(), dict(), result=result,
+                                        skip_ranges=skip_ranges)
+        self.assertFalse(changed)
+        self.assertEqual(0, len(mock_lchown.mock_calls))
+        self.assertEqual(1, result.unchanged)
+
+
+@unittest.skipUnless(os.geteuid() == 0, 'requires root to chown')
+class IdempotentShiftTestCase(unittest.TestCase):
+    """A real tree shifted twice by 0:100000:65536, as by --idempotent."""
+
+    MAPS = [(0, 100000, 65536)]
+    OWNERS = {'a': 0, 'b': main.NOBODY_ID, 'c': 70000, 'd': 0,
+              'd/e': main.NOBODY_ID, 'd/f': 70000}
+    SHIFTED = {'': 100000, 'a': 100000, 'b': 165534, 'c': main.NOBODY_ID,
+               'd': 100000, 'd/e': 165534, 'd/f': main.NOBODY_ID}
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.root = os.path.join(self.tmp, 'root')
+
+    def make_tree(self):
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        os.mkdir(self.root)
+        os.lchown(self.root, 0, 0)
+        for name in sorted(self.OWNERS):
+            path = os.path.join(self.root, name)
+            if name == 'd':
+                os.mkdir(path)
+            else:
+                open(path, 'w').close()
+            os.lchown(path, self.OWNERS[name], self.OWNERS[name])
+
+    def owners(self):
+        owners = {}
+        for name in [''] + list(self.OWNERS):
+            st = os.lstat(os.path.join(self.root, name))
+            self.assertEqual(st.st_uid, st.st_gid)
+            owners[name] = st.st_uid
+        return owners
+
+    def shift(self, **kwargs):
+        return idmapshift.shift_dir(self.root, self.MAPS, self.MAPS,
+                                    main.NOBODY_ID, idempotent=True,
+                                    **kwargs)
+
+    def test_second_shift_changes_nothing(self):
+        manifest = os.path.join(self.tmp, 'manifest')
+        for engine in [dict(), dict(fd_relative=True), dict(jobs=2),
+                       dict(processes=2), dict(manifest=manifest)]:
+            self.make_tree()
+            self.assertEqual(7, self.shift(**engine).changed)
+            self.assertEqual(self.SHIFTED, self.owners())
+            self.assertEqual(0, self.shift(**engine).changed)
+            self.assertEqual(self.SHIFTED, self.owners())
+
+    def test_partial_shift_is_finished(self):
+        self.make_tree()
+        self.shift()
+        path = os.path.join(self.root, 'd', 'g')
+        open(path, 'w').close()
+        os.lchown(path, 0, 0)
+        self.shift()
+        self.assertEqual(100000, os.lstat(path).st_uid)
+        # The tree needed shifting, so host nobody is taken to be the
+        # guest's and shifted; everything else already shifted stays.
+        owners = self.owners()
+        for name in ('', 'a', 'b', 'd', 'd/e'):
+            self.assertEqual(self.SHIFTED[name], owners[name])
+
+
 class ShiftDirTestCase(BaseTestCase):
+    def setUp(self):
+        self.stats = {
+            '/': dir_stat(0, 0),
+            'a': dir_stat(0, 0),
+            'b': dir_stat(0, 0),
+            'c': FakeStat(0, 0),
+            'd': FakeStat(0, 0),
+        }
+        self.tree = {
+            '/': [(x, self.stats[x]) for x in ['a', 'b', 'c', 'd']],
+        }
+
     @mock.patch('idmapshift.shift_path')
-    @mock.patch('os.path.join')
-    @mock.patch('os.walk')
-    def test_shift_dir(self, mock_walk, mock_join, mock_shift_path):
-        mock_walk.return_value = [('/', ['a', 'b'], ['c', 'd'])]
-        mock_join.side_effect = join_side_effect
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_shift_dir(self, mock_lstat, mock_scandir, mock_shift_path):
+        mock_lstat.return_value = self.stats['/']
+        mock_scandir.side_effect = scandir_side_effect(self.tree)
 
         idmapshift.shift_dir('/', self.uid_maps, self.gid_maps, main.NOBODY_ID)
 
         files = ['a', 'b', 'c', 'd']
-        mock_walk.assert_has_calls([mock.call('/')])
-        mock_join_calls = [mock.call('/', x) for x in files]
-        mock_join.assert_has_calls(mock_join_calls)
+        mock_scandir.assert_has_calls([mock.call('/'), mock.call('/a'),
+                                       mock.call('/b')])
 
-        args = (self.uid_maps, self.gid_maps, main.NOBODY_ID)
+        args = (idmapshift.IdMap(self.uid_maps),
+                idmapshift.IdMap(self.gid_maps), main.NOBODY_ID)
         kwargs = dict(dry_run=False, verbose=False,
-                      uid_memo=dict(), gid_memo=dict())
-        shift_path_calls = [mock.call('/', *args, **kwargs)]
-        shift_path_calls += [mock.call('/' + x, *args, **kwargs)
+                      uid_memo=dict(), gid_memo=dict(),
+                      result=mock.ANY, skip_ranges=None,
+                      hardlinks=mock.ANY, stats=None, printer=None,
+                      pre_entry=None, post_entry=None, entry_filter=None,
+                      xattrs=False)
+        shift_path_calls = [mock.call('/', *args, stat=self.stats['/'],
+                                      **kwargs)]
+        shift_path_calls += [mock.call('/' + x, *args, stat=self.stats[x],
+                                       **kwargs)
                              for x in files]
         mock_shift_path.assert_has_calls(shift_path_calls)
 
     @mock.patch('idmapshift.shift_path')
-    @mock.patch('os.path.join')
-    @mock.patch('os.walk')
-    def test_shift_dir_dry_run(self, mock_walk, mock_join, mock_shift_path):
-        mock_walk.return_value = [('/', ['a', 'b'], ['c', 'd'])]
-        mock_join.side_effect = join_side_effect
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_shift_dir_dry_run(self, mock_lstat, mock_scandir,
+                               mock_shift_path):
+        mock_lstat.return_value = self.stats['/']
+        mock_scandir.side_effect = scandir_side_effect(self.tree)
 
         idmapshift.shift_dir('/', self.uid_maps, self.gid_maps, main.NOBODY_ID,
                              dry_run=True)
 
-        mock_walk.assert_has_calls([mock.call('/')])
-
         files = ['a', 'b', 'c', 'd']
-        mock_join_calls = [mock.call('/', x) for x in files]
-        mock_join.assert_has_calls(mock_join_calls)
-
-        args = (self.uid_maps, self.gid_maps, main.NOBODY_ID)
+        args = (idmapshift.IdMap(self.uid_maps),
+                idmapshift.IdMap(self.gid_maps), main.NOBODY_ID)
         kwargs = dict(dry_run=True, verbose=False,
-                      uid_memo=dict(), gid_memo=dict())
-        shift_path_calls = [mock.call('/', *args, **kwargs)]
-        shift_path_calls += [mock.call('/' + x, *args, **kwargs)
+                      uid_memo=dict(), gid_memo=dict(),
+                      result=mock.ANY, skip_ranges=None,
+                      hardlinks=mock.ANY, stats=None, printer=None,
+                      pre_entry=None, post_entry=None, entry_filter=None,
+                      xattrs=False)
+        shift_path_calls = [mock.call('/', *args, stat=self.stats['/'],
+                                      **kwargs)]
+        shift_path_calls += [mock.call('/' + x, *args, stat=self.stats[x],
+                                       **kwargs)
                              for x in files]
         mock_shift_path.assert_has_calls(shift_path_calls)
 
 
+class ShiftDirFdRelativeTestCase(BaseTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'a'))
+        os.symlink('missing', os.path.join(self.root, 'a', 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    @mock.patch('os.lchown')
+    @mock.patch('os.chown')
+    def test_shift_dir_fd_relative(self, mock_chown, mock_lchown):
+        uid = os.lstat(self.root).st_uid
+        gid = os.lstat(self.root).st_gid
+        target_uid = idmapshift.find_target_id(uid, self.uid_maps,
+                                               main.NOBODY_ID, dict())
+        target_gid = idmapshift.find_target_id(gid, self.gid_maps,
+                                               main.NOBODY_ID, dict())
+
+        idmapshift.shift_dir(self.root, self.uid_maps, self.gid_maps,
+                             main.NOBODY_ID, fd_relative=True)
+
+        mock_lchown.assert_has_calls([mock.call(self.root, target_uid,
+                                                target_gid)])
+        self.assertEqual(1, len(mock_lchown.mock_calls))
+        self.assertEqual(2, len(mock_chown.mock_calls))
+        for name, call in zip(['a', 'link'], mock_chown.call_args_list):
+            args, kwargs = call
+            self.assertEqual((name, target_uid, target_gid), args)
+            self.assertFalse(kwargs['follow_symlinks'])
+            self.assertTrue(isinstance(kwargs['dir_fd'], int))
+
+    @mock.patch('os.lchown')
+    @mock.patch('os.chown')
+    def test_shift_dir_fd_relative_dry_run(self, mock_chown, mock_lchown):
+        idmapshift.shift_dir(self.root, self.uid_maps, self.gid_maps,
+                             main.NOBODY_ID, dry_run=True, fd_relative=True)
+
+        self.assertEqual(0, len(mock_lchown.mock_calls))
+        self.assertEqual(0, len(mock_chown.mock_calls))
+
+
+class IdMapShifterTestCase(BaseTestCase):
+    def setUp(self):
+        self.tree = {
+            '/': [('a', dir_stat(0, 0)), ('b', FakeStat(1, 1)),
+                  ('c', FakeStat(20, 20))],
+            '/a': [('d', FakeStat(0, 1))],
+        }
+        self.shifter = idmapshift.IdMapShifter(self.uid_maps, self.gid_maps,
+                                               main.NOBODY_ID)
+
+    def shift(self, shifter, **kwargs):
+        with mock.patch('os.lstat') as mock_lstat, \
+                mock.patch('os.scandir') as mock_scandir, \
+                mock.patch('os.lchown') as mock_lchown:
+            mock_lstat.return_value = dir_stat(0, 0)
+            mock_scandir.side_effect = scandir_side_effect(self.tree)
+            result = shifter.shift('/', **kwargs)
+        return result, mock_lchown.mock_calls
+
+    def test_translate(self):
+        self.assertEqual((10000, 10001), self.shifter.translate(0, 1))
+        self.assertEqual((20010, main.NOBODY_ID),
+                         self.shifter.translate(20, 5000))
+        self.assertEqual(10000, self.shifter.uid_memo[0])
+
+    def test_memos_stay_warm(self):
+        stats = idmapshift.Stats()
+        self.shifter.stats = stats
+        self.shift(self.shifter)
+        self.assertEqual(3, len(self.shifter.uid_memo))
+        lookups = stats.lookups
+        hits = stats.memo_hits
+        self.shift(self.shifter)
+        self.assertEqual(stats.lookups - lookups, stats.memo_hits - hits)
+
+    def test_hooks(self):
+        calls = []
+        shifter = idmapshift.IdMapShifter(
+            self.uid_maps, self.gid_maps, main.NOBODY_ID,
+            pre_entry=lambda path, stat: calls.append(('pre', path)),
+            post_entry=lambda path, stat, changed: calls.append(
+                ('post', path, changed)),
+            entry_filter=lambda path, stat: path != '/b')
+        result, chowns = self.shift(shifter)
+
+        self.assertEqual(4, result.visited)
+        self.assertFalse(mock.call('/b', 10001, 10001) in chowns)
+        self.assertEqual([('pre', '/'), ('post', '/', True),
+                          ('pre', '/a'), ('post', '/a', True),
+                          ('pre', '/c'), ('post', '/c', True),
+                          ('pre', '/a/d'), ('post', '/a/d', True)], calls)
+
+    def test_hooks_with_threads(self):
+        seen = []
+        shifter = idmapshift.IdMapShifter(
+            self.uid_maps, self.gid_maps, main.NOBODY_ID,
+            post_entry=lambda path, stat, changed: seen.append(path))
+        self.shift(shifter, jobs=2)
+        self.assertEqual(['/', '/a', '/a/d', '/b', '/c'], sorted(seen))
+        self.assertRaises(ValueError, shifter.shift, '/', processes=2)
+
+    def test_confirm_filter(self):
+        self.tree = {'/': [('a', FakeStat(10000, 10000)),
+                           ('b', FakeStat(0, 0))]}
+        shifter = idmapshift.IdMapShifter(
+            self.uid_maps, self.gid_maps, main.NOBODY_ID,
+            entry_filter=lambda path, stat: path != '/b')
+        with mock.patch('os.lstat') as mock_lstat, \
+                mock.patch('os.scandir') as mock_scandir:
+            mock_lstat.return_value = dir_stat(10000, 10000)
+            mock_scandir.side_effect = scandir_side_effect(self.tree)
+            self.assertTrue(shifter.confirm('/'))
+            mock_scandir.side_effect = scandir_side_effect(self.tree)
+            self.assertFalse(self.shifter.confirm('/'))
+        self.assertRaises(ValueError, shifter.confirm, '/', jobs=2)
+
+
 class ConfirmPathTestCase(unittest.TestCase):
     @mock.patch('os.lstat')
     def test_confirm_path(self, mock_lstat):
@@ -187,7 +594,7 @@ class ConfirmPathTestCase(unittest.TestCase):
         result = idmapshift.confirm_path('/test/path', uid_ranges, gid_ranges,
                                          50000)
 
-        mock_lstat.assert_has_calls(mock.call('/test/path'))
+        mock_lstat.assert_has_calls([mock.call('/test/path')])
         self.assertTrue(result)
 
     @mock.patch('os.lstat')
@@ -199,7 +606,7 @@ class ConfirmPathTestCase(unittest.TestCase):
         result = idmapshift.confirm_path('/test/path', uid_ranges, gid_ranges,
                                          50000)
 
-        mock_lstat.assert_has_calls(mock.call('/test/path'))
+        mock_lstat.assert_has_calls([mock.call('/test/path')])
         self.assertTrue(result)
 
     @mock.patch('os.lstat')
@@ -211,7 +618,7 @@ class ConfirmPathTestCase(unittest.TestCase):
         result = idmapshift.confirm_path('/test/path', uid_ranges, gid_ranges,
                                          50000)
 
-        mock_lstat.assert_has_calls(mock.call('/test/path'))
+        mock_lstat.assert_has_calls([mock.call('/test/path')])
         self.assertFalse(result)
 
     @mock.patch('os.lstat')
@@ -223,7 +630,7 @@ class ConfirmPathTestCase(unittest.TestCase):
         result = idmapshift.confirm_path('/test/path', uid_ranges, gid_ranges,
                                          50000)
 
-        mock_lstat.assert_has_calls(mock.call('/test/path'))
+        mock_lstat.assert_has_calls([mock.call('/test/path')])
         self.assertFalse(result)
 
     @mock.patch('os.lstat')
@@ -235,7 +642,7 @@ class ConfirmPathTestCase(unittest.TestCase):
         result = idmapshift.confirm_path('/test/path', uid_ranges, gid_ranges,
                                          50000)
 
-        mock_lstat.assert_has_calls(mock.call('/test/path'))
+        mock_lstat.assert_has_calls([mock.call('/test/path')])
         self.assertTrue(result)
 
     @mock.patch('os.lstat')
@@ -247,63 +654,75 @@ class ConfirmPathTestCase(unittest.TestCase):
         result = idmapshift.confirm_path('/test/path', uid_ranges, gid_ranges,
                                          50000)
 
-        mock_lstat.assert_has_calls(mock.call('/test/path'))
+        mock_lstat.assert_has_calls([mock.call('/test/path')])
         self.assertTrue(result)
 
 
 class ConfirmDirTestCase(BaseTestCase):
     def setUp(self):
-        self.uid_map_ranges = idmapshift.get_ranges(self.uid_maps)
-        self.gid_map_ranges = idmapshift.get_ranges(self.gid_maps)
+        self.uid_map_ranges = idmapshift.HostIdSet(
+            idmapshift.get_ranges(self.uid_maps), [main.NOBODY_ID])
+        self.gid_map_ranges = idmapshift.HostIdSet(
+            idmapshift.get_ranges(self.gid_maps), [main.NOBODY_ID])
+        self.stats = {
+            '/': dir_stat(0, 0),
+            'a': dir_stat(0, 0),
+            'b': dir_stat(0, 0),
+            'c': FakeStat(0, 0),
+            'd': FakeStat(0, 0),
+        }
+        self.tree = {
+            '/': [(x, self.stats[x]) for x in ['a', 'b', 'c', 'd']],
+        }
 
     @mock.patch('idmapshift.confirm_path')
-    @mock.patch('os.path.join')
-    @mock.patch('os.walk')
-    def test_confirm_dir(self, mock_walk, mock_join, mock_confirm_path):
-        mock_walk.return_value = [('/', ['a', 'b'], ['c', 'd'])]
-        mock_join.side_effect = join_side_effect
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_confirm_dir(self, mock_lstat, mock_scandir, mock_confirm_path):
+        mock_lstat.return_value = self.stats['/']
+        mock_scandir.side_effect = scandir_side_effect(self.tree)
         mock_confirm_path.return_value = True
 
         idmapshift.confirm_dir('/', self.uid_maps, self.gid_maps,
                                main.NOBODY_ID)
 
         files = ['a', 'b', 'c', 'd']
-        mock_walk.assert_has_calls([mock.call('/')])
-        mock_join_calls = [mock.call('/', x) for x in files]
-        mock_join.assert_has_calls(mock_join_calls)
+        mock_scandir.assert_has_calls([mock.call('/')])
 
         args = (self.uid_map_ranges, self.gid_map_ranges, main.NOBODY_ID)
-        confirm_path_calls = [mock.call('/', *args)]
-        confirm_path_calls += [mock.call('/' + x, *args)
+        confirm_path_calls = [mock.call('/', *args, stat=self.stats['/'])]
+        confirm_path_calls += [mock.call('/' + x, *args, stat=self.stats[x])
                                for x in files]
         mock_confirm_path.assert_has_calls(confirm_path_calls)
 
     @mock.patch('idmapshift.confirm_path')
-    @mock.patch('os.path.join')
-    @mock.patch('os.walk')
-    def test_confirm_dir_short_circuit_root(self, mock_walk, mock_join,
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_confirm_dir_short_circuit_root(self, mock_lstat, mock_scandir,
                                             mock_confirm_path):
-        mock_walk.return_value = [('/', ['a', 'b'], ['c', 'd'])]
-        mock_join.side_effect = join_side_effect
+        mock_lstat.return_value = self.stats['/']
+        mock_scandir.side_effect = scandir_side_effect(self.tree)
         mock_confirm_path.return_value = False
 
         idmapshift.confirm_dir('/', self.uid_maps, self.gid_maps,
                                main.NOBODY_ID)
 
         args = (self.uid_map_ranges, self.gid_map_ranges, main.NOBODY_ID)
-        confirm_path_calls = [mock.call('/', *args)]
+        confirm_path_calls = [mock.call('/', *args, stat=self.stats['/'])]
         mock_confirm_path.assert_has_calls(confirm_path_calls)
+        self.assertEqual(1, len(mock_confirm_path.mock_calls))
+        self.assertEqual(0, len(mock_scandir.mock_calls))
 
     @mock.patch('idmapshift.confirm_path')
-    @mock.patch('os.path.join')
-    @mock.patch('os.walk')
-    def test_confirm_dir_short_circuit_file(self, mock_walk, mock_join,
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_confirm_dir_short_circuit_file(self, mock_lstat, mock_scandir,
                                             mock_confirm_path):
-        mock_walk.return_value = [('/', ['a', 'b'], ['c', 'd'])]
-        mock_join.side_effect = join_side_effect
+        mock_lstat.return_value = self.stats['/']
+        mock_scandir.side_effect = scandir_side_effect(self.tree)
 
-        def confirm_path_side_effect(path, *args):
-            if 'a' in path:
+        def confirm_path_side_effect(path, *args, **kwargs):
+            if 'c' in path:
                 return False
             return True
 
@@ -312,24 +731,24 @@ class ConfirmDirTestCase(BaseTestCase):
         idmapshift.confirm_dir('/', self.uid_maps, self.gid_maps,
                                main.NOBODY_ID)
 
-        mock_walk.assert_has_calls([mock.call('/')])
-        mock_join.assert_has_calls([mock.call('/', 'a')])
-
+        files = ['a', 'b', 'c']
         args = (self.uid_map_ranges, self.gid_map_ranges, main.NOBODY_ID)
-        confirm_path_calls = [mock.call('/', *args),
-                              mock.call('/' + 'a', *args)]
+        confirm_path_calls = [mock.call('/', *args, stat=self.stats['/'])]
+        confirm_path_calls += [mock.call('/' + x, *args, stat=self.stats[x])
+                               for x in files]
         mock_confirm_path.assert_has_calls(confirm_path_calls)
+        self.assertEqual(4, len(mock_confirm_path.mock_calls))
 
     @mock.patch('idmapshift.confirm_path')
-    @mock.patch('os.path.join')
-    @mock.patch('os.walk')
-    def test_confirm_dir_short_circuit_dir(self, mock_walk, mock_join,
-                                            mock_confirm_path):
-        mock_walk.return_value = [('/', ['a', 'b'], ['c', 'd'])]
-        mock_join.side_effect = join_side_effect
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_confirm_dir_short_circuit_dir(self, mock_lstat, mock_scandir,
+                                           mock_confirm_path):
+        mock_lstat.return_value = self.stats['/']
+        mock_scandir.side_effect = scandir_side_effect(self.tree)
 
-        def confirm_path_side_effect(path, *args):
-            if 'c' in path:
+        def confirm_path_side_effect(path, *args, **kwargs):
+            if 'a' in path:
                 return False
             return True
 
@@ -338,16 +757,11 @@ class ConfirmDirTestCase(BaseTestCase):
         idmapshift.confirm_dir('/', self.uid_maps, self.gid_maps,
                                main.NOBODY_ID)
 
-        files = ['a', 'b', 'c']
-        mock_walk.assert_has_calls([mock.call('/')])
-        mock_join_calls = [mock.call('/', x) for x in files]
-        mock_join.assert_has_calls(mock_join_calls)
-
         args = (self.uid_map_ranges, self.gid_map_ranges, main.NOBODY_ID)
-        confirm_path_calls = [mock.call('/', *args)]
-        confirm_path_calls += [mock.call('/' + x, *args)
-                               for x in files]
+        confirm_path_calls = [mock.call('/', *args, stat=self.stats['/']),
+                              mock.call('/a', *args, stat=self.stats['a'])]
         mock_confirm_path.assert_has_calls(confirm_path_calls)
+        self.assertEqual(2, len(mock_confirm_path.mock_calls))
 
 
 class IDMapTypeTestCase(unittest.TestCase):
@@ -363,11 +777,13 @@ class IDMapTypeTestCase(unittest.TestCase):
         self.assertRaises(argparse.ArgumentTypeError, main.id_map_type,
                           "1:1")
 
+    def test_id_map_type_overlapping(self):
+        self.assertRaises(argparse.ArgumentTypeError, main.id_map_type,
+                          "0:1000:10,5:2000:10")
+
 
 class MainTestCase(BaseTestCase):
-    @mock.patch('idmapshift.shift_dir')
-    @mock.patch('argparse.ArgumentParser')
-    def test_main(self, mock_parser_class, mock_shift_dir):
+    def mock_args(self, mock_parser_class, **kwargs):
         mock_parser = mock.MagicMock()
         mock_parser.parse_args.return_value = mock_parser
         mock_parser.idempotent = False
@@ -378,90 +794,166 @@ class MainTestCase(BaseTestCase):
         mock_parser.nobody = main.NOBODY_ID
         mock_parser.dry_run = False
         mock_parser.verbose = False
+        mock_parser.fd_relative = False
+        mock_parser.jobs = 1
+        mock_parser.processes = 1
+        mock_parser.journal = None
+        mock_parser.resume = False
+        mock_parser.manifest = None
+        mock_parser.stats_json = None
+        mock_parser.output_format = 'text'
+        mock_parser.changes_only = False
+        mock_parser.batch = None
+        mock_parser.profile = None
+        mock_parser.tar = False
+        mock_parser.paths_from = None
+        mock_parser.exclude = None
+        mock_parser.one_file_system = False
+        mock_parser.statx = False
+        mock_parser.statx_dont_sync = False
+        mock_parser.xattrs = False
+        mock_parser.confirm_sample = None
+        mock_parser.confidence = 0.95
+        mock_parser.from_uid = None
+        mock_parser.from_gid = None
+        for key, value in kwargs.items():
+            setattr(mock_parser, key, value)
         mock_parser_class.return_value = mock_parser
+        return mock_parser
+
+    @mock.patch('idmapshift.shift_dir')
+    @mock.patch('argparse.ArgumentParser')
+    def test_main(self, mock_parser_class, mock_shift_dir):
+        self.mock_args(mock_parser_class)
 
         main.main()
 
         mock_shift_dir_call = mock.call('/test/path', self.uid_maps,
                                         self.gid_maps, main.NOBODY_ID,
-                                        dry_run=False, verbose=False)
+                                        dry_run=False, verbose=False,
+                                        fd_relative=False, idempotent=False,
+                                        jobs=1, processes=1, journal=None,
+                                        resume=False, manifest=None,
+                                        stats=None, printer=None,
+                                        excludes=None, one_file_system=False,
+                                        statx=False, dont_sync=False,
+                                        xattrs=False)
         mock_shift_dir.assert_has_calls([mock_shift_dir_call])
 
+    @mock.patch('idmapshift.remap_dir')
     @mock.patch('idmapshift.shift_dir')
-    @mock.patch('idmapshift.confirm_dir')
     @mock.patch('argparse.ArgumentParser')
-    def test_main_confirm_dir_idempotent_unshifted(self, mock_parser_class,
-                                                   mock_confirm_dir,
-                                                   mock_shift_dir):
-        mock_parser = mock.MagicMock()
-        mock_parser.parse_args.return_value = mock_parser
-        mock_parser.idempotent = True
-        mock_parser.confirm = False
-        mock_parser.path = '/test/path'
-        mock_parser.uid = self.uid_maps
-        mock_parser.gid = self.gid_maps
-        mock_parser.nobody = main.NOBODY_ID
-        mock_parser.dry_run = False
-        mock_parser.verbose = False
-        mock_parser_class.return_value = mock_parser
-        mock_confirm_dir.return_value = False
+    def test_main_remap(self, mock_parser_class, mock_shift_dir,
+                        mock_remap_dir):
+        src_maps = [(0, 50000, 1010)]
+        self.mock_args(mock_parser_class, from_uid=src_maps,
+                       from_gid=src_maps)
 
         main.main()
 
-        mock_confirm_dir_call = mock.call('/test/path', self.uid_maps,
-                                          self.gid_maps, main.NOBODY_ID)
-        mock_confirm_dir.assert_has_calls([mock_confirm_dir_call])
-        mock_shift_dir_call = mock.call('/test/path', self.uid_maps,
-                                        self.gid_maps, main.NOBODY_ID,
-                                        dry_run=False, verbose=False)
-        mock_shift_dir.assert_has_calls([mock_shift_dir_call])
+        self.assertEqual(0, len(mock_shift_dir.mock_calls))
+        mock_remap_dir_call = mock.call('/test/path', src_maps, src_maps,
+                                        self.uid_maps, self.gid_maps,
+                                        main.NOBODY_ID, dry_run=False,
+                                        verbose=False, fd_relative=False,
+                                        idempotent=False, jobs=1,
+                                        processes=1, journal=None,
+                                        resume=False, manifest=None,
+                                        stats=None, printer=None,
+                                        excludes=None, one_file_system=False,
+                                        statx=False, dont_sync=False,
+                                        xattrs=False)
+        mock_remap_dir.assert_has_calls([mock_remap_dir_call])
+
+    @mock.patch('idmapshift.remap_dir')
+    @mock.patch('argparse.ArgumentParser')
+    def test_main_remap_needs_both_maps(self, mock_parser_class,
+                                        mock_remap_dir):
+        mock_parser = self.mock_args(mock_parser_class,
+                                     from_uid=[(0, 50000, 1010)])
+        mock_parser.error.side_effect = SystemExit(2)
+
+        self.assertRaises(SystemExit, main.main)
+        self.assertEqual(0, len(mock_remap_dir.mock_calls))
+
+    @mock.patch('idmapshift.shift_dir')
+    @mock.patch('argparse.ArgumentParser')
+    def test_main_fd_relative_jobs(self, mock_parser_class, mock_shift_dir):
+        mock_parser = self.mock_args(mock_parser_class, fd_relative=True,
+                                     jobs=4)
+        mock_parser.error.side_effect = SystemExit(2)
+
+        self.assertRaises(SystemExit, main.main)
+        self.assertEqual(0, len(mock_shift_dir.mock_calls))
+
+    @mock.patch('idmapshift.shift_dir')
+    @mock.patch('argparse.ArgumentParser')
+    def test_main_processes_conflicts(self, mock_parser_class,
+                                      mock_shift_dir):
+        for kwargs in (dict(verbose=True), dict(fd_relative=True),
+                       dict(jobs=2), dict(jobs=2, confirm=True)):
+            mock_parser = self.mock_args(mock_parser_class, processes=4,
+                                         **kwargs)
+            mock_parser.error.side_effect = SystemExit(2)
+
+            self.assertRaises(SystemExit, main.main)
+        self.assertEqual(0, len(mock_shift_dir.mock_calls))
+
+    @mock.patch('idmapshift.shift_dir')
+    @mock.patch('argparse.ArgumentParser')
+    def test_main_journal_conflicts(self, mock_parser_class, mock_shift_dir):
+        for kwargs in (dict(resume=True), dict(journal='j', dry_run=True),
+                       dict(journal='j', jobs=2),
+                       dict(journal='j', processes=2),
+                       dict(journal='j', fd_relative=True)):
+            mock_parser = self.mock_args(mock_parser_class, **kwargs)
+            mock_parser.error.side_effect = SystemExit(2)
+
+            self.assertRaises(SystemExit, main.main)
+        self.assertEqual(0, len(mock_shift_dir.mock_calls))
+
+    @mock.patch('idmapshift.shift_dir')
+    @mock.patch('argparse.ArgumentParser')
+    def test_main_manifest_conflicts(self, mock_parser_class,
+                                     mock_shift_dir):
+        for kwargs in (dict(jobs=2), dict(processes=2, confirm=True),
+                       dict(fd_relative=True), dict(journal='j'),
+                       dict(dry_run=True)):
+            mock_parser = self.mock_args(mock_parser_class, manifest='m',
+                                         **kwargs)
+            mock_parser.error.side_effect = SystemExit(2)
+
+            self.assertRaises(SystemExit, main.main)
+        self.assertEqual(0, len(mock_shift_dir.mock_calls))
 
     @mock.patch('idmapshift.shift_dir')
     @mock.patch('idmapshift.confirm_dir')
     @mock.patch('argparse.ArgumentParser')
-    def test_main_confirm_dir_idempotent_shifted(self, mock_parser_class,
-                                                 mock_confirm_dir,
-                                                 mock_shift_dir):
-        mock_parser = mock.MagicMock()
-        mock_parser.parse_args.return_value = mock_parser
-        mock_parser.idempotent = True
-        mock_parser.confirm = False
-        mock_parser.path = '/test/path'
-        mock_parser.uid = self.uid_maps
-        mock_parser.gid = self.gid_maps
-        mock_parser.nobody = main.NOBODY_ID
-        mock_parser.dry_run = False
-        mock_parser.verbose = False
-        mock_parser_class.return_value = mock_parser
-        mock_confirm_dir.return_value = True
+    def test_main_idempotent(self, mock_parser_class, mock_confirm_dir,
+                             mock_shift_dir):
+        self.mock_args(mock_parser_class, idempotent=True)
 
-        try:
-            main.main()
-        except SystemExit as sys_exit:
-            self.assertEqual(sys_exit.code, 0)
+        main.main()
 
-        mock_confirm_dir_call = mock.call('/test/path', self.uid_maps,
-                                          self.gid_maps, main.NOBODY_ID)
-        mock_confirm_dir.assert_has_calls([mock_confirm_dir_call])
-        mock_shift_dir.assert_has_calls([])
+        self.assertEqual(0, len(mock_confirm_dir.mock_calls))
+        mock_shift_dir_call = mock.call('/test/path', self.uid_maps,
+                                        self.gid_maps, main.NOBODY_ID,
+                                        dry_run=False, verbose=False,
+                                        fd_relative=False, idempotent=True,
+                                        jobs=1, processes=1, journal=None,
+                                        resume=False, manifest=None,
+                                        stats=None, printer=None,
+                                        excludes=None, one_file_system=False,
+                                        statx=False, dont_sync=False,
+                                        xattrs=False)
+        mock_shift_dir.assert_has_calls([mock_shift_dir_call])
 
     @mock.patch('idmapshift.shift_dir')
     @mock.patch('idmapshift.confirm_dir')
     @mock.patch('argparse.ArgumentParser')
     def test_main_confirm_dir_check_unshifted(self, mock_parser_class,
                                            mock_confirm_dir, mock_shift_dir):
-        mock_parser = mock.MagicMock()
-        mock_parser.parse_args.return_value = mock_parser
-        mock_parser.idempotent = False
-        mock_parser.confirm = True
-        mock_parser.exit_on_fail = True
-        mock_parser.path = '/test/path'
-        mock_parser.uid = self.uid_maps
-        mock_parser.gid = self.gid_maps
-        mock_parser.nobody = main.NOBODY_ID
-        mock_parser.dry_run = False
-        mock_parser.verbose = False
-        mock_parser_class.return_value = mock_parser
+        self.mock_args(mock_parser_class, confirm=True)
         mock_confirm_dir.return_value = False
 
         try:
@@ -470,27 +962,21 @@ class MainTestCase(BaseTestCase):
             self.assertEqual(sys_exit.code, 1)
 
         mock_confirm_dir_call = mock.call('/test/path', self.uid_maps,
-                                          self.gid_maps, main.NOBODY_ID)
+                                          self.gid_maps, main.NOBODY_ID,
+                                          jobs=1, processes=1,
+                                          manifest=None, stats=None,
+                                          excludes=None, one_file_system=False,
+                                          statx=False, dont_sync=False)
         mock_confirm_dir.assert_has_calls([mock_confirm_dir_call])
         mock_shift_dir.assert_has_calls([])
 
     @mock.patch('idmapshift.shift_dir')
     @mock.patch('idmapshift.confirm_dir')
     @mock.patch('argparse.ArgumentParser')
-    def test_main_confirm_dir_check_unshifted(self, mock_parser_class,
-                                           mock_confirm_dir, mock_shift_dir):
-        mock_parser = mock.MagicMock()
-        mock_parser.parse_args.return_value = mock_parser
-        mock_parser.idempotent = False
-        mock_parser.confirm = True
-        mock_parser.exit_on_fail = True
-        mock_parser.path = '/test/path'
-        mock_parser.uid = self.uid_maps
-        mock_parser.gid = self.gid_maps
-        mock_parser.nobody = main.NOBODY_ID
-        mock_parser.dry_run = False
-        mock_parser.verbose = False
-        mock_parser_class.return_value = mock_parser
+    def test_main_confirm_dir_check_shifted(self, mock_parser_class,
+                                            mock_confirm_dir,
+                                            mock_shift_dir):
+        self.mock_args(mock_parser_class, confirm=True)
         mock_confirm_dir.return_value = True
 
         try:
@@ -499,38 +985,47 @@ class MainTestCase(BaseTestCase):
             self.assertEqual(sys_exit.code, 0)
 
         mock_confirm_dir_call = mock.call('/test/path', self.uid_maps,
-                                          self.gid_maps, main.NOBODY_ID)
+                                          self.gid_maps, main.NOBODY_ID,
+                                          jobs=1, processes=1,
+                                          manifest=None, stats=None,
+                                          excludes=None, one_file_system=False,
+                                          statx=False, dont_sync=False)
         mock_confirm_dir.assert_has_calls([mock_confirm_dir_call])
         mock_shift_dir.assert_has_calls([])
 
 
 class IntegrationTestCase(BaseTestCase):
+    def unshifted_tree(self):
+        return {
+            '/tmp/test': [('a', dir_stat(0, 0)),
+                          ('b', dir_stat(0, 2)),
+                          ('c', dir_stat(30000, 30000)),
+                          ('d', dir_stat(100, 100))],
+            '/tmp/test/d': [('1', FakeStat(0, 100)),
+                            ('2', FakeStat(100, 100))],
+        }
+
+    def shifted_tree(self):
+        return {
+            '/tmp/test': [('a', dir_stat(10000, 10000)),
+                          ('b', dir_stat(10000, 10002)),
+                          ('c', dir_stat(main.NOBODY_ID, main.NOBODY_ID)),
+                          ('d', dir_stat(20090, 20090))],
+            '/tmp/test/d': [('1', FakeStat(10000, 20090)),
+                            ('2', FakeStat(20090, 20090))],
+        }
+
     @mock.patch('os.lchown')
+    @mock.patch('os.scandir')
     @mock.patch('os.lstat')
-    @mock.patch('os.path.join')
-    @mock.patch('os.walk')
-    def test_integrated_shift_dir(self, mock_walk, mock_join, mock_lstat,
+    def test_integrated_shift_dir(self, mock_lstat, mock_scandir,
                                   mock_lchown):
-        mock_walk.return_value = [('/tmp/test', ['a', 'b', 'c'], ['d']),
-                                  ('/tmp/test/d', ['1', '2'], [])]
-        mock_join.side_effect = join_side_effect
-
-        def lstat(path):
-            stats = {
-                't': FakeStat(0, 0),
-                'a': FakeStat(0, 0),
-                'b': FakeStat(0, 2),
-                'c': FakeStat(30000, 30000),
-                'd': FakeStat(100, 100),
-                '1': FakeStat(0, 100),
-                '2': FakeStat(100, 100),
-            }
-            return stats[path[-1]]
-
-        mock_lstat.side_effect = lstat
+        mock_lstat.return_value = dir_stat(0, 0)
+        mock_scandir.side_effect = scandir_side_effect(self.unshifted_tree())
 
-        idmapshift.shift_dir('/tmp/test', self.uid_maps, self.gid_maps,
-                             main.NOBODY_ID, verbose=True)
+        result = idmapshift.shift_dir('/tmp/test', self.uid_maps,
+                                      self.gid_maps, main.NOBODY_ID,
+                                      verbose=True)
 
         lchown_calls = [
             mock.call('/tmp/test', 10000, 10000),
@@ -542,86 +1037,109 @@ class IntegrationTestCase(BaseTestCase):
             mock.call('/tmp/test/d/2', 20090, 20090),
         ]
         mock_lchown.assert_has_calls(lchown_calls)
+        mock_lstat.assert_has_calls([mock.call('/tmp/test')])
+        self.assertEqual(1, len(mock_lstat.mock_calls))
+        self.assertEqual(dict(visited=7, changed=7, unchanged=0,
+                              mapped_to_nobody=1, hardlinks_skipped=0,
+                              pruned=0, xattrs_shifted=0, missing=0),
+                         result.as_dict())
+
+    @mock.patch('os.lchown')
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_integrated_shift_dir_idempotent(self, mock_lstat, mock_scandir,
+                                             mock_lchown):
+        tree = self.shifted_tree()
+        tree['/tmp/test/d'].append(('3', FakeStat(1, 2)))
+        mock_lstat.return_value = dir_stat(10000, 10000)
+        mock_scandir.side_effect = scandir_side_effect(tree)
+
+        result = idmapshift.shift_dir('/tmp/test', self.uid_maps,
+                                      self.gid_maps, main.NOBODY_ID,
+                                      idempotent=True)
+
+        mock_lchown.assert_has_calls([mock.call('/tmp/test/d/3', 10001,
+                                                10002)])
+        self.assertEqual(1, len(mock_lchown.mock_calls))
+        self.assertEqual(dict(visited=8, changed=1, unchanged=7,
+                              mapped_to_nobody=0, hardlinks_skipped=0,
+                              pruned=0, xattrs_shifted=0, missing=0),
+                         result.as_dict())
+
+    @mock.patch('os.lchown')
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_integrated_shift_dir_hardlinks(self, mock_lstat, mock_scandir,
+                                            mock_lchown):
+        tree = self.unshifted_tree()
+        tree['/tmp/test'].append(('e', FakeStat(1, 1, ino=5, nlink=2)))
+        tree['/tmp/test/d'].append(('3', FakeStat(1, 1, ino=5, nlink=2)))
+        mock_lstat.return_value = dir_stat(0, 0)
+        mock_scandir.side_effect = scandir_side_effect(tree)
+
+        result = idmapshift.shift_dir('/tmp/test', self.uid_maps,
+                                      self.gid_maps, main.NOBODY_ID)
+
+        mock_lchown.assert_has_calls([mock.call('/tmp/test/e', 10001,
+                                                10001)])
+        self.assertEqual(8, len(mock_lchown.mock_calls))
+        self.assertEqual(8, result.visited)
+        self.assertEqual(1, result.hardlinks_skipped)
+
+    @mock.patch('os.lchown')
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_integrated_remap_dir(self, mock_lstat, mock_scandir,
+                                  mock_lchown):
+        dst_maps = [(0, 50000, 10), (10, 60000, 1000)]
+        mock_lstat.return_value = dir_stat(10000, 10000)
+        mock_scandir.side_effect = scandir_side_effect(self.shifted_tree())
+
+        idmapshift.remap_dir('/tmp/test', self.uid_maps, self.gid_maps,
+                             dst_maps, dst_maps, main.NOBODY_ID)
+
+        lchown_calls = [
+            mock.call('/tmp/test', 50000, 50000),
+            mock.call('/tmp/test/a', 50000, 50000),
+            mock.call('/tmp/test/b', 50000, 50002),
+            mock.call('/tmp/test/d', 60090, 60090),
+            mock.call('/tmp/test/d/1', 50000, 60090),
+            mock.call('/tmp/test/d/2', 60090, 60090),
+        ]
+        mock_lchown.assert_has_calls(lchown_calls)
+        self.assertEqual(6, len(mock_lchown.mock_calls))
 
     @mock.patch('os.lchown')
+    @mock.patch('os.scandir')
     @mock.patch('os.lstat')
-    @mock.patch('os.path.join')
-    @mock.patch('os.walk')
-    def test_integrated_shift_dir_dry_run(self, mock_walk, mock_join,
-                                          mock_lstat, mock_lchown):
-        mock_walk.return_value = [('/tmp/test', ['a', 'b', 'c'], ['d']),
-                                  ('/tmp/test/d', ['1', '2'], [])]
-        mock_join.side_effect = join_side_effect
-
-        def lstat(path):
-            stats = {
-                't': FakeStat(0, 0),
-                'a': FakeStat(0, 0),
-                'b': FakeStat(0, 2),
-                'c': FakeStat(30000, 30000),
-                'd': FakeStat(100, 100),
-                '1': FakeStat(0, 100),
-                '2': FakeStat(100, 100),
-            }
-            return stats[path[-1]]
-
-        mock_lstat.side_effect = lstat
+    def test_integrated_shift_dir_dry_run(self, mock_lstat, mock_scandir,
+                                          mock_lchown):
+        mock_lstat.return_value = dir_stat(0, 0)
+        mock_scandir.side_effect = scandir_side_effect(self.unshifted_tree())
 
         idmapshift.shift_dir('/tmp/test', self.uid_maps, self.gid_maps,
                              main.NOBODY_ID, dry_run=True, verbose=True)
 
         self.assertEqual(0, len(mock_lchown.mock_calls))
 
+    @mock.patch('os.scandir')
     @mock.patch('os.lstat')
-    @mock.patch('os.path.join')
-    @mock.patch('os.walk')
-    def test_integrated_confirm_dir_shifted(self, mock_walk, mock_join,
-                                              mock_lstat):
-        mock_walk.return_value = [('/tmp/test', ['a', 'b', 'c'], ['d']),
-                                  ('/tmp/test/d', ['1', '2'], [])]
-        mock_join.side_effect = join_side_effect
-
-        def lstat(path):
-            stats = {
-                't': FakeStat(10000, 10000),
-                'a': FakeStat(10000, 10000),
-                'b': FakeStat(10000, 10002),
-                'c': FakeStat(main.NOBODY_ID, main.NOBODY_ID),
-                'd': FakeStat(20090, 20090),
-                '1': FakeStat(10000, 20090),
-                '2': FakeStat(20090, 20090),
-            }
-            return stats[path[-1]]
-
-        mock_lstat.side_effect = lstat
+    def test_integrated_confirm_dir_shifted(self, mock_lstat, mock_scandir):
+        mock_lstat.return_value = dir_stat(10000, 10000)
+        mock_scandir.side_effect = scandir_side_effect(self.shifted_tree())
 
         result = idmapshift.confirm_dir('/tmp/test', self.uid_maps,
                                         self.gid_maps, main.NOBODY_ID)
 
         self.assertTrue(result)
+        self.assertEqual(1, len(mock_lstat.mock_calls))
 
+    @mock.patch('os.scandir')
     @mock.patch('os.lstat')
-    @mock.patch('os.path.join')
-    @mock.patch('os.walk')
-    def test_integrated_confirm_dir_unshifted(self, mock_walk, mock_join,
-                                            mock_lstat):
-        mock_walk.return_value = [('/tmp/test', ['a', 'b', 'c'], ['d']),
-                                  ('/tmp/test/d', ['1', '2'], [])]
-        mock_join.side_effect = join_side_effect
-
-        def lstat(path):
-            stats = {
-                't': FakeStat(0, 0),
-                'a': FakeStat(0, 0),
-                'b': FakeStat(0, 2),
-                'c': FakeStat(30000, 30000),
-                'd': FakeStat(100, 100),
-                '1': FakeStat(0, 100),
-                '2': FakeStat(100, 100),
-            }
-            return stats[path[-1]]
-
-        mock_lstat.side_effect = lstat
+    def test_integrated_confirm_dir_unshifted(self, mock_lstat,
+                                              mock_scandir):
+        mock_lstat.return_value = dir_stat(0, 0)
+        mock_scandir.side_effect = scandir_side_effect(self.unshifted_tree())
 
         result = idmapshift.confirm_dir('/tmp/test', self.uid_maps,
                                         self.gid_maps, main.NOBODY_ID)
@@ -0,0 +1,56 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import random
+import unittest
+
+import idmapshift
+from idmapshift import inodes as inodes_module
+
+
+class InodeSetTestCase(unittest.TestCase):
+    def test_add(self):
+        inodes = idmapshift.InodeSet()
+        self.assertTrue(inodes.add(1, 100))
+        self.assertFalse(inodes.add(1, 100))
+        self.assertTrue(inodes.add(2, 100))
+        self.assertEqual(2, len(inodes))
+
+    def test_add_across_merges(self):
+        inodes = idmapshift.InodeSet()
+        inodes.MIN_MERGE = 8
+        rand = random.Random(4)
+        seen = set()
+        for i in range(5000):
+            ino = rand.randint(0, 1 << 40)
+            self.assertEqual(ino not in seen, inodes.add(7, ino))
+            seen.add(ino)
+        self.assertEqual(len(seen), len(inodes))
+        for ino in seen:
+            self.assertFalse(inodes.add(7, ino))
+
+    def test_merge(self):
+        old = array.array('Q', [10, 20, 30, 40])
+        merged = inodes_module._merge(old, [5, 25, 26, 45])
+        self.assertEqual('Q', merged.typecode)
+        self.assertEqual([5, 10, 20, 25, 26, 30, 40, 45], list(merged))
+        self.assertEqual([1, 2], list(inodes_module._merge(
+            array.array('Q'), [1, 2])))
+        self.assertEqual(list(old), list(inodes_module._merge(old, [])))
+
+    def test_large_inode_numbers(self):
+        inodes = idmapshift.InodeSet()
+        self.assertTrue(inodes.add(1, (1 << 64) - 1))
+        self.assertFalse(inodes.add(1, (1 << 64) - 1))
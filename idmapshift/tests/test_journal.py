@@ -0,0 +1,231 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import idmapshift
+from idmapshift import journal
+from idmapshift import main
+from idmapshift.tests.test_idmapshift import BaseTestCase
+
+
+class JournalTestCase(BaseTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        progress = journal.Journal(self.path, b'abc')
+        progress.record_listed('')
+        progress.record_listed('a/b')
+        progress.record_finished('a/b')
+        progress.close()
+
+        resumed = journal.Journal(self.path, b'abc', resume=True)
+        resumed.close()
+        self.assertTrue(resumed.resumed)
+        self.assertEqual(set(['', 'a/b']), resumed.listed)
+        self.assertEqual(set(['a/b']), resumed.finished)
+
+    def test_torn_record_ignored(self):
+        progress = journal.Journal(self.path, b'abc')
+        progress.record_listed('a')
+        progress.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'Lhalf-writ')
+
+        resumed = journal.Journal(self.path, b'abc', resume=True)
+        resumed.close()
+        self.assertEqual(set(['a']), resumed.listed)
+
+    def test_fingerprint_mismatch(self):
+        journal.Journal(self.path, b'abc').close()
+        self.assertRaises(journal.JournalMismatch, journal.Journal,
+                          self.path, b'def', resume=True)
+
+    def test_main_fingerprint_mismatch(self):
+        journal.Journal(self.path, b'abc').close()
+        argv = ['idmapshift', '-u', '0:10000:1', '-g', '0:10000:1',
+                '--journal', self.path, '--resume', self.tmp]
+        stderr = io.StringIO()
+        with mock.patch('sys.argv', argv), mock.patch('sys.stderr', stderr):
+            self.assertRaises(SystemExit, main.main)
+        self.assertTrue('does not belong to this shift' in stderr.getvalue())
+
+    def test_without_resume_truncates(self):
+        progress = journal.Journal(self.path, b'abc')
+        progress.record_listed('a')
+        progress.close()
+
+        fresh = journal.Journal(self.path, b'abc')
+        fresh.close()
+        self.assertFalse(fresh.resumed)
+        fresh = journal.Journal(self.path, b'abc', resume=True)
+        fresh.close()
+        self.assertEqual(set(), fresh.listed)
+
+    @mock.patch('os.sync')
+    @mock.patch('os.fsync')
+    def test_sync_batching(self, mock_fsync, mock_sync):
+        progress = journal.Journal(self.path, b'abc', sync_every=3,
+                                   sync_interval=3600)
+        mock_fsync.reset_mock()
+        for i in range(7):
+            progress.record_listed(str(i))
+        self.assertEqual(2, len(mock_fsync.mock_calls))
+        self.assertEqual(2, len(mock_sync.mock_calls))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(6, f.read().count(b'\0'))
+        progress.close()
+        self.assertEqual(3, len(mock_fsync.mock_calls))
+        self.assertEqual(3, len(mock_sync.mock_calls))
+
+    @mock.patch('os.sync')
+    def test_nobodies_written_at_once(self, mock_sync):
+        progress = journal.Journal(self.path, b'abc')
+        progress.record_nobodies(['a', 'b/c'])
+        self.assertFalse(mock_sync.called)
+        with open(self.path, 'rb') as f:
+            self.assertTrue(f.read().endswith(b'Na\0Nb/c\0'))
+        progress.close()
+        resumed = journal.Journal(self.path, b'abc', resume=True)
+        resumed.close()
+        self.assertEqual(set(['a', 'b/c']), resumed.nobodies)
+
+
+class ShiftDirJournalTestCase(BaseTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'root')
+        self.path = os.path.join(self.tmp, 'journal')
+        self.all_paths = set([self.root])
+        for i in range(4):
+            for sub in ('', 'x', 'x/y'):
+                dirpath = os.path.join(self.root, 'd%d' % i, sub)
+                if not os.path.isdir(dirpath):
+                    os.makedirs(dirpath)
+                for j in range(3):
+                    filepath = os.path.join(dirpath, 'f%d' % j)
+                    open(filepath, 'w').close()
+                    self.all_paths.add(filepath)
+                self.all_paths.add(os.path.normpath(dirpath))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def shift(self, **kwargs):
+        return idmapshift.shift_dir(self.root, self.uid_maps, self.gid_maps,
+                                    main.NOBODY_ID, journal=self.path,
+                                    **kwargs)
+
+    @mock.patch('os.lchown')
+    def test_shift_dir_journal(self, mock_lchown):
+        result = self.shift()
+        chowned = set(call[1][0] for call in mock_lchown.mock_calls)
+        self.assertEqual(self.all_paths, chowned)
+        self.assertEqual(len(self.all_paths), result.visited)
+
+        progress = journal.Journal(self.path, journal.fingerprint(
+            self.root, self.uid_maps, self.gid_maps, main.NOBODY_ID),
+            resume=True)
+        progress.close()
+        self.assertTrue('' in progress.finished)
+
+    @mock.patch('os.lchown')
+    def test_resume_skips_finished_work(self, mock_lchown):
+        calls = []
+
+        def killed(path, uid, gid):
+            if len(calls) == 20:
+                raise KeyboardInterrupt()
+            calls.append(path)
+
+        mock_lchown.side_effect = killed
+        self.assertRaises(KeyboardInterrupt, self.shift)
+        first = set(calls)
+
+        progress = journal.Journal(self.path, journal.fingerprint(
+            self.root, self.uid_maps, self.gid_maps, main.NOBODY_ID),
+            resume=True)
+        progress.close()
+        done = set(os.path.join(self.root, rel) if rel else self.root
+                   for rel in progress.listed)
+        self.assertTrue(done)
+
+        mock_lchown.side_effect = None
+        mock_lchown.reset_mock()
+        result = self.shift(resume=True)
+        second = set(call[1][0] for call in mock_lchown.mock_calls)
+
+        self.assertEqual(self.all_paths, first | second)
+        for path in second:
+            self.assertFalse(os.path.dirname(path) in done)
+        self.assertTrue(result.visited < len(self.all_paths))
+
+    def test_journal_rejects_parallel(self):
+        self.assertRaises(ValueError, self.shift, jobs=2)
+        self.assertRaises(ValueError, self.shift, dry_run=True)
+        self.assertRaises(ValueError, idmapshift.shift_dir, self.root,
+                          self.uid_maps, self.gid_maps, main.NOBODY_ID,
+                          resume=True)
+
+
+@unittest.skipUnless(os.geteuid() == 0, 'requires root to chown')
+class ResumeNobodyTestCase(unittest.TestCase):
+    MAPS = [(0, 100000, 65536)]
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.root = os.path.join(self.tmp, 'root')
+        self.path = os.path.join(self.tmp, 'journal')
+        os.mkdir(self.root)
+        os.lchown(self.root, 0, 0)
+        self.expected = {self.root: 100000}
+        owners = [(0, 100000), (main.NOBODY_ID, 165534),
+                  (70000, main.NOBODY_ID)]
+        for i in range(12):
+            owner, shifted = owners[i % 3]
+            path = os.path.join(self.root, 'f%d' % i)
+            open(path, 'w').close()
+            os.lchown(path, owner, owner)
+            self.expected[path] = shifted
+
+    def test_resume_after_crash(self):
+        seen = []
+
+        def crash(path, stat):
+            if len(seen) == 7:
+                raise KeyboardInterrupt()
+            seen.append(path)
+
+        shifter = idmapshift.IdMapShifter(self.MAPS, self.MAPS,
+                                          main.NOBODY_ID, pre_entry=crash)
+        self.assertRaises(KeyboardInterrupt, shifter.shift, self.root,
+                          journal=self.path)
+        shifter = idmapshift.IdMapShifter(self.MAPS, self.MAPS,
+                                          main.NOBODY_ID)
+        shifter.shift(self.root, journal=self.path, resume=True)
+        for path, shifted in self.expected.items():
+            st = os.lstat(path)
+            self.assertEqual((shifted, shifted), (st.st_uid, st.st_gid),
+                             path)
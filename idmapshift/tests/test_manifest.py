@@ -0,0 +1,145 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import idmapshift
+from idmapshift import main
+from idmapshift import manifest
+from idmapshift.tests.test_idmapshift import BaseTestCase
+
+
+class FakeDirStat(object):
+    def __init__(self, ino):
+        self.st_ino = ino
+        self.st_dev = 1
+        self.st_ctime_ns = ino * 10
+        self.st_mtime_ns = ino * 20
+
+
+class ManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'manifest')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        writer = manifest.ManifestWriter(b'f' * 40)
+        for ino, relpath in enumerate(['', 'b', 'a', 'b/c', 'a/z', 'a/y']):
+            writer.add(relpath, FakeDirStat(ino + 1), ino)
+        writer.write(self.path)
+
+        m = manifest.Manifest(self.path)
+        self.assertEqual(6, m.count)
+        self.assertEqual([b'a', b'b'], [m.name(i) for i in m.children(0)])
+        a = m.find_child(0, 'a')
+        self.assertEqual([b'y', b'z'], [m.name(i) for i in m.children(a)])
+        b = m.find_child(0, 'b')
+        c = m.find_child(b, 'c')
+        self.assertEqual(3, m.record(c)[4])
+        self.assertTrue(m.matches(c, FakeDirStat(4)))
+        self.assertFalse(m.matches(c, FakeDirStat(5)))
+        self.assertEqual(None, m.find_child(0, 'c'))
+        self.assertEqual(0, len(m.children(c)))
+        m.close()
+
+    def test_load_mismatch(self):
+        writer = manifest.ManifestWriter(b'f' * 40)
+        writer.add('', FakeDirStat(1), 0)
+        writer.write(self.path)
+        self.assertEqual(None, manifest.Manifest.load(self.path, b'e' * 40))
+        self.assertEqual(None, manifest.Manifest.load(self.path + '.x',
+                                                      b'f' * 40))
+        with open(self.path, 'wb') as f:
+            f.write(b'garbage')
+        self.assertEqual(None, manifest.Manifest.load(self.path, b'f' * 40))
+
+
+@unittest.skipUnless(os.geteuid() == 0, 'requires root to chown')
+class ShiftDirManifestTestCase(BaseTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'root')
+        self.path = os.path.join(self.tmp, 'manifest')
+        for i in range(3):
+            dirpath = os.path.join(self.root, 'd%d' % i, 'x')
+            os.makedirs(dirpath)
+            for j in range(3):
+                open(os.path.join(dirpath, 'f%d' % j), 'w').close()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in dirnames + filenames + ['.']:
+                os.lchown(os.path.join(dirpath, name), 0, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def shift(self):
+        return idmapshift.shift_dir(self.root, self.uid_maps, self.gid_maps,
+                                    main.NOBODY_ID, manifest=self.path)
+
+    def confirm(self):
+        return idmapshift.confirm_dir(self.root, self.uid_maps,
+                                      self.gid_maps, main.NOBODY_ID,
+                                      manifest=self.path)
+
+    def test_incremental_shift(self):
+        result = self.shift()
+        self.assertEqual(result.visited, result.changed)
+        self.assertEqual(16, result.visited)
+
+        with mock.patch('os.scandir') as mock_scandir:
+            result = self.shift()
+        self.assertEqual(0, result.visited)
+        self.assertEqual(0, len(mock_scandir.mock_calls))
+
+        new = os.path.join(self.root, 'd1', 'x', 'new')
+        open(new, 'w').close()
+        os.lchown(new, 0, 0)
+        result = self.shift()
+        self.assertEqual(1, result.changed)
+        self.assertEqual(4, result.unchanged)
+        self.assertEqual(10000, os.lstat(new).st_uid)
+        self.assertTrue(self.confirm())
+
+    def test_incremental_confirm(self):
+        self.shift()
+        self.assertTrue(self.confirm())
+
+        new = os.path.join(self.root, 'd2', 'new')
+        os.mkdir(new)
+        os.lchown(new, 0, 0)
+        self.assertFalse(self.confirm())
+
+    def test_changed_dir_under_unchanged_parent(self):
+        self.shift()
+        subdir = os.path.join(self.root, 'd0', 'x')
+        os.lchown(subdir, 0, 0)
+        self.assertFalse(self.confirm())
+        self.shift()
+        self.assertEqual(10000, os.lstat(subdir).st_uid)
+        self.assertTrue(self.confirm())
+
+    def test_manifest_rejects_parallel(self):
+        self.assertRaises(ValueError, idmapshift.shift_dir, self.root,
+                          self.uid_maps, self.gid_maps, main.NOBODY_ID,
+                          manifest=self.path, jobs=2)
+        self.assertRaises(ValueError, idmapshift.shift_dir, self.root,
+                          self.uid_maps, self.gid_maps, main.NOBODY_ID,
+                          manifest=self.path, dry_run=True)
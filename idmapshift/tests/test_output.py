@@ -0,0 +1,121 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import mock
+import unittest
+
+import idmapshift
+from idmapshift import main
+from idmapshift import output
+from idmapshift.tests.test_idmapshift import BaseTestCase
+from idmapshift.tests.test_idmapshift import dir_stat
+from idmapshift.tests.test_idmapshift import scandir_side_effect
+from idmapshift.tests.test_parallel import build_tree
+
+
+class CountingStream(io.BytesIO):
+    def __init__(self):
+        super(CountingStream, self).__init__()
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return super(CountingStream, self).write(data)
+
+
+class OutputSinkTestCase(unittest.TestCase):
+    def test_text(self):
+        stream = io.BytesIO()
+        with output.OutputSink(stream) as sink:
+            sink('/a b', 0, 1, 10000, 10001)
+        self.assertEqual(b'/a b 0:1 -> 10000:10001\n', stream.getvalue())
+
+    def test_ndjson(self):
+        stream = io.BytesIO()
+        with output.OutputSink(stream, 'ndjson') as sink:
+            sink('/a"\n', 0, 1, 10000, 10001)
+            sink(b'/\xff', 2, 3, 10002, 10003)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual({'path': '/a"\n', 'uid': 0, 'gid': 1,
+                          'target_uid': 10000, 'target_gid': 10001},
+                         json.loads(lines[0]))
+        self.assertEqual('/\udcff', json.loads(lines[1])['path'])
+
+    def test_nul(self):
+        stream = io.BytesIO()
+        with output.OutputSink(stream, 'nul') as sink:
+            sink('/a\nb', 0, 1, 10000, 10001)
+        self.assertEqual(b'/a\nb\x000:1\x0010000:10001\x00',
+                         stream.getvalue())
+
+    def test_changes_only(self):
+        stream = io.BytesIO()
+        with output.OutputSink(stream, changes_only=True) as sink:
+            sink('/a', 10000, 10000, 10000, 10000)
+            sink('/b', 0, 10000, 10000, 10000)
+        self.assertEqual(b'/b 0:10000 -> 10000:10000\n', stream.getvalue())
+
+    def test_batches_writes(self):
+        stream = CountingStream()
+        sink = output.OutputSink(stream, buffer_size=100)
+        for i in range(100):
+            sink('/f%d' % i, 0, 0, 10000, 10000)
+        self.assertTrue(0 < stream.writes < 30)
+        sink.close()
+        self.assertEqual(100, len(stream.getvalue().splitlines()))
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, output.OutputSink, io.BytesIO(), 'xml')
+
+
+class ShiftDirOutputTestCase(BaseTestCase):
+    def run_shift(self, tree, **kwargs):
+        stream = io.BytesIO()
+        with mock.patch('os.lstat') as mock_lstat, \
+                mock.patch('os.scandir') as mock_scandir, \
+                mock.patch('os.lchown'), \
+                output.OutputSink(stream) as sink:
+            mock_lstat.return_value = dir_stat(0, 0)
+            mock_scandir.side_effect = scandir_side_effect(tree)
+            idmapshift.shift_dir('/tmp/test', self.uid_maps, self.gid_maps,
+                                 main.NOBODY_ID, verbose=True, printer=sink,
+                                 **kwargs)
+        return stream.getvalue()
+
+    def test_threads_match_serial(self):
+        tree = build_tree(3, 2)
+        serial = self.run_shift(tree)
+        self.assertEqual(serial, self.run_shift(tree, jobs=4))
+        self.assertEqual(sum(len(entries) for entries in tree.values()) + 1,
+                         len(serial.splitlines()))
+
+    @mock.patch('idmapshift.shift_dir')
+    @mock.patch('sys.stdout')
+    def test_main_output_format(self, mock_stdout, mock_shift_dir):
+        mock_stdout.buffer = io.BytesIO()
+
+        def shift_dir(*args, **kwargs):
+            kwargs['printer']('/a', 0, 0, 10000, 10000)
+            kwargs['printer']('/b', 10000, 10000, 10000, 10000)
+
+        mock_shift_dir.side_effect = shift_dir
+        argv = ['idmapshift', '-u', '0:10000:10', '-g', '0:10000:10', '-v',
+                '--output-format', 'nul', '--changes-only', '/tmp/test']
+        with mock.patch('sys.argv', argv):
+            main.main()
+        self.assertEqual(b'/a\x000:0\x0010000:10000\x00',
+                         mock_stdout.buffer.getvalue())
@@ -0,0 +1,232 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import idmapshift
+from idmapshift import main
+from idmapshift import parallel
+from idmapshift.tests.test_idmapshift import BaseTestCase
+from idmapshift.tests.test_idmapshift import dir_stat
+from idmapshift.tests.test_idmapshift import FakeStat
+from idmapshift.tests.test_idmapshift import scandir_side_effect
+
+
+def build_tree(width, depth):
+    tree = {}
+    pending = [('/tmp/test', 0)]
+    while pending:
+        path, level = pending.pop()
+        entries = []
+        for i in range(width):
+            if level < depth:
+                entries.append(('d%d' % i, dir_stat(i, level)))
+                pending.append(('%s/d%d' % (path, i), level + 1))
+            entries.append(('f%d' % i, FakeStat(level, 30000 * (i % 2))))
+        tree[path] = entries
+    return tree
+
+
+class ShiftDirThreadsTestCase(BaseTestCase):
+    def run_shift(self, tree, **kwargs):
+        with mock.patch('os.lstat') as mock_lstat, \
+                mock.patch('os.scandir') as mock_scandir, \
+                mock.patch('os.lchown') as mock_lchown, \
+                mock.patch('idmapshift.print_chown') as mock_print:
+            mock_lstat.return_value = dir_stat(0, 0)
+            mock_scandir.side_effect = scandir_side_effect(tree)
+            result = idmapshift.shift_dir('/tmp/test', self.uid_maps,
+                                          self.gid_maps, main.NOBODY_ID,
+                                          verbose=True, **kwargs)
+        return result, mock_lchown.mock_calls, mock_print.mock_calls
+
+    def test_threads_match_serial(self):
+        tree = build_tree(4, 3)
+        serial, serial_chowns, serial_lines = self.run_shift(tree)
+        threaded, threaded_chowns, threaded_lines = self.run_shift(tree,
+                                                                   jobs=4)
+
+        self.assertEqual(serial.as_dict(), threaded.as_dict())
+        self.assertEqual(sorted(serial_chowns), sorted(threaded_chowns))
+        self.assertEqual(serial_lines, threaded_lines)
+        self.assertEqual(1 + 4 * (1 + 4 + 16 + 64) + 4 * (1 + 4 + 16),
+                         threaded.visited)
+
+    def test_threads_dry_run(self):
+        tree = build_tree(2, 2)
+        result, chowns, lines = self.run_shift(tree, jobs=2, dry_run=True)
+        self.assertEqual([], chowns)
+        self.assertEqual(result.visited, len(lines))
+
+    @mock.patch('os.lchown')
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_threads_raise_worker_error(self, mock_lstat, mock_scandir,
+                                        mock_lchown):
+        mock_lstat.return_value = dir_stat(0, 0)
+        mock_scandir.side_effect = scandir_side_effect(build_tree(2, 2))
+
+        def lchown(path, uid, gid):
+            if path.endswith('d1/f0'):
+                raise OSError('Read-only file system')
+
+        mock_lchown.side_effect = lchown
+
+        self.assertRaises(OSError, idmapshift.shift_dir, '/tmp/test',
+                          self.uid_maps, self.gid_maps, main.NOBODY_ID,
+                          jobs=2)
+
+    def test_threads_reject_fd_relative(self):
+        self.assertRaises(ValueError, idmapshift.shift_dir, '/tmp/test',
+                          self.uid_maps, self.gid_maps, main.NOBODY_ID,
+                          fd_relative=True, jobs=2)
+
+
+class ProcessesTestCase(BaseTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for i in range(3):
+            subdir = os.path.join(self.root, 'd%d' % i, 'e')
+            os.makedirs(subdir)
+            for j in range(5):
+                open(os.path.join(subdir, 'f%d' % j), 'w').close()
+        self.uid = os.lstat(self.root).st_uid
+        self.gid = os.lstat(self.root).st_gid
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_shift_dir_processes_dry_run(self):
+        serial = idmapshift.shift_dir(self.root, self.uid_maps, self.gid_maps,
+                                      main.NOBODY_ID, dry_run=True)
+        sharded = idmapshift.shift_dir(self.root, self.uid_maps,
+                                       self.gid_maps, main.NOBODY_ID,
+                                       dry_run=True, processes=2)
+        self.assertEqual(serial.as_dict(), sharded.as_dict())
+        self.assertEqual(1 + 3 * 7, sharded.visited)
+
+    def test_shift_dir_processes_hardlinks(self):
+        target = os.path.join(self.root, 'd0', 'e', 'f0')
+        for i in range(3):
+            os.link(target, os.path.join(self.root, 'd%d' % i, 'link'))
+
+        result = idmapshift.shift_dir(self.root, self.uid_maps,
+                                      self.gid_maps, main.NOBODY_ID,
+                                      dry_run=True, processes=2)
+
+        self.assertEqual(1 + 3 * 7, result.visited)
+        self.assertEqual(3, result.hardlinks_skipped)
+
+    @unittest.skipUnless(os.geteuid() == 0, 'requires root to chown')
+    def test_shift_dir_processes_hardlinks_shifted_once(self):
+        target = os.path.join(self.root, 'd0', 'e', 'f0')
+        os.lchown(target, 0, 0)
+        for i in range(3):
+            for j in range(4):
+                os.link(target, os.path.join(self.root, 'd%d' % i,
+                                             'link%d' % j))
+        maps = [(0, 100000, 65536)]
+
+        result = idmapshift.shift_dir(self.root, maps, maps, main.NOBODY_ID,
+                                      processes=3)
+
+        self.assertEqual(12, result.hardlinks_skipped)
+        self.assertEqual(100000, os.lstat(target).st_uid)
+        self.assertEqual(100000, os.lstat(target).st_gid)
+
+    def test_shift_dir_processes_rejects_verbose(self):
+        self.assertRaises(ValueError, idmapshift.shift_dir, self.root,
+                          self.uid_maps, self.gid_maps, main.NOBODY_ID,
+                          verbose=True, processes=2)
+
+    def test_confirm_dir_processes(self):
+        maps = [(0, self.uid, 1)]
+        gid_maps = [(0, self.gid, 1)]
+        self.assertTrue(idmapshift.confirm_dir(self.root, maps, gid_maps,
+                                               main.NOBODY_ID, processes=2))
+        self.assertFalse(idmapshift.confirm_dir(self.root, self.uid_maps,
+                                                self.gid_maps, 50000,
+                                                processes=2))
+
+    def test_walk_budget_returns_unfinished(self):
+        seen = []
+
+        def visit(path, stat):
+            seen.append(path)
+            return True
+
+        visited, unfinished, stopped = parallel._walk_budget(
+            [self.root], 3, visit)
+
+        self.assertEqual(3, visited)
+        self.assertFalse(stopped)
+        self.assertEqual(sorted(seen), sorted(unfinished))
+
+        for path in unfinished:
+            more = parallel._walk_budget([path], 100, visit)
+            self.assertEqual([], more[1])
+        self.assertEqual(3 * 7, len(seen))
+
+    def test_walk_budget_stops(self):
+        visited, unfinished, stopped = parallel._walk_budget(
+            [self.root], 100, lambda path, stat: False)
+        self.assertEqual(1, visited)
+        self.assertEqual([], unfinished)
+        self.assertTrue(stopped)
+
+
+class ConfirmDirThreadsTestCase(BaseTestCase):
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_confirm_dir_threads(self, mock_lstat, mock_scandir):
+        tree = build_tree(3, 3)
+        shifted = dict((path, [(name, FakeStat(10000, 10000, st.st_mode))
+                               for name, st in entries])
+                       for path, entries in tree.items())
+        mock_lstat.return_value = dir_stat(10000, 10000)
+        mock_scandir.side_effect = scandir_side_effect(shifted)
+
+        self.assertTrue(idmapshift.confirm_dir('/tmp/test', self.uid_maps,
+                                               self.gid_maps, main.NOBODY_ID,
+                                               jobs=4))
+
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_confirm_dir_threads_stops_early(self, mock_lstat,
+                                             mock_scandir):
+        tree = build_tree(3, 3)
+        shifted = dict((path, [(name, FakeStat(10000, 10000, st.st_mode))
+                               for name, st in entries])
+                       for path, entries in tree.items())
+        shifted['/tmp/test'].insert(0, ('bad', FakeStat(0, 0)))
+        mock_lstat.return_value = dir_stat(10000, 10000)
+        mock_scandir.side_effect = scandir_side_effect(shifted)
+
+        self.assertFalse(idmapshift.confirm_dir('/tmp/test', self.uid_maps,
+                                                self.gid_maps,
+                                                main.NOBODY_ID, jobs=4))
+        self.assertEqual(1, len(mock_scandir.mock_calls))
+
+    @mock.patch('os.scandir')
+    @mock.patch('os.lstat')
+    def test_confirm_dir_threads_root(self, mock_lstat, mock_scandir):
+        mock_lstat.return_value = dir_stat(0, 0)
+        self.assertFalse(idmapshift.confirm_dir('/tmp/test', self.uid_maps,
+                                                self.gid_maps,
+                                                main.NOBODY_ID, jobs=4))
+        self.assertEqual(0, len(mock_scandir.mock_calls))
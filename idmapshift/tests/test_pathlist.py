@@ -0,0 +1,131 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import idmapshift
+from idmapshift import main
+from idmapshift import pathlist
+
+
+class ReadPathsTestCase(unittest.TestCase):
+    def test_read_paths(self):
+        stream = io.BytesIO(b'a\0bb/ccc\0\0d e\0last')
+        self.assertEqual(['a', 'bb/ccc', 'd e', 'last'],
+                         list(pathlist.read_paths(stream, chunk_size=3)))
+
+    def test_read_paths_base(self):
+        stream = io.BytesIO(b'a\0/abs\0')
+        self.assertEqual(['/root/a', '/abs'],
+                         list(pathlist.read_paths(stream, base='/root')))
+
+    def test_read_paths_undecodable(self):
+        stream = io.BytesIO(b'caf\xe9\0')
+        path = next(pathlist.read_paths(stream))
+        self.assertEqual(b'caf\xe9', os.fsencode(path))
+
+
+class ShiftPathsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.paths = []
+        for name in ('a', 'b', 'c'):
+            path = os.path.join(self.tmp, name)
+            open(path, 'w').close()
+            self.paths.append(path)
+        os.link(self.paths[0], os.path.join(self.tmp, 'a2'))
+        maps = [(os.getuid(), 10000, 1)]
+        self.shifter = idmapshift.IdMapShifter(maps, maps, main.NOBODY_ID)
+
+    @mock.patch('os.lchown')
+    def test_shift_paths(self, mock_lchown):
+        paths = [self.paths[0], self.paths[2],
+                 os.path.join(self.tmp, 'a2')]
+        result = self.shifter.shift_paths(iter(paths))
+        self.assertEqual(2, result.visited)
+        self.assertEqual(1, result.hardlinks_skipped)
+        self.assertEqual([mock.call(self.paths[0], 10000, 10000),
+                          mock.call(self.paths[2], 10000, 10000)],
+                         mock_lchown.call_args_list)
+
+    @mock.patch('os.lchown')
+    def test_shift_paths_dry_run(self, mock_lchown):
+        result = self.shifter.shift_paths(self.paths, dry_run=True)
+        self.assertEqual(3, result.changed)
+        self.assertFalse(mock_lchown.called)
+
+    def test_shift_paths_missing(self):
+        paths = [os.path.join(self.tmp, 'missing'), self.paths[1]]
+        result = self.shifter.shift_paths(paths, dry_run=True)
+        self.assertEqual(1, result.missing)
+        self.assertEqual(1, result.changed)
+
+    @mock.patch('os.lchown')
+    def test_shift_paths_listed_twice(self, mock_lchown):
+        paths = [self.tmp, self.paths[1], self.tmp, self.paths[1]]
+        result = self.shifter.shift_paths(paths)
+        self.assertEqual(2, result.visited)
+        self.assertEqual(2, result.hardlinks_skipped)
+        self.assertEqual([mock.call(self.tmp, 10000, 10000),
+                          mock.call(self.paths[1], 10000, 10000)],
+                         mock_lchown.call_args_list)
+
+    def test_confirm_paths_missing(self):
+        own = [(0, os.getuid(), 1)]
+        shifter = idmapshift.IdMapShifter(own, own, main.NOBODY_ID)
+        result = idmapshift.ShiftResult()
+        paths = self.paths + [os.path.join(self.tmp, 'missing')]
+        self.assertTrue(shifter.confirm_paths(paths, result=result))
+        self.assertEqual(1, result.missing)
+
+    def test_confirm_paths(self):
+        stats = idmapshift.Stats()
+        own = [(0, os.getuid(), 1)]
+        shifter = idmapshift.IdMapShifter(own, own, main.NOBODY_ID,
+                                          stats=stats)
+        self.assertTrue(shifter.confirm_paths(self.paths))
+        self.assertEqual(3, stats.entries)
+        self.assertEqual(3, stats.lstat.count)
+
+    def test_confirm_paths_stops_early(self):
+        paths = iter(self.paths)
+        self.assertFalse(self.shifter.confirm_paths(paths))
+        self.assertEqual(self.paths[1:], list(paths))
+
+    @mock.patch('os.lchown')
+    def test_main_paths_from(self, mock_lchown):
+        listing = os.path.join(self.tmp, 'list')
+        with open(listing, 'wb') as f:
+            f.write(b'b\0gone\0c\0')
+        own = '%d:10000:1' % os.getuid()
+        argv = ['idmapshift', '-u', own, '-g', own, '--paths-from', listing,
+                self.tmp]
+        stderr = io.StringIO()
+        with mock.patch('sys.argv', argv), mock.patch('sys.stderr', stderr):
+            main.main()
+        self.assertEqual([mock.call(self.paths[1], 10000, 10000),
+                          mock.call(self.paths[2], 10000, 10000)],
+                         mock_lchown.call_args_list)
+        self.assertEqual('Skipped 1 missing paths\n', stderr.getvalue())
+
+        argv += ['-j', '2']
+        with mock.patch('sys.argv', argv), mock.patch('sys.stderr'):
+            self.assertRaises(SystemExit, main.main)
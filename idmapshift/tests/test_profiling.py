@@ -0,0 +1,90 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mock
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from idmapshift import main
+from idmapshift import profiling
+from idmapshift import stats
+
+
+class SlowestTestCase(unittest.TestCase):
+    def test_keeps_slowest(self):
+        run_stats = stats.Stats(keep_slowest=3)
+        for ns in (5, 1, 9, 7, 3):
+            run_stats.note(ns, '/p%d' % ns, 'lstat')
+        other = run_stats.spawn()
+        other.note(8, '/q', 'chown')
+        run_stats.merge(other)
+        self.assertEqual(['/p9', '/q', '/p7'],
+                         [slow['path']
+                          for slow in run_stats.as_dict()['slowest']])
+
+    def test_off_by_default(self):
+        run_stats = stats.Stats()
+        run_stats.note(5, '/p', 'lstat')
+        self.assertEqual([], run_stats.slowest)
+        self.assertFalse('slowest' in run_stats.as_dict())
+
+
+class ProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'root')
+        os.makedirs(os.path.join(self.root, 'a'))
+        open(os.path.join(self.root, 'a', 'f'), 'w').close()
+        self.path = os.path.join(self.tmp, 'out.prof')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_run_records_phase(self):
+        profiler = profiling.Profiler()
+        self.assertEqual(6, profiler.run('add', sum, [1, 2, 3]))
+        self.assertRaises(ZeroDivisionError, profiler.run, 'div',
+                          lambda: 1 / 0)
+        self.assertEqual(set(['add', 'div']), set(profiler.phases))
+        self.assertEqual(profiling.SLOWEST, profiler.stats.keep_slowest)
+
+    @mock.patch('os.lchown')
+    def test_main_profile(self, mock_lchown):
+        argv = ['idmapshift', '-u', '0:10000:2000', '-g', '0:10000:2000',
+                '--profile', self.path, self.root]
+        with mock.patch('sys.argv', argv):
+            main.main()
+
+        profile = pstats.Stats(self.path)
+        functions = set(name for _, _, name in profile.stats)
+        self.assertTrue('shift_path' in functions)
+        with open(self.path + '.json') as f:
+            summary = json.load(f)
+        self.assertEqual(set(['parse', 'shift']), set(summary['phases']))
+        self.assertEqual(set(['lstat', 'lookup', 'chown', 'traversal']),
+                         set(summary['breakdown']))
+        self.assertEqual(5, len(summary['slowest']))
+
+    def test_main_profile_confirm(self):
+        argv = ['idmapshift', '-u', '0:10000:2000', '-g', '0:10000:2000',
+                '-c', '-j', '2', '--profile', self.path, self.root]
+        with mock.patch('sys.argv', argv):
+            self.assertRaises(SystemExit, main.main)
+        with open(self.path + '.json') as f:
+            summary = json.load(f)
+        self.assertTrue('confirm' in summary['phases'])
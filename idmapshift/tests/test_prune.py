@@ -0,0 +1,223 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import collections
+import io
+import json
+import mock
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import idmapshift
+from idmapshift import aio
+from idmapshift import batch
+from idmapshift import journal
+from idmapshift import main
+from idmapshift import prune
+
+DevStat = collections.namedtuple('DevStat', 'st_dev')
+
+EXCLUDES = ['keep/cache', 'var/l?g', '*.tmp']
+ENGINES = [dict(), dict(fd_relative=True), dict(jobs=2), dict(processes=2)]
+FILES = ['keep/f', 'keep/cache/f', 'var/log/f', 'x.tmp', 'z']
+PRUNED = ['keep/cache/f', 'var/log/f', 'x.tmp']
+
+
+class CompileExcludesTestCase(unittest.TestCase):
+    def matches(self, patterns, path):
+        return prune.compile_excludes(patterns).search(path) is not None
+
+    def test_prefix(self):
+        self.assertTrue(self.matches(['/var/log/'], 'var/log'))
+        self.assertTrue(self.matches(['var/log'], 'var/log/syslog'))
+        self.assertFalse(self.matches(['var/log'], 'var/logs'))
+        self.assertFalse(self.matches(['var/log'], 'srv/var/log'))
+        self.assertTrue(self.matches(['a.b'], 'a.b'))
+        self.assertFalse(self.matches(['a.b'], 'axb'))
+
+    def test_component_glob(self):
+        self.assertTrue(self.matches(['*.tmp'], 'x.tmp'))
+        self.assertTrue(self.matches(['*.tmp'], 'a/b/x.tmp/c'))
+        self.assertFalse(self.matches(['*.tmp'], 'x.tmpl'))
+        self.assertTrue(self.matches(['[!a]?'], 'd/bc'))
+        self.assertFalse(self.matches(['[!a]?'], 'd/ac'))
+
+    def test_path_glob(self):
+        self.assertTrue(self.matches(['home/*/.cache'], 'home/u/.cache/x'))
+        self.assertFalse(self.matches(['home/*/.cache'],
+                                      'home/u/v/.cache'))
+        self.assertFalse(self.matches(['home/*/.cache'],
+                                      'srv/home/u/.cache'))
+
+    def test_none(self):
+        self.assertIsNone(prune.compile_excludes(None))
+        self.assertIsNone(prune.compile_excludes([]))
+        self.assertRaises(ValueError, prune.compile_excludes, ['/'])
+
+
+class PrunerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.dev = os.lstat(self.tmp).st_dev
+
+    def test_one_file_system(self):
+        pruner = prune.Pruner(self.tmp, one_file_system=True)
+        path = os.path.join(self.tmp, 'mnt')
+        self.assertFalse(pruner(path, DevStat(self.dev)))
+        self.assertTrue(pruner(path, DevStat(self.dev + 1)))
+        self.assertEqual(1, pruner.pruned)
+
+    def test_excludes_are_relative(self):
+        pruner = prune.Pruner(self.tmp, ['tmp'])
+        stat = DevStat(self.dev)
+        self.assertFalse(pruner(os.path.join(self.tmp, 'a'), stat))
+        self.assertTrue(pruner(os.path.join(self.tmp, 'tmp'), stat))
+        self.assertFalse(pruner.listed('/tmp', stat))
+
+    def test_pickle_resets_count(self):
+        pruner = prune.Pruner(self.tmp, ['a'])
+        pruner(os.path.join(self.tmp, 'a'), DevStat(self.dev))
+        copy = pickle.loads(pickle.dumps(pruner))
+        self.assertEqual(0, copy.pruned)
+        self.assertTrue(copy(os.path.join(self.tmp, 'a'), DevStat(0)))
+
+    def test_fingerprint(self):
+        pruner = prune.Pruner(self.tmp, ['a'])
+        maps = [(0, 0, 1)]
+        self.assertNotEqual(journal.fingerprint(self.tmp, maps, maps, 1),
+                            journal.fingerprint(self.tmp, maps, maps, 1,
+                                                pruner))
+
+
+class TreeTestCase(unittest.TestCase):
+    """A tree of the caller's own files, shifted onto themselves."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        for name in FILES:
+            path = os.path.join(self.tmp, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        self.uid_maps = [(os.getuid(), os.getuid(), 1)]
+        self.gid_maps = [(os.getgid(), os.getgid(), 1)]
+
+
+class PruneTreeTestCase(TreeTestCase):
+    def shift(self, **kwargs):
+        stats = idmapshift.Stats()
+        result = idmapshift.shift_dir(self.tmp, self.uid_maps, self.gid_maps,
+                                      main.NOBODY_ID, stats=stats,
+                                      excludes=EXCLUDES, **kwargs)
+        self.assertEqual(3, stats.pruned)
+        return result
+
+    def check(self, result):
+        # The root, keep, keep/f, var and z.
+        self.assertEqual(5, result.visited)
+        self.assertEqual(3, result.pruned)
+
+    def test_engines(self):
+        for engine in ENGINES:
+            self.check(self.shift(**engine))
+
+    def test_journal_and_manifest(self):
+        path = self.tmp + '.state'
+        self.addCleanup(os.unlink, path)
+        self.check(self.shift(journal=path))
+        # The tree is shifted onto itself, so it confirms and is left.
+        result = self.shift(manifest=path)
+        self.assertEqual(0, result.visited)
+        self.assertEqual(3, result.pruned)
+
+    def test_batch(self):
+        spec = os.path.join(self.tmp, 'z')
+        with open(spec, 'w') as f:
+            json.dump([{'path': self.tmp, 'uid': self.uid_maps,
+                        'gid': self.gid_maps, 'exclude': 'keep/cache'}], f)
+        stats = idmapshift.Stats()
+        trees = batch.load_spec(spec, excludes=['var/l?g', '*.tmp'])
+        batch.shift_trees(trees, jobs=2, stats=stats)
+        self.check(trees[0].result)
+        self.assertEqual(3, stats.pruned)
+
+    def test_async(self):
+        result = asyncio.run(aio.shift_dir_async(
+            self.tmp, self.uid_maps, self.gid_maps, main.NOBODY_ID,
+            excludes=EXCLUDES))
+        self.check(result)
+
+    def test_paths(self):
+        shifter = idmapshift.IdMapShifter(self.uid_maps, self.gid_maps,
+                                          main.NOBODY_ID, excludes=EXCLUDES)
+        paths = [os.path.join(self.tmp, name) for name in FILES]
+        result = shifter.shift_paths(paths, root=self.tmp)
+        self.assertEqual(2, result.visited)
+        self.assertEqual(3, result.pruned)
+        self.assertRaises(ValueError, shifter.shift_paths, paths)
+
+    def test_main(self):
+        uid = '%d:%d:1' % (os.getuid(), os.getuid())
+        gid = '%d:%d:1' % (os.getgid(), os.getgid())
+        argv = ['idmapshift', '-u', uid, '-g', gid, '--exclude', 'keep/cache',
+                '--exclude', 'var/l?g', '--exclude', '*.tmp', self.tmp]
+        stderr = io.StringIO()
+        with mock.patch('sys.argv', argv), mock.patch('sys.stderr', stderr):
+            main.main()
+        self.assertEqual('Pruned 3 entries\n', stderr.getvalue())
+
+    def test_bad_pattern(self):
+        self.assertRaises(ValueError, idmapshift.IdMapShifter,
+                          self.uid_maps, self.gid_maps, main.NOBODY_ID,
+                          excludes=[''])
+
+
+@unittest.skipUnless(os.geteuid() == 0, 'requires root to chown')
+class PruneConfirmTestCase(TreeTestCase):
+    def setUp(self):
+        super(PruneConfirmTestCase, self).setUp()
+        for name in PRUNED:
+            os.lchown(os.path.join(self.tmp, name), 54321, 54321)
+
+    def confirm(self, excludes, **kwargs):
+        return idmapshift.confirm_dir(self.tmp, self.uid_maps,
+                                      self.gid_maps, main.NOBODY_ID,
+                                      excludes=excludes, **kwargs)
+
+    def test_confirm(self):
+        for engine in [dict(), dict(jobs=2), dict(processes=2)]:
+            self.assertFalse(self.confirm(None, **engine))
+            self.assertTrue(self.confirm(EXCLUDES, **engine))
+
+    def test_confirm_manifest(self):
+        manifest = os.path.join(self.tmp, 'z')
+        self.assertTrue(self.confirm(EXCLUDES, manifest=manifest))
+        self.assertFalse(self.confirm(['*.tmp'], manifest=manifest))
+
+    def test_confirm_stats(self):
+        stats = idmapshift.Stats()
+        self.assertTrue(self.confirm(EXCLUDES, stats=stats))
+        self.assertEqual(3, stats.pruned)
+
+    def test_confirm_async(self):
+        self.assertTrue(asyncio.run(aio.confirm_dir_async(
+            self.tmp, self.uid_maps, self.gid_maps, main.NOBODY_ID,
+            excludes=EXCLUDES)))
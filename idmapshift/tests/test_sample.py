@@ -0,0 +1,183 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+import mock
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import idmapshift
+from idmapshift import main
+from idmapshift import sample
+from idmapshift.tests.test_idmapshift import FakeStat
+
+DIRS = 4
+FILES = 6
+BAD = ['d1/bad0', 'd1/bad1', 'd3/bad0']
+
+
+class SampleResultTestCase(unittest.TestCase):
+    def test_weighted_estimate(self):
+        result = sample.SampleResult(0.95)
+        result.add('/a', True, 1.0)
+        result.add('/b', False, 3.0)
+        self.assertEqual(0.75, result.estimate())
+        self.assertEqual(1.6, result.effective_size())
+        self.assertFalse(result.confirmed())
+        self.assertEqual('/b', result.first_out_of_range)
+
+    def test_upper_bound(self):
+        result = sample.SampleResult(0.95)
+        self.assertEqual(1.0, result.upper_bound())
+        for i in range(100):
+            result.add('/p', True, 1.0)
+        self.assertEqual(0.0, result.estimate())
+        self.assertAlmostEqual(0.0263, result.upper_bound(), places=4)
+        result.confidence = 0.99
+        self.assertAlmostEqual(0.0513, result.upper_bound(), places=4)
+
+    def test_quota(self):
+        self.assertEqual(1, sample.per_dir_quota(1))
+        self.assertEqual(100, sample.per_dir_quota(10000))
+
+    def test_normal_quantile(self):
+        self.assertAlmostEqual(0.0, sample.normal_quantile(0.5))
+        self.assertAlmostEqual(1.644854, sample.normal_quantile(0.95),
+                               places=6)
+        self.assertAlmostEqual(-2.326348, sample.normal_quantile(0.01),
+                               places=6)
+
+
+class ConfirmSampleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        for d in range(DIRS):
+            dirpath = os.path.join(self.tmp, 'd%d' % d)
+            os.makedirs(dirpath)
+            for f in range(FILES):
+                open(os.path.join(dirpath, 'f%d' % f), 'w').close()
+        for name in BAD:
+            open(os.path.join(self.tmp, name), 'w').close()
+        self.entries = 1 + DIRS + DIRS * FILES + len(BAD)
+        own = [(0, os.getuid(), 1)]
+        self.shifter = idmapshift.IdMapShifter(own, own, main.NOBODY_ID)
+        self.uid_ranges, self.gid_ranges = self.shifter.host_ranges()
+
+    def lstat(self, path, dir_fd=None):
+        real = os.lstat(path)
+        uid = os.getuid()
+        if os.path.basename(path).startswith('bad'):
+            uid = 54321
+        return FakeStat(uid, real.st_gid, mode=real.st_mode)
+
+    def confirm(self, size, **kwargs):
+        return sample.confirm_sample(self.tmp, self.uid_ranges,
+                                     self.gid_ranges, main.NOBODY_ID, size,
+                                     rng=random.Random(7), **kwargs)
+
+    def test_confirmed(self):
+        stats = idmapshift.Stats()
+        result = self.confirm(10, stats=stats)
+        self.assertTrue(result.confirmed())
+        self.assertEqual(10, result.checked)
+        self.assertEqual(10, stats.entries)
+        self.assertEqual(result.dirs, stats.dirs)
+        self.assertEqual(0.0, result.estimate())
+        self.assertLess(0.0, result.upper_bound())
+
+    def test_whole_tree(self):
+        result = self.confirm(1000, lstat=self.lstat, stop_early=False)
+        self.assertEqual(self.entries, result.checked)
+        self.assertEqual(1 + DIRS, result.dirs)
+        self.assertEqual(len(BAD), result.out_of_range)
+        self.assertAlmostEqual(len(BAD) / self.entries, result.estimate())
+
+    def test_stops_at_first_out_of_range(self):
+        result = self.confirm(1000, lstat=self.lstat)
+        self.assertEqual(1, result.out_of_range)
+        self.assertEqual('bad', os.path.basename(
+            result.first_out_of_range)[:3])
+        self.assertLess(result.checked, self.entries)
+
+    def test_entry_filter(self):
+        result = self.confirm(1000, lstat=self.lstat,
+                              entry_filter=lambda path, stat: 'bad' not in
+                              path)
+        self.assertTrue(result.confirmed())
+        self.assertEqual(self.entries - len(BAD), result.checked)
+
+    def test_random_order(self):
+        seen = set()
+        for seed in range(20):
+            result = sample.confirm_sample(
+                self.tmp, self.uid_ranges, self.gid_ranges, main.NOBODY_ID,
+                2 + FILES, lstat=self.lstat, stop_early=False,
+                rng=random.Random(seed))
+            seen.add(result.out_of_range > 0)
+        self.assertEqual(set([True, False]), seen)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.confirm, 0)
+        self.assertRaises(ValueError, self.confirm, 10, confidence=1)
+
+    def test_shifter_prunes(self):
+        own = [(0, os.getuid(), 1)]
+        stats = idmapshift.Stats()
+        shifter = idmapshift.IdMapShifter(own, own, main.NOBODY_ID,
+                                          stats=stats, excludes=['d1'])
+        result = shifter.confirm_sample(self.tmp, 1000,
+                                        rng=random.Random(7))
+        self.assertTrue(result.confirmed())
+        self.assertEqual(self.entries - 1 - FILES - 2, result.checked)
+        self.assertEqual(1, result.pruned)
+        self.assertEqual(1, stats.pruned)
+
+    def main(self, *args):
+        uid = '0:%d:1' % os.getuid()
+        gid = '0:%d:1' % os.getgid()
+        argv = ['idmapshift', '-u', uid, '-g', gid] + list(args)
+        stderr = io.StringIO()
+        with mock.patch('sys.argv', argv), mock.patch('sys.stderr', stderr):
+            try:
+                main.main()
+            except SystemExit as e:
+                return e.code, stderr.getvalue()
+
+    def test_main(self):
+        code, output = self.main('--confirm-sample', '20', self.tmp)
+        self.assertEqual(0, code)
+        self.assertTrue(output.startswith('Sampled 20 entries in '))
+        self.assertIn('with 95% confidence', output)
+
+    def test_main_errors(self):
+        for args in (['-j', '2'], ['--manifest', 'm'],
+                     ['--confidence', '1.5']):
+            code, output = self.main('--confirm-sample', '20', self.tmp,
+                                     *args)
+            self.assertEqual(2, code)
+        code, output = self.main('--confirm-sample', '0', self.tmp)
+        self.assertEqual(2, code)
+
+    @unittest.skipUnless(os.geteuid() == 0, 'requires root to chown')
+    def test_main_out_of_range(self):
+        bad = os.path.join(self.tmp, 'd2')
+        os.lchown(bad, 54321, 54321)
+        code, output = self.main('--confirm-sample', '1000', self.tmp)
+        self.assertEqual(1, code)
+        self.assertTrue(output.startswith('%s is out of range\n' % bad))
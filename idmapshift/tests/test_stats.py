@@ -0,0 +1,137 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import idmapshift
+from idmapshift import main
+from idmapshift import stats
+from idmapshift.tests.test_idmapshift import BaseTestCase
+from idmapshift.tests.test_idmapshift import dir_stat
+from idmapshift.tests.test_idmapshift import scandir_side_effect
+from idmapshift.tests.test_parallel import build_tree
+
+
+class LatencyTestCase(unittest.TestCase):
+    def test_percentiles(self):
+        latency = stats.Latency()
+        for ns in range(1, 1001):
+            latency.add(ns * 1000)
+        self.assertEqual(1000, latency.count)
+        self.assertEqual(1000000, latency.max_ns)
+        for p, expected in ((50, 500000), (90, 900000), (99, 990000)):
+            value = latency.percentile(p)
+            self.assertTrue(expected <= value <= expected * 1.2,
+                            (p, value))
+        self.assertEqual(1000000, latency.percentile(100))
+
+    def test_merge(self):
+        a = stats.Latency()
+        b = stats.Latency()
+        a.add(10)
+        b.add(1000)
+        b.add(0)
+        a.merge(b)
+        self.assertEqual(3, a.count)
+        self.assertEqual(1010, a.total_ns)
+        self.assertEqual(1000, a.max_ns)
+        self.assertEqual(0, stats.Latency().percentile(50))
+
+
+class ShiftDirStatsTestCase(BaseTestCase):
+    def run_shift(self, tree, **kwargs):
+        run_stats = stats.Stats()
+        with mock.patch('os.lstat') as mock_lstat, \
+                mock.patch('os.scandir') as mock_scandir, \
+                mock.patch('os.lchown'):
+            mock_lstat.return_value = dir_stat(0, 0)
+            mock_scandir.side_effect = scandir_side_effect(tree)
+            result = idmapshift.shift_dir('/tmp/test', self.uid_maps,
+                                          self.gid_maps, main.NOBODY_ID,
+                                          stats=run_stats, **kwargs)
+        return result, run_stats
+
+    def test_counters(self):
+        tree = build_tree(3, 2)
+        result, run_stats = self.run_shift(tree)
+        self.assertEqual(result.visited, run_stats.entries)
+        self.assertEqual(len(tree), run_stats.dirs)
+        self.assertEqual(result.changed, run_stats.chowns)
+        self.assertEqual(result.unchanged, run_stats.skips)
+        self.assertEqual(run_stats.entries - 1, run_stats.lstat.count)
+        self.assertEqual(run_stats.chowns, run_stats.lchown.count)
+        self.assertEqual(2 * result.visited, run_stats.lookups)
+        self.assertTrue(run_stats.memo_hits > 0)
+        self.assertTrue(run_stats.wall_ns > 0)
+
+        data = run_stats.as_dict()
+        self.assertEqual(run_stats.memo_hits / float(run_stats.lookups),
+                         data['memo_hit_rate'])
+        self.assertEqual(run_stats.chowns, data['lchown']['count'])
+
+    def test_dry_run_makes_no_chowns(self):
+        result, run_stats = self.run_shift(build_tree(3, 1), dry_run=True)
+        self.assertEqual(0, run_stats.chowns)
+        self.assertEqual(0, run_stats.lchown.count)
+        self.assertEqual(result.unchanged, run_stats.skips)
+
+    def test_threads_match_serial(self):
+        tree = build_tree(3, 2)
+        serial = self.run_shift(tree)[1]
+        threaded = self.run_shift(tree, jobs=4)[1]
+        for counter in ('entries', 'dirs', 'chowns', 'skips', 'lookups'):
+            self.assertEqual(getattr(serial, counter),
+                             getattr(threaded, counter), counter)
+        self.assertEqual(serial.lstat.count, threaded.lstat.count)
+
+
+class MainStatsTestCase(BaseTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'root')
+        os.makedirs(os.path.join(self.root, 'a'))
+        open(os.path.join(self.root, 'a', 'f'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    @mock.patch('os.lchown')
+    def test_stats_json(self, mock_lchown):
+        path = os.path.join(self.tmp, 'stats.json')
+        argv = ['idmapshift', '-u', '0:10000:2000', '-g', '0:10000:2000',
+                '--stats-json', path, self.root]
+        with mock.patch('sys.argv', argv):
+            main.main()
+        with open(path) as f:
+            data = json.load(f)
+        self.assertEqual(3, data['entries'])
+        self.assertEqual(2, data['dirs'])
+        self.assertEqual(len(mock_lchown.mock_calls), data['chowns'])
+        self.assertTrue('p99_us' in data['lstat'])
+
+    def test_stats_json_parallel_confirm(self):
+        path = os.path.join(self.tmp, 'stats.json')
+        for extra in (['-j', '4'], ['-P', '2'], ['--manifest', path]):
+            argv = ['idmapshift', '-u', '0:10000:2000', '-g',
+                    '0:10000:2000', '--confirm', '--stats-json', path,
+                    self.root] + extra
+            with mock.patch('sys.argv', argv), mock.patch('sys.stderr'):
+                with self.assertRaises(SystemExit) as cm:
+                    main.main()
+            self.assertEqual(2, cm.exception.code)
@@ -0,0 +1,144 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import ctypes
+import errno
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import idmapshift
+from idmapshift import main
+from idmapshift import statx
+
+FIELDS = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid', 'st_gid')
+
+
+def failing_statx(err):
+    def fake(dirfd, path, flags, mask, buf):
+        ctypes.set_errno(err)
+        return -1
+    return fake
+
+
+class TreeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        os.makedirs(os.path.join(self.tmp, 'd'))
+        open(os.path.join(self.tmp, 'd', 'f'), 'w').close()
+        os.link(os.path.join(self.tmp, 'd', 'f'),
+                os.path.join(self.tmp, 'g'))
+        os.symlink('d/f', os.path.join(self.tmp, 'l'))
+
+
+class StatxTestCase(TreeTestCase):
+    def assertSameStat(self, expected, actual):
+        self.assertEqual([getattr(expected, f) for f in FIELDS],
+                         [getattr(actual, f) for f in FIELDS])
+
+    @unittest.skipUnless(statx.available(), 'statx is not available')
+    def test_matches_lstat(self):
+        for dont_sync in (False, True):
+            lstat = statx.Lstat(dont_sync)
+            for name in ('d', 'g', 'l'):
+                path = os.path.join(self.tmp, name)
+                stat = lstat(path)
+                self.assertIsInstance(stat, statx.StatxResult)
+                self.assertSameStat(os.lstat(path), stat)
+
+    @unittest.skipUnless(statx.available(), 'statx is not available')
+    def test_dir_fd(self):
+        fd = os.open(self.tmp, os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        self.assertSameStat(os.lstat(os.path.join(self.tmp, 'l')),
+                            statx.Lstat()('l', fd))
+
+    @unittest.skipUnless(statx.available(), 'statx is not available')
+    def test_missing(self):
+        self.assertRaises(FileNotFoundError, statx.Lstat(),
+                          os.path.join(self.tmp, 'missing'))
+
+    def test_fallback(self):
+        path = os.path.join(self.tmp, 'g')
+        with mock.patch.object(statx, '_statx', None):
+            self.assertFalse(statx.available())
+            stat = statx.Lstat()(path)
+        self.assertIsInstance(stat, os.stat_result)
+
+    def test_fallback_when_refused(self):
+        path = os.path.join(self.tmp, 'g')
+        with mock.patch.object(statx, '_statx',
+                               failing_statx(errno.ENOSYS)):
+            self.assertIsInstance(statx.Lstat()(path), os.stat_result)
+            self.assertFalse(statx.available())
+
+    def test_fallback_when_fields_missing(self):
+        path = os.path.join(self.tmp, 'g')
+        with mock.patch.object(statx, '_statx', lambda *args: 0):
+            self.assertIsInstance(statx.Lstat()(path), os.stat_result)
+
+    def test_error(self):
+        with mock.patch.object(statx, '_statx',
+                               failing_statx(errno.EACCES)):
+            self.assertRaises(PermissionError, statx.Lstat(), 'x')
+
+
+class StatxWalkTestCase(TreeTestCase):
+    def setUp(self):
+        super(StatxWalkTestCase, self).setUp()
+        self.uid_maps = [(os.getuid(), 10000, 1)]
+        self.gid_maps = [(os.getgid(), 10000, 1)]
+
+    def shift(self, **kwargs):
+        lines = []
+        result = idmapshift.shift_dir(self.tmp, self.uid_maps, self.gid_maps,
+                                      main.NOBODY_ID, dry_run=True,
+                                      verbose='processes' not in kwargs,
+                                      printer=lambda *a: lines.append(a),
+                                      **kwargs)
+        return result.as_dict(), sorted(lines)
+
+    def test_shift(self):
+        for engine in [dict(), dict(fd_relative=True), dict(jobs=2),
+                       dict(processes=2)]:
+            self.assertEqual(self.shift(**engine),
+                             self.shift(statx=True, dont_sync=True,
+                                        **engine))
+
+    def test_confirm(self):
+        own = [(0, os.getuid(), 1)]
+        for engine in [dict(), dict(jobs=2), dict(processes=2)]:
+            self.assertTrue(idmapshift.confirm_dir(
+                self.tmp, own, [(0, os.getgid(), 1)], main.NOBODY_ID,
+                statx=True, **engine))
+            self.assertFalse(idmapshift.confirm_dir(
+                self.tmp, self.uid_maps, self.gid_maps, main.NOBODY_ID,
+                statx=True, **engine))
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, idmapshift.IdMapShifter,
+                          self.uid_maps, self.gid_maps, main.NOBODY_ID,
+                          dont_sync=True)
+        shifter = idmapshift.IdMapShifter(self.uid_maps, self.gid_maps,
+                                          main.NOBODY_ID, statx=True)
+        manifest = self.tmp + '.manifest'
+        self.assertRaises(ValueError, shifter.shift, self.tmp,
+                          manifest=manifest)
+        self.assertRaises(ValueError, shifter.confirm, self.tmp,
+                          manifest=manifest)
+        self.assertFalse(os.path.exists(manifest))
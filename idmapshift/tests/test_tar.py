@@ -0,0 +1,138 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import mock
+import os
+import shutil
+import tarfile
+import tempfile
+
+from idmapshift import main
+from idmapshift import tar
+from idmapshift.tests.test_idmapshift import BaseTestCase
+
+
+def build_archive(mode='w', fmt=tarfile.PAX_FORMAT):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode, format=fmt) as archive:
+        def add(name, uid, gid, data=None, **attrs):
+            info = tarfile.TarInfo(name)
+            info.uid = uid
+            info.gid = gid
+            info.uname = 'guest'
+            info.gname = 'guest'
+            for key, value in attrs.items():
+                setattr(info, key, value)
+            if data is not None:
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+            else:
+                archive.addfile(info)
+
+        add('etc', 0, 0, type=tarfile.DIRTYPE)
+        add('etc/passwd', 0, 0, data=b'root:x:0:0\n')
+        add('home/user/big', 5, 20, data=b'x' * 100000)
+        add('bin/sh', 0, 0, type=tarfile.SYMTYPE, linkname='dash')
+        add('etc/passwd.bak', 0, 0, type=tarfile.LNKTYPE,
+            linkname='etc/passwd')
+        add('outside', 3000000, 0, data=b'',
+            pax_headers={'uid': '3000000', 'comment': 'kept'})
+    buf.seek(0)
+    return buf
+
+
+class ShiftTarTestCase(BaseTestCase):
+    def shift(self, src):
+        dst = io.BytesIO()
+        result = tar.shift_tar(src, dst, self.uid_maps, self.gid_maps,
+                               main.NOBODY_ID)
+        dst.seek(0)
+        return result, tarfile.open(fileobj=dst, mode='r:')
+
+    def test_shift_tar(self):
+        result, shifted = self.shift(build_archive())
+        members = dict((m.name, m) for m in shifted.getmembers())
+        self.assertEqual(6, result.visited)
+        self.assertEqual(1, result.mapped_to_nobody)
+
+        self.assertEqual((10000, 10000), (members['etc'].uid,
+                                          members['etc'].gid))
+        self.assertEqual((10005, 20010), (members['home/user/big'].uid,
+                                          members['home/user/big'].gid))
+        self.assertEqual(main.NOBODY_ID, members['outside'].uid)
+        self.assertEqual(str(main.NOBODY_ID),
+                         members['outside'].pax_headers['uid'])
+        self.assertEqual('kept', members['outside'].pax_headers['comment'])
+        for member in members.values():
+            self.assertEqual('', member.uname)
+            self.assertEqual('', member.gname)
+
+        self.assertEqual('dash', members['bin/sh'].linkname)
+        self.assertTrue(members['etc/passwd.bak'].islnk())
+        self.assertEqual(b'root:x:0:0\n',
+                         shifted.extractfile('etc/passwd').read())
+        self.assertEqual(b'x' * 100000,
+                         shifted.extractfile('home/user/big').read())
+
+    def test_members_not_retained(self):
+        opened = []
+        real_open = tarfile.open
+
+        def recording_open(*args, **kwargs):
+            archive = real_open(*args, **kwargs)
+            opened.append(archive)
+            return archive
+
+        src = io.BytesIO()
+        with tarfile.open(fileobj=src, mode='w') as archive:
+            for i in range(300):
+                info = tarfile.TarInfo('f%d' % i)
+                info.size = 1
+                archive.addfile(info, io.BytesIO(b'x'))
+        src.seek(0)
+        dst = io.BytesIO()
+        with mock.patch('tarfile.open', recording_open):
+            result = tar.shift_tar(src, dst, self.uid_maps, self.gid_maps,
+                                   main.NOBODY_ID)
+        self.assertEqual(300, result.visited)
+        self.assertEqual(2, len(opened))
+        for archive in opened:
+            self.assertEqual([], archive.members)
+        dst.seek(0)
+        self.assertEqual(300, len(tarfile.open(fileobj=dst).getmembers()))
+
+    def test_compressed_gnu_input(self):
+        result, shifted = self.shift(build_archive('w:gz',
+                                                   tarfile.GNU_FORMAT))
+        self.assertEqual(6, len(shifted.getmembers()))
+        self.assertEqual(10000, shifted.getmember('etc/passwd').uid)
+
+    def test_main_tar(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        src = os.path.join(tmp, 'in.tar')
+        dst = os.path.join(tmp, 'out.tar')
+        with open(src, 'wb') as f:
+            f.write(build_archive().getvalue())
+        argv = ['idmapshift', '-u', '0:10000:2000', '-g', '0:10000:2000',
+                '--tar', '--tar-output', dst, src]
+        with mock.patch('sys.argv', argv):
+            main.main()
+        with tarfile.open(dst) as shifted:
+            self.assertEqual(10000, shifted.getmember('etc').uid)
+
+        argv += ['--dry-run']
+        with mock.patch('sys.argv', argv), mock.patch('sys.stderr'):
+            self.assertRaises(SystemExit, main.main)
@@ -0,0 +1,239 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import errno
+import mock
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import unittest
+
+import idmapshift
+from idmapshift import main
+from idmapshift.tests.test_idmapshift import BaseTestCase
+from idmapshift.tests.test_idmapshift import FakeStat
+from idmapshift import xattrs
+
+UNDEFINED = 0xffffffff
+
+
+def acl(*entries):
+    return xattrs.ACL_HEADER.pack(xattrs.ACL_VERSION) + b''.join(
+        xattrs.ACL_ENTRY.pack(*entry) for entry in entries)
+
+
+def capability(rootid, revision=xattrs.VFS_CAP_REVISION_3):
+    if revision != xattrs.VFS_CAP_REVISION_3:
+        return struct.pack('<IIIII', revision | 1, 1 << 10, 0, 0, 0)
+    return xattrs.CAP_V3.pack(revision | 1, 1 << 10, 0, 0, 0, rootid)
+
+
+def access_acl(user, group):
+    return acl((0x01, 6, UNDEFINED), (xattrs.ACL_USER, 6, user),
+               (0x04, 4, UNDEFINED), (xattrs.ACL_GROUP, 4, group),
+               (0x10, 6, UNDEFINED), (0x20, 4, UNDEFINED))
+
+
+class TranslateTestCase(BaseTestCase):
+    def uid_map(self, fsid):
+        return idmapshift.find_target_id(fsid, self.uid_maps,
+                                         main.NOBODY_ID, dict())
+
+    def test_shift_acl(self):
+        self.assertEqual(access_acl(10005, 20002),
+                         xattrs.shift_acl(access_acl(5, 12), self.uid_map,
+                                          self.uid_map))
+        self.assertEqual(access_acl(10005, main.NOBODY_ID),
+                         xattrs.shift_acl(access_acl(5, 5000), self.uid_map,
+                                          self.uid_map))
+
+    def test_shift_acl_leaves_unknown_alone(self):
+        for value in (b'', b'\x01\x00\x00\x00' + b'\x02\x00' * 4,
+                      access_acl(5, 12)[:-1]):
+            self.assertEqual(value, xattrs.shift_acl(value, self.uid_map,
+                                                     self.uid_map))
+
+    def test_shift_capability(self):
+        self.assertEqual(capability(10000),
+                         xattrs.shift_capability(capability(0),
+                                                 self.uid_map))
+        v2 = capability(0, revision=0x02000000)
+        self.assertEqual(v2, xattrs.shift_capability(v2, self.uid_map))
+
+    @mock.patch('os.setxattr')
+    def test_shift(self, mock_setxattr):
+        values = {xattrs.ACL_DEFAULT: access_acl(10005, 20002),
+                  xattrs.CAPABILITY: capability(10000)}
+        shifted = {xattrs.ACL_DEFAULT: access_acl(10005, 20002),
+                   xattrs.CAPABILITY: capability(10000)}
+        self.assertEqual(0, xattrs.shift('/p', values, lambda i: i,
+                                         lambda i: i))
+        self.assertEqual(1, xattrs.shift('/p', values, lambda i: i,
+                                         lambda i: i, chowned=True))
+        mock_setxattr.assert_called_once_with(
+            '/p', xattrs.CAPABILITY, shifted[xattrs.CAPABILITY],
+            follow_symlinks=False)
+
+    @mock.patch('os.getxattr')
+    @mock.patch('os.listxattr')
+    def test_read(self, mock_listxattr, mock_getxattr):
+        mock_listxattr.return_value = ['user.x', xattrs.ACL_ACCESS]
+        mock_getxattr.return_value = b'acl'
+        self.assertEqual({xattrs.ACL_ACCESS: b'acl'}, xattrs.read('/p'))
+        mock_getxattr.assert_called_once_with('/p', xattrs.ACL_ACCESS,
+                                              follow_symlinks=False)
+
+        mock_listxattr.side_effect = OSError(errno.ENOTSUP, 'no')
+        self.assertEqual({}, xattrs.read('/p'))
+        mock_listxattr.side_effect = OSError(errno.EIO, 'io')
+        self.assertRaises(OSError, xattrs.read, '/p')
+
+
+class DirFdTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        for name in ('f', 'g'):
+            open(os.path.join(self.tmp, name), 'w').close()
+        self.dir_fd = os.open(self.tmp, os.O_RDONLY | os.O_DIRECTORY)
+        self.addCleanup(os.close, self.dir_fd)
+
+    @mock.patch('os.setxattr')
+    @mock.patch('os.getxattr')
+    @mock.patch('os.listxattr')
+    def test_relative_to_dir_fd(self, mock_listxattr, mock_getxattr,
+                                mock_setxattr):
+        mock_listxattr.return_value = [xattrs.ACL_ACCESS]
+        mock_getxattr.return_value = access_acl(5, 12)
+        stat = os.lstat(os.path.join(self.tmp, 'f'))
+        values = xattrs.read('/elsewhere/f', self.dir_fd, 'f', stat)
+        self.assertEqual({xattrs.ACL_ACCESS: access_acl(5, 12)}, values)
+        path = mock_listxattr.call_args[0][0]
+        self.assertTrue(path.startswith('/proc/self/fd/'))
+        self.assertEqual(1, xattrs.shift('/elsewhere/f', values,
+                                         lambda i: i + 1, lambda i: i,
+                                         dir_fd=self.dir_fd, name='f',
+                                         stat=stat))
+        self.assertTrue(mock_setxattr.call_args[0][0].startswith(
+            '/proc/self/fd/'))
+
+    @mock.patch('os.setxattr')
+    @mock.patch('os.listxattr')
+    def test_swapped_entry_left_alone(self, mock_listxattr, mock_setxattr):
+        # f has been replaced since it was stat'ed.
+        stat = os.lstat(os.path.join(self.tmp, 'g'))
+        self.assertEqual({}, xattrs.read('f', self.dir_fd, 'f', stat))
+        self.assertEqual(0, xattrs.shift(
+            'f', {xattrs.ACL_ACCESS: access_acl(5, 12)}, lambda i: i + 1,
+            lambda i: i, dir_fd=self.dir_fd, name='f', stat=stat))
+        self.assertFalse(mock_listxattr.called)
+        self.assertFalse(mock_setxattr.called)
+
+        os.symlink('g', os.path.join(self.tmp, 'l'))
+        self.assertEqual({}, xattrs.read('l', self.dir_fd, 'l',
+                                         os.lstat(os.path.join(self.tmp,
+                                                               'l'))))
+        self.assertFalse(mock_listxattr.called)
+
+
+class ShiftPathXattrsTestCase(BaseTestCase):
+    def shift(self, fake_stat, **kwargs):
+        result = idmapshift.ShiftResult()
+        idmapshift.shift_path('/p', self.uid_maps, self.gid_maps,
+                              main.NOBODY_ID, dict(), dict(), stat=fake_stat,
+                              result=result, xattrs=True, **kwargs)
+        return result
+
+    @mock.patch('os.setxattr')
+    @mock.patch('os.lchown')
+    @mock.patch('os.getxattr')
+    @mock.patch('os.listxattr')
+    def test_capability_restored_after_chown(self, mock_listxattr,
+                                             mock_getxattr, mock_lchown,
+                                             mock_setxattr):
+        calls = mock.Mock()
+        calls.attach_mock(mock_lchown, 'lchown')
+        calls.attach_mock(mock_setxattr, 'setxattr')
+        mock_listxattr.return_value = [xattrs.ACL_ACCESS, xattrs.CAPABILITY]
+        mock_getxattr.side_effect = lambda path, name, **kwargs: {
+            xattrs.CAPABILITY: capability(0),
+            xattrs.ACL_ACCESS: access_acl(5, 12)}[name]
+
+        result = self.shift(FakeStat(0, 0))
+
+        self.assertEqual(2, result.xattrs_shifted)
+        self.assertEqual([
+            mock.call.lchown('/p', 10000, 10000),
+            mock.call.setxattr('/p', xattrs.CAPABILITY, capability(10000),
+                               follow_symlinks=False),
+            mock.call.setxattr('/p', xattrs.ACL_ACCESS,
+                               access_acl(10005, 20002),
+                               follow_symlinks=False)], calls.mock_calls)
+
+    @mock.patch('os.setxattr')
+    @mock.patch('os.listxattr')
+    def test_dry_run_and_symlinks(self, mock_listxattr, mock_setxattr):
+        mock_listxattr.return_value = []
+        self.shift(FakeStat(0, 0, mode=stat.S_IFLNK), dry_run=True)
+        self.assertFalse(mock_listxattr.called)
+
+        with mock.patch('os.getxattr', return_value=access_acl(5, 12)):
+            mock_listxattr.return_value = [xattrs.ACL_DEFAULT]
+            result = self.shift(FakeStat(0, 0, mode=stat.S_IFDIR),
+                                dry_run=True)
+        self.assertEqual(1, result.xattrs_shifted)
+        self.assertFalse(mock_setxattr.called)
+
+    @mock.patch('os.listxattr')
+    def test_skipped_when_already_shifted(self, mock_listxattr):
+        self.shift(FakeStat(10000, 10000),
+                   skip_ranges=(idmapshift.IdMap(self.uid_maps),
+                                idmapshift.IdMap(self.gid_maps)))
+        self.assertFalse(mock_listxattr.called)
+
+
+@unittest.skipUnless(os.geteuid() == 0, 'requires root to set xattrs')
+class XattrsTreeTestCase(BaseTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        os.makedirs(os.path.join(self.tmp, 'd'))
+        self.file = os.path.join(self.tmp, 'd', 'f')
+        open(self.file, 'w').close()
+        os.lchown(self.tmp, 0, 0)
+        os.lchown(self.file, 1, 1)
+        try:
+            os.setxattr(self.tmp, xattrs.ACL_DEFAULT, access_acl(5, 12))
+            os.setxattr(self.file, xattrs.CAPABILITY, capability(1))
+        except OSError as e:
+            if e.errno in xattrs.ABSENT:
+                self.skipTest('xattrs are not supported here')
+            raise
+
+    def test_shift_dir(self):
+        for engine in [dict(), dict(fd_relative=True), dict(jobs=2),
+                       dict(processes=2)]:
+            self.setUp()
+            result = idmapshift.shift_dir(self.tmp, self.uid_maps,
+                                          self.gid_maps, main.NOBODY_ID,
+                                          xattrs=True, **engine)
+            self.assertEqual(2, result.xattrs_shifted)
+            self.assertEqual(access_acl(10005, 20002),
+                             os.getxattr(self.tmp, xattrs.ACL_DEFAULT))
+            self.assertEqual(capability(10001),
+                             os.getxattr(self.file, xattrs.CAPABILITY))
+            self.assertEqual(10001, os.lstat(self.file).st_uid)
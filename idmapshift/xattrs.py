@@ -0,0 +1,193 @@
+# Copyright 2014 Rackspace, Andrew Melton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Translate the ids stored in POSIX ACL and file capability xattrs.
+
+system.posix_acl_access and system.posix_acl_default hold a version
+word followed by (tag, perm, id) entries; the ids of named user and
+group entries are shifted like the owner. A v3 security.capability
+records the root uid of the user namespace the capability applies in,
+which is shifted as a uid. v2 capabilities hold no id and are kept as
+they are.
+
+The kernel drops security.capability when a file is chowned, so it is
+read before the chown and written back afterwards even when its rootid
+does not change.
+
+With a dir_fd, as the fd_relative walk has, an entry is opened by name
+relative to it with O_PATH and O_NOFOLLOW and its xattrs are reached
+through /proc/self/fd, so no path is resolved and a parent swapped for
+a symlink cannot redirect them outside the tree.
+"""
+
+import errno
+import os
+import stat as stat_module
+import struct
+
+ACL_ACCESS = 'system.posix_acl_access'
+ACL_DEFAULT = 'system.posix_acl_default'
+CAPABILITY = 'security.capability'
+NAMES = frozenset([ACL_ACCESS, ACL_DEFAULT, CAPABILITY])
+
+ACL_VERSION = 2
+ACL_HEADER = struct.Struct('<I')
+ACL_ENTRY = struct.Struct('<HHI')
+ACL_USER = 0x02
+ACL_GROUP = 0x08
+
+VFS_CAP_REVISION_MASK = 0xff000000
+VFS_CAP_REVISION_3 = 0x03000000
+CAP_V3 = struct.Struct('<IIIIII')
+
+# Errors meaning the entry or its filesystem has no xattrs for us.
+ABSENT = (errno.ENODATA, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOENT)
+
+PROC_FD = '/proc/self/fd/%d'
+OPEN_FLAGS = os.O_PATH | os.O_NOFOLLOW | os.O_CLOEXEC
+
+
+def _open(dir_fd, name, stat):
+    """Return an O_PATH fd for name in dir_fd, or None if swapped.
+
+    The entry counts as swapped when it is no longer the inode stat
+    describes, or has become a symlink.
+    """
+    fd = os.open(name, OPEN_FLAGS, dir_fd=dir_fd)
+    opened = os.fstat(fd)
+    same = (opened.st_ino, opened.st_dev) == (stat.st_ino, stat.st_dev)
+    if same and not stat_module.S_ISLNK(opened.st_mode):
+        return fd
+    os.close(fd)
+    return None
+
+
+def read(path, dir_fd=None, name=None, stat=None):
+    """Return {name: value} for path's ACL and capability xattrs.
+
+    Costs one listxattr, plus a getxattr for each xattr found, so an
+    inode without any is cheap. Symlinks cannot carry them and should
+    not be passed. With dir_fd, the entry is reached as name relative to
+    it, and nothing is read if it is no longer the inode stat describes.
+    """
+    if dir_fd is None:
+        return _read(path, False)
+    try:
+        fd = _open(dir_fd, name, stat)
+    except OSError as e:
+        if e.errno in ABSENT:
+            return {}
+        raise
+    if fd is None:
+        return {}
+    try:
+        return _read(PROC_FD % fd, True)
+    finally:
+        os.close(fd)
+
+
+def _read(path, follow_symlinks):
+    try:
+        names = NAMES.intersection(
+            os.listxattr(path, follow_symlinks=follow_symlinks))
+    except OSError as e:
+        if e.errno in ABSENT:
+            return {}
+        raise
+    values = {}
+    for name in names:
+        try:
+            values[name] = os.getxattr(path, name,
+                                       follow_symlinks=follow_symlinks)
+        except OSError as e:
+            if e.errno not in ABSENT:
+                raise
+    return values
+
+
+def shift_acl(value, uid_map, gid_map):
+    """Return an ACL xattr value with its named ids passed through maps.
+
+    uid_map and gid_map take an id and return its target.
+    """
+    if len(value) < ACL_HEADER.size:
+        return value
+    if ACL_HEADER.unpack_from(value)[0] != ACL_VERSION:
+        return value
+    count, extra = divmod(len(value) - ACL_HEADER.size, ACL_ENTRY.size)
+    if extra:
+        return value
+    out = bytearray(value)
+    for i in range(count):
+        offset = ACL_HEADER.size + i * ACL_ENTRY.size
+        tag, perm, fsid = ACL_ENTRY.unpack_from(value, offset)
+        if tag == ACL_USER:
+            fsid = uid_map(fsid)
+        elif tag == ACL_GROUP:
+            fsid = gid_map(fsid)
+        else:
+            continue
+        ACL_ENTRY.pack_into(out, offset, tag, perm, fsid)
+    return bytes(out)
+
+
+def shift_capability(value, uid_map):
+    """Return a capability xattr value with a v3 rootid passed through."""
+    if len(value) != CAP_V3.size:
+        return value
+    fields = list(CAP_V3.unpack(value))
+    if fields[0] & VFS_CAP_REVISION_MASK != VFS_CAP_REVISION_3:
+        return value
+    fields[5] = uid_map(fields[5])
+    return CAP_V3.pack(*fields)
+
+
+def shift(path, values, uid_map, gid_map, chowned=False, dry_run=False,
+          dir_fd=None, name=None, stat=None):
+    """Rewrite path's xattrs in values, as read() returned them, shifted.
+
+    An xattr is only written when its value changes or, for the
+    capability, when chowned says the chown has just dropped it. Returns
+    the number of xattrs that were, or in a dry run would be, rewritten.
+    dir_fd, name and stat are as for read.
+    """
+    changes = []
+    for key, value in sorted(values.items()):
+        if key == CAPABILITY:
+            shifted = shift_capability(value, uid_map)
+            if shifted == value and not chowned:
+                continue
+        else:
+            shifted = shift_acl(value, uid_map, gid_map)
+            if shifted == value:
+                continue
+        changes.append((key, shifted))
+    if dry_run or not changes:
+        return len(changes)
+    if dir_fd is None:
+        _write(path, changes, False)
+        return len(changes)
+    fd = _open(dir_fd, name, stat)
+    if fd is None:
+        return 0
+    try:
+        _write(PROC_FD % fd, changes, True)
+    finally:
+        os.close(fd)
+    return len(changes)
+
+
+def _write(path, changes, follow_symlinks):
+    for key, value in changes:
+        os.setxattr(path, key, value, follow_symlinks=follow_symlinks)